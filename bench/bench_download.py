@@ -0,0 +1,211 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+from urllib.parse import urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+from coomerscraper import networking
+from coomerscraper.bandwidth import configure_bandwidth, parse_rate
+from coomerscraper.coom import process_page
+from coomerscraper.mocksite import MockSite, SERVICE
+from coomerscraper.nodes import node_health
+from coomerscraper.ratelimit import configure_rate_limits
+from coomerscraper.scheduler import DownloadJob, ORDER_POLICIES, Scheduler
+from coomerscraper.sessions import configure_session, get_session
+
+
+"""
+Transport adapter that sends every request to the local mock site instead of its real host.
+The original host is kept in the Host header, so the scraper runs unchanged.
+"""
+class LocalAdapter(HTTPAdapter):
+    """
+    Create the adapter.
+    - port: Port of the mock site.
+    - pool_size: Maximum number of pooled connections.
+    """
+    def __init__(self, port: int, pool_size: int) -> None:
+        super().__init__(pool_connections=1, pool_maxsize=pool_size)
+        self.port = port
+
+
+    """
+    Rewrite the URL of a request to the mock site before sending it.
+    - request: Prepared request.
+    Returns the response of the mock site.
+    """
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.headers['Host'] = parts.netloc
+        request.url = urlunsplit(('http', f'127.0.0.1:{self.port}', parts.path, parts.query, ''))
+        return super().send(request, **kwargs)
+
+
+"""
+Run the mock site in a child process, so its CPU time is not counted against the scraper.
+- conn: Pipe to send the port through, and to wait on until the benchmark is done.
+- kwargs: Arguments for MockSite.
+"""
+def serve(conn, kwargs: dict) -> None:
+    site = MockSite(**kwargs)
+    conn.send((site.start(), site.media_totals()))
+    conn.recv()
+    conn.send(site.stats)
+    site.stop()
+
+
+"""
+Percentile of a list of samples.
+- samples: Samples to take the percentile of.
+- pct: Percentile between 0 and 100.
+Returns the percentile, or 0 if there are no samples.
+"""
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+"""
+Discover and download every creator of the mock site once.
+- port: Port of the mock site.
+- creators: Number of creators on the mock site.
+- jobs: Number of concurrent downloads.
+- args: Parsed benchmark arguments.
+Returns the measurements of the run.
+"""
+def run(port: int, creators: int, jobs: int, args: argparse.Namespace) -> Dict[str, float]:
+    configure_session(jobs)
+    adapter = LocalAdapter(port, max(jobs, 4))
+    get_session().mount('https://', adapter)
+    get_session().mount('http://', adapter)
+    configure_rate_limits(args.api_rate, args.media_rate)
+    configure_bandwidth(parse_rate(args.shape) if args.shape else None)
+    node_health.reset()
+
+    # Time every API request the scraper makes
+    latencies: List[float] = []
+    lock = threading.Lock()
+    api_get = networking._api_get
+    def timed_api_get(api_url: str, headers=None):
+        start = time.perf_counter()
+        try:
+            return api_get(api_url, headers)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    # Time when each file and each post finishes downloading
+    finished: List[float] = []
+    posts: Dict[str, int] = {}
+    first_post = [ 0.0 ]
+    def on_complete(nu) -> None:
+        finished.append(time.perf_counter())
+        posts[nu.post] -= 1
+        if posts[nu.post] == 0 and not first_post[0]:
+            first_post[0] = finished[-1]
+
+    dst = Path(tempfile.mkdtemp(dir=args.dir))
+    networking._api_get = timed_api_get
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            named_urls = []
+            for c in range(creators):
+                named_urls += process_page(f'https://coomer.st/{SERVICE}/user/creator{c}', False, False, (None, None))
+            discovery = time.perf_counter() - wall
+            for nu in named_urls:
+                posts[nu.post] = posts.get(nu.post, 0) + 1
+
+            (dst / 'pics').mkdir()
+            (dst / 'vids').mkdir()
+            scheduler = Scheduler(order=args.order, preflight=args.preflight)
+            scheduler.add(DownloadJob('bench', 'coomer.st', 'bench', named_urls, dst / 'pics', dst / 'vids', on_complete=on_complete))
+            start = time.perf_counter()
+            scheduler.download( jobs, segments=args.segments, segment_threshold=args.segment_threshold * 1024**2
+                              , zero_copy=args.zero_copy )
+            half = finished[len(finished) // 2 - 1] - start if finished else 0.0
+            first = first_post[0] - start if first_post[0] else 0.0
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+
+        files = [ f for folder in ('pics', 'vids') for f in (dst / folder).iterdir() if f.suffix != '.part' ]
+        size = sum(f.stat().st_size for f in files)
+    finally:
+        networking._api_get = api_get
+        shutil.rmtree(dst)
+
+    mib = size / 1024**2
+    return { 'files': len(files), 'expected': len(named_urls), 'mib': mib, 'wall': wall, 'discovery': discovery
+           , 'files_s': len(files) / wall, 'mib_s': mib / wall, 'cpu_mib': cpu * 1000 / max(mib, 1e-9)
+           , 'api_p50': percentile(latencies, 50) * 1000, 'api_p95': percentile(latencies, 95) * 1000
+           , 'api_n': len(latencies), 'first_post': first, 'half': half }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure end-to-end scraping throughput against a local mock site')
+    parser.add_argument('--jobs', type=str, default='1,4,8,16', help='comma-separated --jobs values to compare (default: 1,4,8,16)')
+    parser.add_argument('--creators', type=int, default=2, help='number of creators (default: 2)')
+    parser.add_argument('--posts', type=int, default=100, help='posts per creator (default: 100)')
+    parser.add_argument('--attachments', type=int, default=1, help='attachments per post (default: 1)')
+    parser.add_argument('--min-size', type=int, default=64, help='smallest media file in KiB (default: 64)')
+    parser.add_argument('--max-size', type=int, default=1024, help='largest media file in KiB (default: 1024)')
+    parser.add_argument('--video-scale', type=int, default=1, help='how many times larger videos are than images (default: 1)')
+    parser.add_argument('--latency', type=float, default=20.0, help='delay before every response in ms (default: 20)')
+    parser.add_argument('--bandwidth', type=int, default=0, help='KiB/s per connection, 0 for no limit (default: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with 429 (default: 0)')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of media responses dropped midway (default: 0)')
+    parser.add_argument('--dead-ratio', type=float, default=0.0, help='fraction of listed media missing from the servers (default: 0)')
+    parser.add_argument('--api-rate', type=float, default=1000.0, help='scraper API requests per second (default: 1000)')
+    parser.add_argument('--media-rate', type=float, default=1000.0, help='scraper media requests per second (default: 1000)')
+    parser.add_argument('--shape', type=str, default=None, help='scraper media bandwidth limit, e.g. 4M (default: no limit)')
+    parser.add_argument('--segments', type=int, default=1, help='parallel segments per large video (default: 1)')
+    parser.add_argument('--segment-threshold', type=int, default=256, help='segment threshold in MiB (default: 256)')
+    parser.add_argument('--order', type=str, default='discovery', choices=ORDER_POLICIES, help='download ordering policy (default: discovery)')
+    parser.add_argument('--preflight', action='store_true', help='probe every file before downloading')
+    parser.add_argument('--zero-copy', action='store_true', help='read media into reusable buffers')
+    parser.add_argument('--dir', type=str, default=None, help='folder to download into (default: a temp dir)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the content and faults (default: 0)')
+    args = parser.parse_args()
+
+    site_args = { 'creators': args.creators, 'posts': args.posts, 'attachments': args.attachments
+                , 'min_size': args.min_size * 1024, 'max_size': args.max_size * 1024, 'video_scale': args.video_scale
+                , 'latency': args.latency / 1000, 'bandwidth': args.bandwidth * 1024
+                , 'throttle_rate': args.throttle_rate, 'drop_rate': args.drop_rate, 'dead_ratio': args.dead_ratio, 'seed': args.seed }
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, site_args), daemon=True)
+    server.start()
+    port, (total_files, total_size) = parent.recv()
+    print(f'Mock site serves {total_files} files ({total_size / 1024**2:.1f} MiB) on port {port}')
+
+    try:
+        print(f'{"jobs":>5} {"files":>7} {"MiB":>8} {"wall s":>7} {"files/s":>8} {"MiB/s":>8} '
+              f'{"API p50":>8} {"API p95":>8} {"CPU ms/MiB":>10} {"1st post":>8} {"50% files":>9}')
+        for jobs in [ int(j) for j in args.jobs.split(',') ]:
+            r = run(port, args.creators, jobs, args)
+            missing = '' if r['files'] == r['expected'] else f'  ({r["expected"] - r["files"]} missing)'
+            print( f'{jobs:>5} {r["files"]:>7} {r["mib"]:>8.1f} {r["wall"]:>7.2f} {r["files_s"]:>8.1f} {r["mib_s"]:>8.1f} '
+                   f'{r["api_p50"]:>6.0f}ms {r["api_p95"]:>6.0f}ms {r["cpu_mib"]:>10.1f} '
+                   f'{r["first_post"]:>7.2f}s {r["half"]:>8.2f}s{missing}' )
+    finally:
+        parent.send(None)
+        stats = parent.recv()
+        server.join(timeout=5)
+    print( f'Mock site answered {stats["api"]} API and {stats["media"]} media requests, '
+           f'{stats["throttled"]} throttled, {stats["dropped"]} dropped' )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+from coomerscraper.utils import compute_file_hashes
+
+
+"""
+Create a synthetic download folder of mixed-size files.
+- root: Folder to create the files in.
+- files: Number of files to create.
+- seed: Seed for the file sizes and contents.
+Returns the total number of bytes written.
+"""
+def make_tree(root: Path, files: int, seed: int) -> int:
+    rng = random.Random(seed)
+    (root / 'pics').mkdir(parents=True)
+    (root / 'vids').mkdir(parents=True)
+    total = 0
+    for i in range(files):
+        # Roughly one video for every twenty images, like a typical creator
+        if rng.random() < 0.05:
+            size = rng.randint(8, 96) * 1024 * 1024
+            dst = root / 'vids' / f'{i}.mp4'
+        else:
+            size = rng.randint(16, 2048) * 1024
+            dst = root / 'pics' / f'{i}.jpg'
+        with dst.open('wb') as f:
+            f.write(os.urandom(min(size, 1024 * 1024)) * (size // (1024 * 1024) or 1))
+        total += dst.stat().st_size
+    return total
+
+
+"""
+Time a single hashing pass over a folder.
+- root: Folder to hash.
+- workers: Number of hashing threads.
+Returns the elapsed wall-clock time in seconds.
+"""
+def time_pass(root: Path, workers: int) -> float:
+    start = time.perf_counter()
+    compute_file_hashes(root, workers=workers)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare serial and parallel hashing of an existing library')
+    parser.add_argument('--files', type=int, default=3000, help='number of synthetic files (default: 3000)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='parallel hashing threads (default: cores)')
+    parser.add_argument('--repeat', type=int, default=3, help='passes per mode, best is reported (default: 3)')
+    parser.add_argument('--dir', type=str, default=None, help='folder to build the tree in (default: a temp dir)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic tree (default: 0)')
+    args = parser.parse_args()
+
+    base = Path(tempfile.mkdtemp(dir=args.dir))
+    try:
+        print(f'Building {args.files} files in {base} ...')
+        total = make_tree(base / 'creator', args.files, args.seed)
+        print(f'Tree holds {total / 1024**2:.1f} MiB')
+
+        # Warm the page cache so both modes measure hashing rather than the first disk read
+        time_pass(base / 'creator', args.workers)
+
+        for label, workers in (('serial', 1), (f'parallel x{args.workers}', args.workers)):
+            best = min(time_pass(base / 'creator', workers) for _ in range(args.repeat))
+            print(f'{label:>14}: {best:7.2f} s  {total / 1024**2 / best:8.1f} MiB/s  {args.files / best:8.1f} files/s')
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
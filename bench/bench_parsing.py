@@ -0,0 +1,150 @@
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+from coomerscraper.coom import parse_posts_json
+from coomerscraper.networking import NamedUrl
+from coomerscraper.utils import json_loads, orjson, to_camel
+
+
+BASELINE_IMG_EXTS = [ 'jpg', 'jpeg', 'png', 'gif', 'webp' ]
+BASELINE_VID_EXTS = [ 'mp4', 'm4v', 'mkv', 'mov', 'wmv', 'webm', 'avi', 'flv', 'mp3' ]
+
+WORDS = [ 'hello', 'Behind', 'the', 'scenes!', 'new', 'SET', 'outfit', '#2', 'vlog', '(part', '1)', 'café', 'summer' ]
+EXTS = [ 'jpg', 'jpg', 'jpg', 'jpeg', 'png', 'gif', 'webp', 'mp4', 'mov', 'm4v', 'zip' ]
+
+
+"""
+Create synthetic post JSONs like the ones the API returns.
+- posts: Number of posts to create.
+- seed: Seed for the titles and files.
+Returns the posts, newest first.
+"""
+def make_posts(posts: int, seed: int) -> List[dict]:
+    rng = random.Random(seed)
+    feed = []
+    for p in range(posts):
+        # Most posts have a main file, some only have attachments
+        files = []
+        for _ in range(rng.randint(0, 12)):
+            digest = '%064x' % rng.getrandbits(256)
+            ext = rng.choice(EXTS)
+            files.append({ 'name': f'{digest}.{ext}', 'path': f'/{digest[:2]}/{digest[2:4]}/{digest}.{ext}' })
+        main = files.pop(0) if files and rng.random() < 0.8 else {}
+        published = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(1700000000 - p * 3600))
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 8)))
+        feed.append({ 'id': str(1000000 - p), 'user': 'bench', 'service': 'onlyfans', 'title': title
+                    , 'published': published, 'file': main, 'attachments': files })
+    return feed
+
+
+"""
+NamedUrl as it was before the parser was optimized, a plain dataclass holding the URL.
+"""
+@dataclass
+class BaselineUrl:
+    url: str
+    name: str
+    post: Optional[str] = None
+
+
+"""
+Extract media URLs exactly the way the parser did before it was optimized, as a baseline.
+It only differs from parse_posts_json when a main file is skipped, which used to skip
+the attachments of its post too, so only runs that skip nothing are compared.
+Same arguments as parse_posts_json, and:
+- wrap: Class the URLs are wrapped in, BaselineUrl as before or NamedUrl as now.
+Yields each URL extracted from the posts.
+"""
+def baseline_parse( base: str
+                  , posts: Iterable[dict]
+                  , skip_img: bool
+                  , skip_vid: bool
+                  , wrap: Callable[..., Any] = BaselineUrl ) -> Iterator[Any]:
+    base = base.replace('https://', 'https://n1.')
+    for post in posts:
+        title = to_camel(re.sub(r'[^A-Za-z0-9\s]+', '', post['title']))
+        datetime = re.sub('-|:', '', post['published'])
+        post_id = post.get('id')
+        if 'path' in post['file']:
+            ext = post['file']['path'].split('.')[-1]
+            if skip_vid and ext in BASELINE_VID_EXTS:
+                continue
+            if skip_img and ext in BASELINE_IMG_EXTS:
+                continue
+            name = f'{datetime}-{title}_0.{ext}'
+            url = f'{base}/data/{post["file"]["path"]}'
+            yield wrap(url, name, post_id)
+
+        for i, attachment in enumerate(post['attachments']):
+            ext = attachment['path'].split('.')[-1]
+            if skip_vid and ext in BASELINE_VID_EXTS:
+                continue
+            if skip_img and ext in BASELINE_IMG_EXTS:
+                continue
+            url = f'{base}/data/{attachment["path"]}'
+            name = f'{datetime}-{title}_{i+1}.{ext}'
+            yield wrap(url, name, post_id)
+
+
+"""
+Time the best of several calls.
+- func: Function to time.
+- repeat: Number of calls.
+Returns the best elapsed wall-clock time in seconds.
+"""
+def best_of(func: Callable[[], object], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare the baseline and optimized post-JSON parsers')
+    parser.add_argument('--posts', type=int, default=50000, help='number of synthetic posts (default: 50000)')
+    parser.add_argument('--repeat', type=int, default=5, help='passes per parser, best is reported (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic posts (default: 0)')
+    args = parser.parse_args()
+
+    print(f'Building {args.posts} posts ...')
+    posts = make_posts(args.posts, args.seed)
+    body = json.dumps(posts).encode()
+    print(f'Posts hold {len(body) / 1024**2:.1f} MiB of JSON')
+
+    # The parsers are checked against each other in tests/test_parsing.py, this is only a sanity check
+    base = 'https://coomer.st'
+    expected = [ (bu.url, bu.name, bu.post) for bu in baseline_parse(base, posts, False, False) ]
+    actual = [ (nu.url, nu.name, nu.post) for nu in parse_posts_json(base, posts, False, False) ]
+    assert actual == expected, 'Parsers disagree'
+    print(f'Both parsers extract the same {len(expected)} media URLs')
+
+    # The baseline is timed with the URL wrapper it had then, and with the compact NamedUrl
+    # of today to tell the gain of the parsing loop apart from the cost of the wrapper
+    runs = [ ('baseline', lambda: list(baseline_parse(base, posts, False, False)))
+           , ('+NamedUrl', lambda: list(baseline_parse(base, posts, False, False, NamedUrl)))
+           , ('optimized', lambda: list(parse_posts_json(base, posts, False, False))) ]
+    times = {}
+    for label, run in runs:
+        times[label] = best = best_of(run, args.repeat)
+        print(f'{label:>10}: {best:7.3f} s  {args.posts / best:10.0f} posts/s  {times["baseline"] / best:5.2f}x')
+
+    decoders = [ ('json', json.loads) ] + ([ ('orjson', json_loads) ] if orjson is not None else [])
+    for label, loads in decoders:
+        best = best_of(lambda: loads(body), args.repeat)
+        print(f'{label:>10}: {best:7.3f} s  {len(body) / 1024**2 / best:10.1f} MiB/s')
+    if orjson is None:
+        print('orjson is not installed, the API is decoded with json')
+
+
+if __name__ == '__main__':
+    main()
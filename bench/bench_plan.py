@@ -0,0 +1,99 @@
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_parsing import make_posts
+from coomerscraper.coom import parse_posts_json
+from coomerscraper.urllist import DigestSet, UrlList
+
+
+"""
+NamedUrl as it was before plans were made compact, as a reference
+"""
+@dataclass
+class ReferenceNamedUrl:
+    url: str
+    name: str
+    post: Optional[str] = None
+
+
+"""
+Hold a plan the way it was held before it was made compact, as a reference.
+- posts: Post JSONs to plan.
+Returns the plan and the set of URLs it was deduplicated with.
+"""
+def reference_plan(posts: List[dict]) -> Tuple[list, set]:
+    seen, plan = set(), []
+    for nu in parse_posts_json('https://coomer.st', posts, False, False):
+        url = nu.url
+        if url not in seen:
+            seen.add(url)
+            plan.append(ReferenceNamedUrl(url, nu.name, nu.post))
+    return plan, seen
+
+
+"""
+Hold a plan in a UrlList, deduplicated by the binary hash of each file in a DigestSet.
+- posts: Post JSONs to plan.
+Returns the plan and the set of hashes it was deduplicated with.
+"""
+def compact_plan(posts: List[dict]) -> Tuple[UrlList, DigestSet]:
+    seen, plan = DigestSet(), UrlList()
+    for nu in parse_posts_json('https://coomer.st', posts, False, False):
+        if seen.add(nu.key()):
+            plan.append(nu)
+    return plan, seen
+
+
+"""
+Measure the memory a plan holds on to once it is built.
+The plan is built twice, since tracing allocations slows the build down: once to time it, once to trace it.
+- build: Function building the plan.
+- posts: Post JSONs to plan.
+Returns the bytes held by the plan, by its deduplication set, and the build time in seconds.
+"""
+def measure(build: Callable[[List[dict]], Tuple[object, object]], posts: List[dict]) -> Tuple[int, int, float]:
+    gc.collect()
+    start = time.perf_counter()
+    build(posts)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    plan, seen = build(posts)
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0]
+    del seen
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del plan
+    return held, total - held, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare the memory of reference and compact download plans')
+    parser.add_argument('--posts', type=int, default=115000, help='number of synthetic posts, about 500k files (default: 115000)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic posts (default: 0)')
+    args = parser.parse_args()
+
+    print(f'Building {args.posts} posts ...')
+    posts = make_posts(args.posts, args.seed)
+    files = len(compact_plan(posts)[0])
+    print(f'Posts hold {files} unique media files')
+
+    for label, build in (('reference', reference_plan), ('compact', compact_plan)):
+        held, seen, elapsed = measure(build, posts)
+        print( f'{label:>10}: plan {held / 1024**2:7.1f} MiB ({held / files:5.0f} B/file)  '
+               f'dedup set {seen / 1024**2:7.1f} MiB  total {(held + seen) / 1024**2:7.1f} MiB '
+               f'({(held + seen) / files:5.0f} B/file)  built in {elapsed:.2f} s' )
+
+
+if __name__ == '__main__':
+    main()
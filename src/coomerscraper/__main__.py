@@ -3,9 +3,14 @@ import logging
 import os
 import sys
 from pathlib import Path
-from typing import List, Tuple
+from typing import List
 
-from .coom import main as coom_main
+from .aio import async_available
+from .apicache import CACHE_MAX_BYTES, CACHE_TTL
+from .bandwidth import parse_rate, parse_schedule
+from .coom import ScrapeConfig, main as coom_main
+from .networking import SEGMENT_COUNT, SEGMENT_THRESHOLD
+from .ratelimit import API_RATE, MEDIA_RATE
 from .utils import sanitize_url
 
 
@@ -15,21 +20,47 @@ logger = logging.getLogger(__name__)
 """
 Parse the program arguments or read them from stdin
 """
-def get_arguments() -> Tuple[List[str], Path, bool, bool, Tuple[int,int], bool, int]:
+def get_arguments() -> argparse.Namespace:
         # Initialize arguments for CLI use
     parser = argparse.ArgumentParser(description='Coomer and Kemono scraper')
     parser.exit_on_error = False
     parser.add_argument('urls', type=str, nargs='*', help='coomer or kemono URLs to scrape media from, separated by a space')
+    parser.add_argument('--api-cache-size', type=int, default=CACHE_MAX_BYTES // (1024 * 1024), help=f'maximum size in MiB of the API response cache (default: {CACHE_MAX_BYTES // (1024 * 1024)})')
+    parser.add_argument('--api-cache-ttl', type=float, default=CACHE_TTL, help=f'seconds to reuse cached API responses past the first page before revalidating, 0 to disable the cache (default: {CACHE_TTL:g})')
+    parser.add_argument('--api-rate', type=float, default=API_RATE, help=f'maximum API requests per second (default: {API_RATE:g})')
+    parser.add_argument('--bandwidth', type=str, default=None, help='maximum media bandwidth over every download, e.g. 500K or 2M bytes per second (default: no limit)')
+    parser.add_argument('--bandwidth-schedule', type=str, default=None, help='bandwidth by local time of day, e.g. "08:00-18:00=1M,18:00-08:00=0", taking precedence over --bandwidth')
     parser.add_argument('-c', '--confirm', action='store_true', help='confirm arguments before proceeding')
+    parser.add_argument('--creator-bandwidth', type=str, default=None, help='maximum media bandwidth per creator (default: no limit)')
+    parser.add_argument('--creator-jobs', type=int, default=0, help='maximum concurrent downloads per creator, 0 for no limit (default: 0)')
     parser.add_argument('--dump-urls', action='store_true', help='print the urls to a text file instead of downloading')
-    parser.add_argument('-j', '--jobs', type=int, default=4, help='number of concurrent download threads (default: 4)')
+    parser.add_argument('--engine', type=str, default='threads', choices=['threads', 'async'], help='download engine, async requires aiohttp (default: threads)')
+    parser.add_argument('--export-plan', type=str, default=None, help='export the download plan to a file ("-" for stdout) instead of downloading')
+    parser.add_argument('--hash-jobs', type=int, default=0, help='number of threads hashing existing files, 0 for one per core (default: 0)')
+    parser.add_argument('--host-bandwidth', type=str, default=None, help='maximum media bandwidth per site (default: no limit)')
+    parser.add_argument('--host-jobs', type=int, default=0, help='maximum concurrent downloads per site, 0 for no limit (default: 0)')
+    parser.add_argument('--import-plan', type=str, default=None, help='download the files of a plan exported in the jsonl format')
+    parser.add_argument('-i', '--input-file', type=str, default=None, help='file of URLs to scrape, one per line')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='number of concurrent downloads (default: 4)')
     parser.add_argument('--log-file', type=str, default=None, help='direct logs to a file instead of stdout')
     parser.add_argument('--log-level', type=str, default=None, help='level of logging (DEBUG, INFO, WARNING, ERROR; default: INFO)')
+    parser.add_argument('--media-rate', type=float, default=None, help=f'maximum media requests per second to each server (default: no limit until a server answers 429, then {MEDIA_RATE:g} halved on every further 429)')
+    parser.add_argument('--metrics-file', type=str, default=None, help='write a JSON summary of counters and timings to a file at exit')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve Prometheus metrics on this localhost port while running')
+    parser.add_argument('--no-progress', action='store_true', help='do not draw progress bars, only log a periodic summary')
     parser.add_argument('--offset-end', type=int, default=None, dest='end', help='ending offset to finish downloading')
     parser.add_argument('--offset-start', type=int, default=None, dest='start', help='starting offset to begin downloading')
+    parser.add_argument('--order', type=str, default='discovery', choices=['discovery', 'smallest', 'newest', 'images', 'mixed'], help='order to download the files of each URL in (default: discovery)')
     parser.add_argument('-o', '--out', type=str, default=os.getcwd(), help='download destination (default: CWD)')
+    parser.add_argument('--plan-format', type=str, default='jsonl', choices=['jsonl', 'aria2'], help='format of the exported plan, aria2 writes an aria2c input file (default: jsonl)')
+    parser.add_argument('--preflight', action='store_true', help='probe every file before downloading to skip dead links and files on disk (threads engine only)')
+    parser.add_argument('--segment-threshold', type=int, default=SEGMENT_THRESHOLD // (1024 * 1024), help=f'size in MiB from which videos are downloaded in parallel segments (default: {SEGMENT_THRESHOLD // (1024 * 1024)})')
+    parser.add_argument('--segments', type=int, default=SEGMENT_COUNT, help=f'number of parallel segments per large video, 1 to disable (default: {SEGMENT_COUNT})')
     parser.add_argument('--skip-imgs', action='store_true', help='skip image downloads')
     parser.add_argument('--skip-vids', action='store_true', help='skip video downloads')
+    parser.add_argument('--store', type=str, default=None, help='content-addressed store to hardlink media from, shared by every creator')
+    parser.add_argument('--sync', action='store_true', help='only scrape page posts newer than those of the last completed run')
+    parser.add_argument('--zero-copy', action='store_true', help='read media from the socket into reusable buffers (threads engine only)')
 
     # Handle the special case of logging data
     log_file = None
@@ -69,50 +100,72 @@ def get_arguments() -> Tuple[List[str], Path, bool, bool, Tuple[int,int], bool,
         if '--help' in sys.argv or '-h' in sys.argv:
             parser.print_help(sys.stderr)
             exit()
-        urls = args.urls
-        dst = args.out
-        skip_img = args.skip_imgs
-        skip_vid = args.skip_vids
-        confirm = args.confirm
-        offs_start = args.start
-        offs_end = args.end
-        dump_urls = args.dump_urls
-        jobs = args.jobs
-        assert len(urls) > 0
+        assert len(args.urls) > 0 or args.input_file is not None or args.import_plan is not None
         logger.debug('Usage: non-interactive')
 
     # Fallback to interactive usage
     except AssertionError:
         logger.debug('Usage: interactive')
-        urls = [ input('Enter Coomer URL: ') ]
-        dst = input(f'Enter download dir (default: {os.getcwd()}): ')
+        args.urls = [ input('Enter Coomer URL: ') ]
+        args.out = input(f'Enter download dir (default: {os.getcwd()}): ')
         skip_img = input('Skip images (y/N): ')
         skip_vid = input('Skip videos (y/N): ')
-        skip_img = skip_img and skip_img.lower()[0] == 'y'
-        skip_vid = skip_vid and skip_vid.lower()[0] == 'y'
-        dst = dst if dst else os.getcwd()
-        offs_start = None
-        offs_end = None
-        dump_urls = False
-        confirm = True
+        args.skip_imgs = bool(skip_img) and skip_img.lower()[0] == 'y'
+        args.skip_vids = bool(skip_vid) and skip_vid.lower()[0] == 'y'
+        args.out = args.out if args.out else os.getcwd()
+        args.start = None
+        args.end = None
+        args.dump_urls = False
+        args.confirm = True
 
     # Allow the user to confirm information
-    if(confirm):
+    if(args.confirm):
         print()
-        logger.info(f'Scraping media from {urls}')
-        logger.info(f'Media will be downloaded to {dst}')
-        logger.info(f'Videos will be {skip_vid and "skipped" or "downloaded"}')
-        logger.info(f'Images will be {skip_img and "skipped" or "downloaded"}')
-        logger.info(f'Starting offset is {offs_start}')
-        logger.info(f'Ending offset is {offs_end}')
-        logger.info(f'There will be {jobs} concurrent download threads')
+        logger.info(f'Scraping media from {args.urls}{f" and the URLs in {args.input_file}" if args.input_file else ""}')
+        logger.info(f'Media will be downloaded to {args.out}')
+        if args.export_plan:
+            logger.info(f'The plan will be exported to {args.export_plan} as {args.plan_format} instead of downloading')
+        if args.import_plan:
+            logger.info(f'The plan in {args.import_plan} will be downloaded')
+        logger.info(f'Videos will be {args.skip_vids and "skipped" or "downloaded"}')
+        logger.info(f'Images will be {args.skip_imgs and "skipped" or "downloaded"}')
+        logger.info(f'Starting offset is {args.start}')
+        logger.info(f'Ending offset is {args.end}')
+        logger.info(f'There will be {args.jobs} concurrent downloads using the {args.engine} engine')
+        logger.info(f'Files will be downloaded in {args.order} order')
+        logger.info(f'Files will be {args.preflight and "probed before downloading" or "downloaded without probing"}')
+        logger.info(f'Downloads are limited to {args.creator_jobs or "any number"} per creator and {args.host_jobs or "any number"} per site')
+        logger.info(f'Videos of at least {args.segment_threshold} MiB will be split into {args.segments} segments')
+        logger.info(f'Requests are limited to {args.api_rate}/s for the API and {args.media_rate is not None and f"{args.media_rate}/s per media server" or "media servers once they answer 429"}')
+        logger.info(f'Media bandwidth is limited to {args.bandwidth or "no limit"}{f" (scheduled as {args.bandwidth_schedule})" if args.bandwidth_schedule else ""}, '
+                    f'{args.host_bandwidth or "no limit"} per site and {args.creator_bandwidth or "no limit"} per creator')
+        logger.info(f'API responses will be {args.api_cache_ttl > 0 and f"cached for {args.api_cache_ttl:g}s, up to {args.api_cache_size} MiB" or "not cached"}')
+        logger.info(f'There will be {args.hash_jobs or "one per core"} hashing threads')
+        logger.info(f'Media will be read {args.zero_copy and "into reusable buffers" or "in regular chunks"}')
+        logger.info(f'Progress will be {not args.no_progress and "drawn as bars" or "logged periodically"}')
+        logger.info(f'Metrics will be {args.metrics_port is not None and f"served on port {args.metrics_port}" or "not served"}'
+                    f'{f" and summarized to {args.metrics_file}" if args.metrics_file else ""}')
+        logger.info(f'Media will be {args.store and f"shared between creators through {args.store}" or "stored per creator"}')
+        logger.info(f'Pages will be {args.sync and "synced from the last completed run" or "fully scraped"}')
         print()
         confirmed = input('Continue to download (Y/n): ')
         if len(confirmed) > 0 and confirmed.lower()[0] != 'y':
             exit()
 
     # Return parsed arguments
-    return urls, Path(dst), skip_img, skip_vid, (offs_start, offs_end), dump_urls, jobs
+    return args
+
+
+
+"""
+Read the URLs listed in a file, one per line.
+Blank lines and lines starting with "#" are ignored.
+- path: File to read.
+Returns the list of URLs.
+"""
+def read_url_file(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [ line.strip() for line in f if line.strip() and not line.strip().startswith('#') ]
 
 
 
@@ -121,30 +174,147 @@ Driver function to handle argument parsing and sanity checks before going to coo
 """
 def main():
     # Get the program arguments or read them from stdin
-    urls, dst, skip_img, skip_vid, offsets, dump_urls, jobs = get_arguments()
+    args = get_arguments()
 
     # Sanity check skip flags
-    if skip_img and skip_vid:
+    if args.skip_imgs and args.skip_vids:
         logger.warning('Nothing to download when skipping images and videos')
         return
 
     # Sanity check offsets
-    if offsets[0] is not None and offsets[0] <= 0:
+    if args.start is not None and args.start <= 0:
         logger.error('Starting offset must be > 0')
         return
-    if offsets[1] is not None:
-        if offsets[1] <= 0:
+    if args.end is not None:
+        if args.end <= 0:
             logger.error('Ending offset must be > 0')
             return
-        if offsets[0] is not None and offsets[0] > offsets[1]:
+        if args.start is not None and args.start > args.end:
             logger.error('Ending offset must be >= starting offset')
             return
 
+    # Sanity check thread counts
+    if args.jobs <= 0:
+        logger.error('Number of download threads must be > 0')
+        return
+    if args.hash_jobs < 0:
+        logger.error('Number of hashing threads must be >= 0')
+        return
+    if args.creator_jobs < 0 or args.host_jobs < 0:
+        logger.error('Per-creator and per-site download limits must be >= 0')
+        return
+    if args.engine == 'async' and (args.creator_jobs > 0 or args.host_jobs > 0):
+        logger.warning('Per-creator and per-site download limits are ignored by the async engine')
+    if args.engine == 'async' and args.order != 'discovery':
+        logger.warning('Download ordering is ignored by the async engine')
+    if args.engine == 'async' and args.preflight:
+        logger.warning('Preflight probing is ignored by the async engine')
+    if args.engine == 'async' and args.zero_copy:
+        logger.warning('Zero-copy reads are ignored by the async engine')
+
+    # Sanity check segmented downloads
+    if args.segments <= 0:
+        logger.error('Number of segments must be > 0')
+        return
+    if args.segment_threshold <= 0:
+        logger.error('Segment threshold must be > 0')
+        return
+
+    # Sanity check request rates
+    if args.api_rate <= 0 or (args.media_rate is not None and args.media_rate <= 0):
+        logger.error('Request rates must be > 0')
+        return
+
+    # Sanity check bandwidth limits, which are parsed into bytes per second
+    try:
+        bandwidth = parse_rate(args.bandwidth) if args.bandwidth else None
+        host_bandwidth = parse_rate(args.host_bandwidth) if args.host_bandwidth else None
+        creator_bandwidth = parse_rate(args.creator_bandwidth) if args.creator_bandwidth else None
+        bandwidth_schedule = parse_schedule(args.bandwidth_schedule) if args.bandwidth_schedule else None
+    except ValueError as e:
+        logger.error(f'{e}, bandwidths are numbers of bytes per second with an optional K, M or G suffix')
+        return
+
+    # Sanity check the API cache
+    if args.api_cache_ttl < 0 or args.api_cache_size <= 0:
+        logger.error('API cache TTL must be >= 0 and its size must be > 0')
+        return
+
+    # Sanity check syncing, which needs the whole page
+    if args.sync and (args.start is not None or args.end is not None):
+        logger.warning('Pages are not synced when starting or ending offsets are given')
+
+    # Sanity check the metrics endpoint
+    if args.metrics_port is not None and not 0 <= args.metrics_port <= 65535:
+        logger.error('Metrics port must be between 0 and 65535')
+        return
+
+    # Sanity check plans, which are either exported or imported
+    if args.import_plan is not None and (args.export_plan is not None or args.dump_urls):
+        logger.error('A plan cannot be imported while exporting a plan or dumping URLs')
+        return
+    if args.export_plan is not None and args.dump_urls:
+        logger.error('A plan cannot be exported while dumping URLs')
+        return
+    if args.import_plan is not None and not Path(args.import_plan).is_file():
+        logger.error(f'Plan {args.import_plan} does not exist')
+        return
+    if args.import_plan is not None and args.engine == 'async':
+        logger.warning('Imported plans are downloaded with the threads engine')
+
+    # Sanity check the download engine
+    if args.engine == 'async' and not async_available():
+        logger.error('The async engine requires aiohttp (pip install coomerscraper[async])')
+        return
+
+    # Read the URLs listed in the input file
+    urls = args.urls
+    if args.input_file is not None:
+        try:
+            urls = urls + read_url_file(args.input_file)
+        except OSError as e:
+            logger.error(f'Failed to read URLs from {args.input_file}: {e}')
+            return
+        if not urls:
+            logger.error(f'No URLs found in {args.input_file}')
+            return
+
     # Sanitize argument URLs
     urls = [ sanitize_url(u) for u in urls ]
 
     # Proceed with coomer-specific details...
-    coom_main(urls, dst, skip_img, skip_vid, offsets, dump_urls, jobs)
+    coom_main(ScrapeConfig( urls=urls
+                          , dst=Path(args.out)
+                          , skip_img=args.skip_imgs
+                          , skip_vid=args.skip_vids
+                          , offsets=(args.start, args.end)
+                          , dump_urls=args.dump_urls
+                          , jobs=args.jobs
+                          , hash_jobs=args.hash_jobs
+                          , engine=args.engine
+                          , segment_count=args.segments
+                          , segment_threshold=args.segment_threshold * 1024 * 1024
+                          , api_rate=args.api_rate
+                          , media_rate=args.media_rate
+                          , sync=args.sync
+                          , creator_jobs=args.creator_jobs
+                          , host_jobs=args.host_jobs
+                          , show_progress=not args.no_progress
+                          , zero_copy=args.zero_copy
+                          , metrics_port=args.metrics_port
+                          , metrics_file=Path(args.metrics_file) if args.metrics_file else None
+                          , api_cache_ttl=args.api_cache_ttl
+                          , api_cache_size=args.api_cache_size * 1024 * 1024
+                          , store=Path(args.store) if args.store else None
+                          , export_plan=args.export_plan
+                          , plan_format=args.plan_format
+                          , import_plan=Path(args.import_plan) if args.import_plan else None
+                          , order=args.order
+                          , bandwidth=bandwidth
+                          , host_bandwidth=host_bandwidth
+                          , creator_bandwidth=creator_bandwidth
+                          , bandwidth_schedule=bandwidth_schedule
+                          , preflight=args.preflight ))
     
 
 
@@ -0,0 +1,392 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections.abc import Sequence
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .bandwidth import bandwidth_shaper
+from .hashindex import HashIndex
+from .metrics import metrics
+from .networking import ( _chunk_size, _dead_link, _destination, _seed_hash, _write_buffer_size
+                        , DEAD_STATUSES, MAX_CORRUPT_RETRIES, MISSING_ATTEMPTS, NamedUrl )
+from .nodes import node_health
+from .progress import LOG_INTERVAL, RENDER_INTERVAL
+from .ratelimit import parse_retry_after, rate_limiter
+from .store import content_store
+from .utils import hash_from_url
+
+
+DISK_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Check if the asyncio download engine can be used.
+Returns True if the optional aiohttp dependency is installed.
+"""
+def async_available() -> bool:
+    return aiohttp is not None
+
+
+"""
+Shared progress for every transfer running on the event loop.
+Instead of one bar per download, a single bar tracks the combined bytes. Transfers
+only add to plain counters, which a background task renders at a fixed rate.
+"""
+class _AsyncProgress:
+    """
+    Create the file and byte bars.
+    - total_urls: Number of files to download, or None if unknown.
+    - show: If the bars should be drawn, otherwise progress is only logged.
+    """
+    def __init__(self, total_urls: Optional[int], show: bool = True) -> None:
+        self.show = show
+        self.total_urls = total_urls
+        self.files = tqdm(total=total_urls, unit="file", desc="Total Media Files", position=0, disable=not show)
+        self.bytes = tqdm(unit="B", unit_scale=True, unit_divisor=1024, desc="Transferred", position=1, disable=not show)
+        self.transferred = 0
+        self.completed = 0
+        self.failed = 0
+        self.active = 0
+        self.paused = 0
+        self._start = time.monotonic()
+
+
+    """
+    Redraw the bars at a fixed rate, or log a summary every so often if headless.
+    """
+    async def run(self) -> None:
+        logged = time.monotonic()
+        while True:
+            await asyncio.sleep(RENDER_INTERVAL)
+            if self.show:
+                self.render()
+            elif time.monotonic() - logged >= LOG_INTERVAL:
+                logged = time.monotonic()
+                self.log_summary()
+
+
+    """
+    Sample the counters into the bars.
+    """
+    def render(self) -> None:
+        self.files.n = self.completed + self.failed
+        if self.failed:
+            self.files.set_postfix(failed=self.failed, refresh=False)
+        self.bytes.n = self.transferred
+        self.bytes.set_postfix(active=self.active, paused=self.paused, refresh=False)
+        self.files.refresh()
+        self.bytes.refresh()
+
+
+    """
+    Log how many files and bytes have been downloaded so far.
+    """
+    def log_summary(self) -> None:
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        total = f'/{self.total_urls}' if self.total_urls is not None else ''
+        failed = f' ({self.failed} failed)' if self.failed else ''
+        logger.info( f'Downloaded {self.completed}{total} files{failed}, {self.transferred / 1024**2:.1f} MiB '
+                     f'({self.transferred / 1024**2 / elapsed:.2f} MiB/s)' )
+
+
+    """
+    Close both bars, or log the final summary if headless.
+    """
+    def close(self) -> None:
+        if self.show:
+            self.render()
+        else:
+            self.log_summary()
+        self.bytes.close()
+        self.files.close()
+
+
+"""
+Write a batch of chunks of a download and add it to the hash of the file.
+Called on a disk thread, so disk writes never stall the event loop.
+- f: Partial download, open for appending.
+- hasher: Hash of the bytes written so far.
+- data: Bytes to write.
+"""
+def _write_chunk(f: BinaryIO, hasher: 'hashlib._Hash', data: bytearray) -> None:
+    f.write(data)
+    hasher.update(data)
+
+
+"""
+Get how much of a file was already downloaded.
+- tmp: Partial download.
+Returns the size of the partial download, 0 if there is none.
+"""
+def _part_size(tmp: Path) -> int:
+    return tmp.stat().st_size if tmp.exists() else 0
+
+
+"""
+Link a file that was already downloaded for any creator out of the content store.
+- digest: Hash of the file, if known.
+- dst: Destination of the file.
+- index: Hash index to record the linked file in, if any.
+Returns True if the file was linked.
+"""
+def _link_stored(digest: Optional[str], dst: Path, index: Optional[HashIndex]) -> bool:
+    if not content_store.link_out(digest, dst):
+        return False
+    if index is not None:
+        index.add(dst, digest)
+    return True
+
+
+"""
+Move a finished download into place and record it.
+- tmp: Partial download holding the whole file.
+- dst: Destination of the file.
+- digest: Hash of the downloaded file.
+- expected: Hash of the file from its URL, if any.
+- index: Hash index to record the file in, if any.
+"""
+def _finish_file(tmp: Path, dst: Path, digest: str, expected: Optional[str], index: Optional[HashIndex]) -> None:
+    tmp.replace(dst)
+    if index is not None:
+        index.add(dst, digest)
+    if digest == expected:
+        content_store.add(dst, digest)
+
+
+"""
+Download a single URL on the event loop, choosing load-balancing servers by their measured health.
+This mirrors networking._download: .part files are resumed, the file is hashed as it
+streams in, and errors move the transfer to another server. Chunks are buffered and
+written and hashed in batches, and every other file operation runs on the disk threads.
+- session: Shared aiohttp session.
+- disk: Executor for the file operations of every transfer.
+- url: NamedUrl to download.
+- dst: Destination of the URL.
+- progress: Shared progress for all transfers.
+- index: Hash index to record the completed file in, if any.
+- creator: Creator of the file, for its bandwidth limit.
+"""
+async def _download_async( session: 'aiohttp.ClientSession'
+                         , disk: Executor
+                         , url: NamedUrl
+                         , dst: Path
+                         , progress: _AsyncProgress
+                         , index: Optional[HashIndex] = None
+                         , creator: Optional[str] = None ) -> None:
+    loop = asyncio.get_running_loop()
+    def run(func: Callable[..., Any], *args: Any) -> 'asyncio.Future[Any]':
+        return loop.run_in_executor(disk, func, *args)
+
+    # Link files that were already downloaded for any creator out of the content store
+    expected = hash_from_url(url.url)
+    if await run(_link_stored, expected, dst, index):
+        return
+
+    server_ident = node_health.choose()
+    static_url = url.url[10:]
+    tmp = dst.with_suffix(dst.suffix + '.part')
+    timeout = aiohttp.ClientTimeout(sock_connect=3, sock_read=3)
+    hasher, hashed = await run(_seed_hash, tmp)
+    corrupt = 0
+    missing = 0
+
+    while True:
+        headers = {}
+        done = await run(_part_size, tmp)
+        if done > 0:
+            headers['Range'] = f'bytes={done}-'
+        if hashed != done:
+            hasher, hashed = await run(_seed_hash, tmp)
+
+        real_url = f'https://n{server_ident}{static_url}'
+        await asyncio.sleep(rate_limiter.reserve(real_url))
+        meter = node_health.meter(server_ident)
+        throttle = bandwidth_shaper.throttle(real_url, creator)
+        try:
+            async with session.get(real_url, headers=headers, timeout=timeout) as res:
+                meter.responded()
+
+                # The partial download already holds the entire file
+                if res.status != 416 or done == 0:
+                    res.raise_for_status()
+
+                    # The server ignored the range, so start from the beginning
+                    if done > 0 and res.status != 206:
+                        await run(tmp.unlink)
+                        hasher, hashed, done = hashlib.sha256(), 0, 0
+
+                    # Chunks are written in batches, so a transfer only hands its file to a disk
+                    # thread every few chunks, and whatever arrived is written even on errors
+                    f = await run(tmp.open, 'ab')
+                    buffer = bytearray()
+                    try:
+                        chunk_size = _chunk_size(res.content_length, throttle.cap(node_health.throughput(server_ident)))
+                        buffer_size = _write_buffer_size(chunk_size)
+                        async for chunk in res.content.iter_chunked(chunk_size):
+                            buffer += chunk
+                            if len(buffer) >= buffer_size:
+                                data, buffer = buffer, bytearray()
+                                await run(_write_chunk, f, hasher, data)
+                            meter.update(len(chunk))
+                            wait = throttle.reserve(len(chunk))
+                            if wait > 0:
+                                await asyncio.sleep(wait)
+                            done += len(chunk)
+                            progress.transferred += len(chunk)
+                    finally:
+                        if buffer:
+                            await run(_write_chunk, f, hasher, buffer)
+                        hashed = done
+                        await run(f.close)
+            meter.close()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Give up on files that several servers do not have. A missing file says
+            # nothing about the health of the server, so only other errors count against it.
+            meter.close()
+            status = getattr(e, 'status', None)
+            if status in DEAD_STATUSES:
+                missing += 1
+                if missing >= MISSING_ATTEMPTS:
+                    raise
+            else:
+                err_headers = getattr(e, 'headers', None) or {}
+                node_health.record_error(server_ident, status, parse_retry_after(err_headers.get('Retry-After')))
+                rate_limiter.record_error(real_url, status)
+
+            # Move to the best other server, pausing only if every server is backed off
+            server_ident = node_health.choose(exclude=server_ident)
+            pause = node_health.delay(server_ident)
+            if pause > 0:
+                metrics.inc('backoff_seconds_total', pause, kind='media')
+                progress.paused += 1
+                await asyncio.sleep(pause)
+                progress.paused -= 1
+            continue
+
+        # Discard corrupt downloads and try again, up to a limit
+        digest = hasher.hexdigest()
+        if expected is not None and digest != expected:
+            corrupt += 1
+            metrics.inc('hash_mismatches_total')
+            if corrupt < MAX_CORRUPT_RETRIES:
+                logger.warning(f'Hash mismatch for {url.name} ({digest} != {expected}), retrying download')
+                await run(tmp.unlink)
+                hasher, hashed = hashlib.sha256(), 0
+                continue
+            logger.error(f'Hash mismatch for {url.name} persisted after {corrupt} attempts, keeping the file')
+
+        await run(_finish_file, tmp, dst, digest, expected, index)
+        return
+
+
+"""
+Download a list of NamedUrl using asyncio, holding many transfers on a single thread.
+URLs may be a lazy iterable; it is advanced on a helper thread so that slow
+discovery (e.g. API pagination) never blocks the transfers already running.
+- urls: List or iterable of NamedUrl to download.
+- dst_pics: Path to download pictures to.
+- dst_vids: Path to download videos to.
+- workers: Maximum number of concurrent transfers.
+- index: Hash index to record completed downloads in, if any.
+- on_complete: Called on a disk thread with each NamedUrl once it is downloaded.
+- show_progress: If progress bars should be drawn.
+- creator: Creator of the files, for its bandwidth limit.
+- on_dead: Called on a disk thread with each NamedUrl that the servers do not have.
+"""
+def async_download( urls: Iterable[NamedUrl]
+                  , dst_pics: Path
+                  , dst_vids: Path
+                  , workers: int = 64
+                  , index: Optional[HashIndex] = None
+                  , on_complete: Optional[Callable[[NamedUrl], None]] = None
+                  , show_progress: bool = True
+                  , creator: Optional[str] = None
+                  , on_dead: Optional[Callable[[NamedUrl], None]] = None ) -> None:
+    if aiohttp is None:
+        raise RuntimeError('The asyncio engine requires aiohttp (pip install coomerscraper[async])')
+    asyncio.run(_async_download(urls, dst_pics, dst_vids, workers, index, on_complete, show_progress, creator, on_dead))
+    if index is not None:
+        index.save()
+
+
+"""
+Event loop body of async_download, see async_download for the arguments.
+"""
+async def _async_download( urls: Iterable[NamedUrl]
+                         , dst_pics: Path
+                         , dst_vids: Path
+                         , workers: int
+                         , index: Optional[HashIndex]
+                         , on_complete: Optional[Callable[[NamedUrl], None]]
+                         , show_progress: bool
+                         , creator: Optional[str]
+                         , on_dead: Optional[Callable[[NamedUrl], None]] ) -> None:
+    url_iter: Iterator[NamedUrl] = iter(urls)
+    loop = asyncio.get_running_loop()
+    pull_lock = asyncio.Lock()
+    progress = _AsyncProgress(len(urls) if isinstance(urls, Sequence) else None, show_progress)
+
+    # Discovery and disk work get threads of their own, so neither queues behind the other
+    # or behind anything else on the default executor
+    discovery = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aio-discover')
+    disk = ThreadPoolExecutor(max_workers=DISK_WORKERS, thread_name_prefix='aio-disk')
+
+    # Helper to take the next URL without blocking the event loop
+    async def pull() -> Optional[NamedUrl]:
+        async with pull_lock:
+            return await loop.run_in_executor(discovery, next, url_iter, None)
+
+    # Each worker repeatedly takes the next URL until none are left
+    async def worker(session: 'aiohttp.ClientSession') -> None:
+        while True:
+            waited = time.monotonic()
+            url = await pull()
+            if url is None:
+                return
+            started = time.monotonic()
+            metrics.observe('queue_wait_seconds', started - waited)
+            progress.active += 1
+            # Any error only fails its own file, the worker moves on to the next one
+            try:
+                await _download_async(session, disk, url, _destination(url, dst_pics, dst_vids), progress, index, creator)
+            except Exception as e:
+                progress.failed += 1
+                if not _dead_link(e):
+                    metrics.inc('files_total', result='failed')
+                    logger.error(f'Failed to download {url.name}: {e}')
+                    continue
+                metrics.inc('files_total', result='dead')
+                logger.warning(f'Skipping {url.name}, the file is missing on the servers: {e}')
+                if on_dead is not None:
+                    await loop.run_in_executor(disk, on_dead, url)
+                continue
+            finally:
+                progress.active -= 1
+                metrics.observe('download_seconds', time.monotonic() - started)
+            metrics.inc('files_total', result='downloaded')
+            progress.completed += 1
+            if on_complete is not None:
+                await loop.run_in_executor(disk, on_complete, url)
+
+    connector = aiohttp.TCPConnector(limit=workers)
+    renderer = asyncio.create_task(progress.run())
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*(worker(session) for _ in range(workers)))
+    finally:
+        renderer.cancel()
+        progress.close()
+        discovery.shutdown(wait=False)
+        disk.shutdown()
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .metrics import metrics
+
+
+CACHE_DIR_NAME = '.apicache'
+CACHE_TTL = 3600.0
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+ENTRY_SUFFIX = '.entry'
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Cached API response along with what is needed to revalidate it
+"""
+@dataclass
+class CacheEntry:
+    url: str
+    body: bytes
+    stored: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+    """
+    Check if the entry may be used without asking the server.
+    - ttl: Number of seconds a response stays fresh.
+    Returns True if the entry is younger than the TTL.
+    """
+    def fresh(self, ttl: float) -> bool:
+        return time.time() - self.stored < ttl
+
+
+    """
+    Get the headers that ask the server to only send the response if it changed.
+    Returns the conditional request headers, empty if the server sent no validators.
+    """
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+"""
+On-disk cache of API responses, shared by every API request.
+Each response is kept in its own file, named after the hash of its URL (which holds
+the service, creator, and offset or post). Responses are served without a request
+while younger than the TTL, and revalidated with ETag/Last-Modified after that.
+Once the cache grows past its size limit, the least recently used entries are evicted.
+"""
+class ApiCache:
+    """
+    Create a disabled cache, which is enabled through configure.
+    """
+    def __init__(self) -> None:
+        self.root: Optional[Path] = None
+        self.ttl = CACHE_TTL
+        self.max_bytes = CACHE_MAX_BYTES
+        self._lock = threading.Lock()
+        self._sizes: Dict[str, int] = {}
+        self._used: Dict[str, float] = {}
+        self._total = 0
+
+
+    """
+    Point the cache at a folder, or disable it.
+    - root: Folder to keep the responses in, or None to disable the cache.
+    - ttl: Number of seconds a response is used without revalidation.
+    - max_bytes: Maximum combined size of the cached responses.
+    """
+    def configure(self, root: Optional[Path], ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        with self._lock:
+            self.root, self.ttl, self.max_bytes = root, ttl, max_bytes
+            self._sizes, self._used, self._total = {}, {}, 0
+            if root is None:
+                return
+            try:
+                root.mkdir(parents=True, exist_ok=True)
+                for entry in os.scandir(root):
+                    if entry.name.endswith(ENTRY_SUFFIX):
+                        st = entry.stat()
+                        self._sizes[entry.name] = st.st_size
+                        self._used[entry.name] = st.st_mtime
+                        self._total += st.st_size
+            except OSError as e:
+                logger.warning(f'Disabling the API cache, {root} is not usable: {e}')
+                self.root = None
+                return
+            evicted = self._evict()
+        self._delete(evicted)
+        logger.debug(f'Loaded {len(self._sizes)} cached API responses ({self._total / 1024**2:.1f} MiB) from {root}')
+
+
+    """
+    Get the file name of the entry for a URL.
+    - url: URL of the request.
+    Returns the file name of the entry.
+    """
+    @staticmethod
+    def _name(url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest() + ENTRY_SUFFIX
+
+
+    """
+    Read the cached response of a URL.
+    - url: URL of the request.
+    Returns the entry, or None if the URL is not cached.
+    """
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        if self.root is None:
+            return None
+        name = self._name(url)
+        try:
+            with (self.root / name).open('rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.debug(f'Ignoring unreadable cache entry for {url}: {e}')
+            return None
+        if meta.get('url') != url:
+            return None
+        self._touch(name)
+        return CacheEntry(url, body, meta['stored'], meta.get('etag'), meta.get('last_modified'))
+
+
+    """
+    Store the response of a URL, evicting old entries if the cache is full.
+    - url: URL of the request.
+    - body: Body of the response.
+    - etag: ETag header of the response, if any.
+    - last_modified: Last-Modified header of the response, if any.
+    """
+    def store(self, url: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        if self.root is None:
+            return
+        name = self._name(url)
+        meta = { 'url': url, 'stored': time.time(), 'etag': etag, 'last_modified': last_modified }
+        path = self.root / name
+        tmp = path.with_suffix(f'.{threading.get_ident()}.tmp')
+        try:
+            with tmp.open('wb') as f:
+                f.write(json.dumps(meta).encode() + b'\n')
+                f.write(body)
+            size = tmp.stat().st_size
+            tmp.replace(path)
+        except OSError as e:
+            logger.warning(f'Failed to cache the response of {url}: {e}')
+            return
+
+        with self._lock:
+            self._total += size - self._sizes.get(name, 0)
+            self._sizes[name] = size
+            self._used[name] = time.time()
+            evicted = self._evict()
+        self._delete(evicted)
+
+
+    """
+    Mark a cached response as valid again after the server confirmed it is unchanged.
+    - entry: Entry that was revalidated.
+    """
+    def refresh(self, entry: CacheEntry) -> None:
+        self.store(entry.url, entry.body, entry.etag, entry.last_modified)
+
+
+    """
+    Mark an entry as recently used, so it is evicted last.
+    - name: File name of the entry.
+    """
+    def _touch(self, name: str) -> None:
+        now = time.time()
+        with self._lock:
+            if name in self._used:
+                self._used[name] = now
+        try:
+            os.utime(self.root / name, (now, now))
+        except OSError:
+            pass
+
+
+    """
+    Delete the files of evicted entries.
+    - names: File names of the entries.
+    """
+    def _delete(self, names: List[str]) -> None:
+        for name in names:
+            try:
+                (self.root / name).unlink()
+            except OSError:
+                pass
+        if names:
+            metrics.inc('api_cache_evictions_total', len(names))
+            logger.debug(f'Evicted {len(names)} cached API responses')
+
+
+    """
+    Forget the least recently used entries until the cache is under its size limit.
+    Must be called with the lock held.
+    Returns the file names of the evicted entries, to be deleted.
+    """
+    def _evict(self) -> List[str]:
+        if self._total <= self.max_bytes:
+            return []
+        evicted = []
+        for name in sorted(self._used, key=self._used.get):
+            if self._total <= self.max_bytes:
+                break
+            self._total -= self._sizes.pop(name)
+            del self._used[name]
+            evicted.append(name)
+        return evicted
+
+
+api_cache = ApiCache()
+
+
+"""
+Set up the shared API cache.
+- root: Folder to keep the responses in, or None to disable the cache.
+- ttl: Number of seconds a response is used without revalidation.
+- max_bytes: Maximum combined size of the cached responses.
+"""
+def configure_api_cache(root: Optional[Path], ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES) -> None:
+    api_cache.configure(root, ttl, max_bytes)
+    if root is not None:
+        logger.debug(f'Caching API responses in {root} for {ttl:.0f}s, up to {max_bytes / 1024**2:.0f} MiB')
@@ -0,0 +1,288 @@
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+from .metrics import metrics
+from .ratelimit import TokenBucket
+
+
+BURST_SECONDS = 0.5
+SCHEDULE_CHECK_INTERVAL = 10.0
+RATE_UNITS = { '': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3 }
+RATE_PATTERN = re.compile(r'(\d+(?:\.\d*)?)\s*([kmg]?)(?:i?b)?(?:/s)?', re.IGNORECASE)
+WINDOW_PATTERN = re.compile(r'(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)')
+MEDIA_HOST_PATTERN = re.compile(r'^n\d+\.')
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Bandwidth allowed during a daily window of local time
+"""
+@dataclass
+class ScheduleWindow:
+    start: int
+    end: int
+    rate: Optional[float]
+
+
+    """
+    Check if the window covers a time of day, windows ending before they start wrap past midnight.
+    - minute: Minutes since midnight.
+    Returns True if the time is within the window.
+    """
+    def covers(self, minute: int) -> bool:
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+"""
+Transfer of a single response, shaped by every limit that applies to it.
+Reserving is lock-free when no limit applies, so it may be called for every chunk.
+"""
+class Throttle:
+    """
+    Create a throttle over the buckets of a transfer.
+    - shaper: Shaper the global, scheduled limit is taken from.
+    - buckets: Buckets of the per-site and per-creator limits of the transfer.
+    """
+    def __init__(self, shaper: 'BandwidthShaper', buckets: List[TokenBucket]) -> None:
+        self.shaper = shaper
+        self.buckets = buckets
+        self.active = shaper.enabled
+
+
+    """
+    Get the tightest limit that currently applies to the transfer.
+    Returns the limit in bytes per second, or None if the transfer is not limited.
+    """
+    def rate(self) -> Optional[float]:
+        if not self.active:
+            return None
+        bucket = self.shaper.scheduled_bucket()
+        rates = [ b.rate for b in self.buckets + ([ bucket ] if bucket is not None else []) ]
+        return min(rates, default=None)
+
+
+    """
+    Cap a measured throughput to the limit of the transfer, to size its reads.
+    - rate: Measured throughput in bytes per second, if known.
+    Returns the lower of the throughput and the limit, or None if neither is known.
+    """
+    def cap(self, rate: Optional[float]) -> Optional[float]:
+        limit = self.rate()
+        if limit is None or (rate is not None and rate < limit):
+            return rate
+        return limit
+
+
+    """
+    Account for received bytes without blocking, for use from the event loop.
+    - size: Number of bytes received.
+    Returns the number of seconds to wait before reading more.
+    """
+    def reserve(self, size: int) -> float:
+        if not self.active:
+            return 0.0
+        wait = 0.0
+        bucket = self.shaper.scheduled_bucket()
+        if bucket is not None:
+            wait = bucket.reserve(size)
+        for b in self.buckets:
+            wait = max(wait, b.reserve(size))
+        if wait > 0:
+            metrics.inc('bandwidth_wait_seconds_total', wait)
+        return wait
+
+
+    """
+    Account for received bytes, sleeping if the transfer is over its limits.
+    - size: Number of bytes received.
+    """
+    def update(self, size: int) -> None:
+        wait = self.reserve(size)
+        if wait > 0:
+            time.sleep(wait)
+
+
+"""
+Limits on the bandwidth of media transfers, shared by every download.
+A global limit, which may change with the time of day, applies to all transfers at once,
+and optional per-site and per-creator limits are shared by the transfers of each. Every
+limit is a token bucket of bytes holding half a second of traffic, so transfers run at a
+steady rate rather than bursting.
+"""
+class BandwidthShaper:
+    """
+    Create a shaper without limits, which are set through configure.
+    """
+    def __init__(self) -> None:
+        self.rate: Optional[float] = None
+        self.host_rate: Optional[float] = None
+        self.creator_rate: Optional[float] = None
+        self.schedule: List[ScheduleWindow] = []
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._global: Optional[TokenBucket] = None
+        self._hosts: Dict[str, TokenBucket] = {}
+        self._creators: Dict[str, TokenBucket] = {}
+        self._checked = float('-inf')
+
+
+    """
+    Set the limits, starting every transfer over with full buckets.
+    - rate: Global limit in bytes per second, or None for no limit.
+    - host_rate: Limit per site in bytes per second, or None for no limit.
+    - creator_rate: Limit per creator in bytes per second, or None for no limit.
+    - schedule: Windows of the day with their own global limit, taking precedence over rate.
+    """
+    def configure( self
+                 , rate: Optional[float] = None
+                 , host_rate: Optional[float] = None
+                 , creator_rate: Optional[float] = None
+                 , schedule: Optional[List[ScheduleWindow]] = None ) -> None:
+        with self._lock:
+            self.rate, self.host_rate, self.creator_rate = rate, host_rate, creator_rate
+            self.schedule = schedule or []
+            self.enabled = any(r is not None for r in ( rate, host_rate, creator_rate )) or bool(self.schedule)
+            self._global = None
+            self._hosts.clear()
+            self._creators.clear()
+            self._checked = float('-inf')
+
+
+    """
+    Get the global limit at a time of day.
+    - minute: Minutes since local midnight, or None for now.
+    Returns the limit of the first window covering the time, else the global limit.
+    """
+    def current_rate(self, minute: Optional[int] = None) -> Optional[float]:
+        if minute is None:
+            now = time.localtime()
+            minute = now.tm_hour * 60 + now.tm_min
+        for window in self.schedule:
+            if window.covers(minute):
+                return window.rate
+        return self.rate
+
+
+    """
+    Get the bucket of the global limit, following the schedule every few seconds.
+    Returns the bucket, or None if there is currently no global limit.
+    """
+    def scheduled_bucket(self) -> Optional[TokenBucket]:
+        now = time.monotonic()
+        if now - self._checked < SCHEDULE_CHECK_INTERVAL:
+            return self._global
+        with self._lock:
+            if now - self._checked >= SCHEDULE_CHECK_INTERVAL:
+                rate = self.current_rate()
+                if rate is None:
+                    self._global = None
+                elif self._global is None:
+                    self._global = TokenBucket(rate, rate * BURST_SECONDS)
+                elif self._global.rate != rate:
+                    self._global.set_rate(rate, rate * BURST_SECONDS)
+                    logger.info(f'Bandwidth limit changed to {format_rate(rate)}')
+                self._checked = now
+            return self._global
+
+
+    """
+    Start shaping a transfer.
+    - url: URL of the media being transferred.
+    - creator: Creator the media belongs to, if known.
+    Returns the throttle to report the received bytes to.
+    """
+    def throttle(self, url: str, creator: Optional[str] = None) -> Throttle:
+        buckets = []
+        if self.host_rate is not None:
+            host = MEDIA_HOST_PATTERN.sub('', urlsplit(url).netloc)
+            buckets.append(self._bucket(self._hosts, host, self.host_rate))
+        if self.creator_rate is not None and creator is not None:
+            buckets.append(self._bucket(self._creators, creator, self.creator_rate))
+        return Throttle(self, buckets)
+
+
+    """
+    Get the bucket of a key, creating it full on first use.
+    - buckets: Buckets of every key.
+    - key: Site or creator.
+    - rate: Limit of the key in bytes per second.
+    Returns the bucket shared by the transfers of the key.
+    """
+    def _bucket(self, buckets: Dict[str, TokenBucket], key: str, rate: float) -> TokenBucket:
+        with self._lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = TokenBucket(rate, rate * BURST_SECONDS)
+            return bucket
+
+
+"""
+Parse a bandwidth such as "500K", "2M" or "1.5GiB/s", in bytes per second with binary units.
+- text: Bandwidth to parse.
+Returns the bandwidth in bytes per second, or None for "0" (no limit).
+"""
+def parse_rate(text: str) -> Optional[float]:
+    match = RATE_PATTERN.fullmatch(text.strip())
+    if match is None:
+        raise ValueError(f'Invalid bandwidth "{text}"')
+    rate = float(match.group(1)) * RATE_UNITS[match.group(2).lower()]
+    return rate if rate > 0 else None
+
+
+"""
+Parse a bandwidth schedule such as "08:00-18:00=1M,18:00-08:00=0".
+Each window gives the global bandwidth between two local times, 0 being no limit.
+- text: Comma-separated windows to parse.
+Returns the windows of the schedule, in the order given.
+"""
+def parse_schedule(text: str) -> List[ScheduleWindow]:
+    windows = []
+    for part in text.split(','):
+        match = WINDOW_PATTERN.fullmatch(part.strip())
+        if match is None:
+            raise ValueError(f'Invalid schedule window "{part.strip()}", expected HH:MM-HH:MM=RATE')
+        h1, m1, h2, m2 = ( int(g) for g in match.group(1, 2, 3, 4) )
+        if h1 > 23 or h2 > 23 or m1 > 59 or m2 > 59:
+            raise ValueError(f'Invalid time in schedule window "{part.strip()}"')
+        windows.append(ScheduleWindow(h1 * 60 + m1, h2 * 60 + m2, parse_rate(match.group(5))))
+    return windows
+
+
+"""
+Format a bandwidth for logging.
+- rate: Bandwidth in bytes per second, or None for no limit.
+Returns the bandwidth in MiB/s, or "unlimited".
+"""
+def format_rate(rate: Optional[float]) -> str:
+    if rate is None:
+        return 'unlimited'
+    return f'{rate / 1024**2:.2f} MiB/s'
+
+
+bandwidth_shaper = BandwidthShaper()
+
+
+"""
+Set the limits of the shared bandwidth shaper.
+- rate: Global limit in bytes per second, or None for no limit.
+- host_rate: Limit per site in bytes per second, or None for no limit.
+- creator_rate: Limit per creator in bytes per second, or None for no limit.
+- schedule: Windows of the day with their own global limit, taking precedence over rate.
+"""
+def configure_bandwidth( rate: Optional[float] = None
+                       , host_rate: Optional[float] = None
+                       , creator_rate: Optional[float] = None
+                       , schedule: Optional[List[ScheduleWindow]] = None ) -> None:
+    bandwidth_shaper.configure(rate, host_rate, creator_rate, schedule)
+    if bandwidth_shaper.enabled:
+        logger.info( f'Limiting media bandwidth to {format_rate(bandwidth_shaper.current_rate())} now'
+                     f'{" following the schedule" if schedule else ""}, '
+                     f'{format_rate(host_rate)} per site and {format_rate(creator_rate)} per creator' )
@@ -1,56 +1,81 @@
 import logging
 import re
-from pathlib import Path
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
 from sys import maxsize
-from typing import List, Optional, Tuple
-
-from .networking import ( api_fetch_post_multi, api_fetch_post_single
-                        , multithread_download, NamedUrl, IMG_EXTS, VID_EXTS )
-from .utils import base_url, compute_file_hashes, create_folder_tree, round_offsets, to_camel
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .aio import async_download
+from .apicache import CACHE_DIR_NAME, CACHE_MAX_BYTES, CACHE_TTL, configure_api_cache
+from .bandwidth import configure_bandwidth, ScheduleWindow
+from .hashindex import HashIndex
+from .journal import Journal
+from .metrics import metrics, serve_metrics
+from .networking import ( _destination, api_fetch_post_single, api_iter_post_pages
+                        , NamedUrl, IMG_EXTS, PROBE_WORKERS, SEGMENT_COUNT, SEGMENT_THRESHOLD, VID_EXTS )
+from .nodes import node_health
+from .plan import PlanWriter, read_plan
+from .ratelimit import API_RATE, configure_rate_limits
+from .scheduler import DownloadJob, Scheduler
+from .sessions import configure_session, log_connection_stats, pool_size
+from .store import configure_content_store, content_store
+from .urllist import DigestSet, UrlList
+from .utils import ( base_url, compute_file_hashes, create_folder_tree, file_ext, read_watermark
+                   , round_offsets, to_camel, Watermark, write_watermark )
 
 
 POSTS_PER_FETCH = 50
+PAGE_READ_AHEAD = 4
+TITLE_STRIP = re.compile(r'[^A-Za-z0-9\s]+')
+DATE_STRIP = str.maketrans('', '', '-:')
 
 logger = logging.getLogger(__name__)
 
 
 """
-Extract media URLs from a list of post JSONs
+Get the extensions that should be skipped.
+- skip_img: If images should be skipped.
+- skip_vid: If videos should be skipped.
+Returns the set of skipped extensions.
+"""
+def skipped_exts(skip_img: bool, skip_vid: bool) -> FrozenSet[str]:
+    return (IMG_EXTS if skip_img else frozenset()) | (VID_EXTS if skip_vid else frozenset())
+
+
+"""
+Extract media URLs from post JSONs, lazily as the posts arrive
 - base: Base URL that the media should be one
-- posts: List of post JSONs to parse
+- posts: Iterable of post JSONs to parse
 - skip_img: If images should be skipped
 - skip_vid: if videos should be skipped
-Returns a list of NamedUrl extracted from the posts
+Yields each NamedUrl extracted from the posts
 """
 def parse_posts_json( base: str
-                    , posts: List[dict]
+                    , posts: Iterable[dict]
                     , skip_img: bool
-                    , skip_vid: bool ) -> List[NamedUrl]:
-    named_urls = []
-    base = base.replace('https://', 'https://n1.')
+                    , skip_vid: bool ) -> Iterator[NamedUrl]:
+    data = base.replace('https://', 'https://n1.') + '/data/'
+    skipped = skipped_exts(skip_img, skip_vid)
     for post in posts:
-        title = to_camel(re.sub(r'[^A-Za-z0-9\s]+', '', post['title']))
-        datetime = re.sub('-|:', '', post['published'])
-        if 'path' in post['file']:
-            ext = post['file']['path'].split('.')[-1]
-            if skip_vid and ext in VID_EXTS:
-                continue
-            if skip_img and ext in IMG_EXTS:
+        # Every file of a post shares the same name prefix
+        prefix = None
+        post_id = post.get('id')
+        main = post.get('file') or {}
+        has_file = 'path' in main
+        files = [ main, *post['attachments'] ] if has_file else post['attachments']
+        for i, file in enumerate(files, 0 if has_file else 1):
+            # Same as file_ext, inlined as this runs for every file of every post
+            path = file['path']
+            ext = path.rpartition('.')[2]
+            if ext in skipped:
                 continue
-            name = f'{datetime}-{title}_0.{ext}'
-            url = f'{base}/data/{post["file"]["path"]}'
-            named_urls.append(NamedUrl(url, name))
-
-        for i, attachment in enumerate(post['attachments']):
-            ext = attachment['path'].split('.')[-1]
-            if skip_vid and ext in VID_EXTS:
-                continue
-            if skip_img and ext in IMG_EXTS:
-                continue
-            url = f'{base}/data/{attachment["path"]}'
-            name = f'{datetime}-{title}_{i+1}.{ext}'
-            named_urls.append(NamedUrl(url, name))
-    return named_urls
+            if prefix is None:
+                title = to_camel(TITLE_STRIP.sub('', post['title']))
+                prefix = f'{post["published"].translate(DATE_STRIP)}-{title}_'
+            yield NamedUrl(f'{data}{path}', f'{prefix}{i}.{ext}', post_id)
 
 
 
@@ -71,8 +96,7 @@ def process_prefetched( url: str
     name = url.split('/')[-1]
 
     # Ensure it shouldn't be skipped (for some reason)
-    ext = name.split('.')[-1]
-    if (ext in IMG_EXTS and skip_img) or (ext in VID_EXTS and skip_vid):
+    if file_ext(name) in skipped_exts(skip_img, skip_vid):
         return []
 
     # Create the NamedUrl
@@ -102,32 +126,33 @@ def process_post( url: str
 
     # Parse the media URLs from the post
     logger.info('Parsing media URLs from 1 post')
-    named_urls = parse_posts_json(base, post, skip_img, skip_vid)
+    named_urls = list(parse_posts_json(base, post, skip_img, skip_vid))
     logger.info(f'Found {len(named_urls)} media files to download')
 
     # Remove duplicates by finding multiple posts that show the same media
     # I imagine this can only happen by mistake of the uploader
-    seen = set()
-    unique_urls = []
-    for nu in named_urls:
-        if nu.url not in seen:
-            seen.add(nu.url)
-            unique_urls.append(nu)
-    return unique_urls
+    seen = DigestSet()
+    return [ nu for nu in named_urls if seen.add(nu.key()) ]
 
 
 """
 Process a page to get all media URLs.
+Pages are fetched ahead concurrently and parsed as they arrive, so the returned
+URLs can be downloaded while later pages are still being discovered.
 - url: Main URL of the page.
 - skip_img: If image downloads should be skipped.
 - skip_vid: If video downloads should be skipped.
 - offsets: Range of offsets to download.
-Returns a list of NamedUrl extracted from all posts belonging to the page.
+- since: Newest post of an earlier scrape, to stop at once it is reached.
+- newest: Filled in with the newest post that was found, if given.
+Yields each NamedUrl extracted from all posts belonging to the page.
 """
 def process_page( url: str
                 , skip_img: bool
                 , skip_vid: bool
-                , offsets: Tuple[Optional[int], Optional[int]] ) -> List[NamedUrl]:
+                , offsets: Tuple[Optional[int], Optional[int]]
+                , since: Optional[Watermark] = None
+                , newest: Optional[Watermark] = None ) -> Iterator[NamedUrl]:
     # Get the SLD and TLD of the URL
     base = base_url(url)
     segments = url.split('/')
@@ -137,133 +162,446 @@ def process_page( url: str
     # Round the offsets
     rounded_offsets = round_offsets(offsets, POSTS_PER_FETCH)
 
-    # Iterate through post ranges for the page
-    all_posts = []
-    offset = rounded_offsets[0]
-    while True:
-        logger.info(f'Fetching posts {offset + 1} - {offset + POSTS_PER_FETCH}')
-        curr_posts = api_fetch_post_multi(base, service, creator, offset)
-        all_posts += curr_posts
-        offset += POSTS_PER_FETCH
-        if len(curr_posts) % POSTS_PER_FETCH != 0 or len(curr_posts) == 0 or offset >= rounded_offsets[1]:
-            break
-    
-    # Prune to user-requested offsets
-    if rounded_offsets[0] != 0 and offsets[0] is not None:
-        skip_start = offsets[0] - rounded_offsets[0] - 1
-        all_posts = all_posts[skip_start:]
-    if rounded_offsets[1] != maxsize and offsets[1] is not None:
-        skip_end = rounded_offsets[1] - offsets[1]
-        all_posts = all_posts[:-skip_end]
-
-    # Parse the media URLs from each post
-    logger.info(f'Parsing media URLs from {len(all_posts)} posts')
-    named_urls = parse_posts_json(base, all_posts, skip_img, skip_vid)
-    logger.info(f'Found {len(named_urls)} media files to download')
-
-    # Remove duplicates by finding multiple posts that show the same media
-    seen = set()
-    unique_urls = []
-    for nu in named_urls:
-        if nu.url not in seen:
-            seen.add(nu.url)
-            unique_urls.append(nu)
-    return unique_urls
+    # Posts are kept by their zero-based position on the page
+    first = offsets[0] - 1 if offsets[0] is not None else 0
+    last = offsets[1] - 1 if offsets[1] is not None else maxsize
+
+    # Iterate through post ranges for the page, parsing each as it arrives
+    # When syncing, usually only the first page has new posts, so don't read ahead,
+    # and cached pages are checked with the server so that new posts are not missed
+    window = 1 if since is not None else PAGE_READ_AHEAD
+    pages = api_iter_post_pages( base, service, creator, rounded_offsets[0], rounded_offsets[1]
+                               , POSTS_PER_FETCH, window, since is not None )
+
+    # Walk the posts of each page as it arrives, pruning them on the fly
+    num_posts = 0
+    def walk_posts() -> Iterator[dict]:
+        nonlocal num_posts
+        for offset, curr_posts in pages:
+            if newest is not None and offset == 0 and first == 0 and curr_posts:
+                newest.id, newest.published = curr_posts[0].get('id'), curr_posts[0].get('published')
+
+            for i, post in enumerate(curr_posts, offset):
+                # Prune to user-requested offsets
+                if i < first or i > last:
+                    continue
+
+                # Stop at the first post that was already seen by an earlier scrape
+                # Posts published in the same second as it may be new, so only older posts stop the scrape
+                if since is not None:
+                    published = post.get('published')
+                    if post.get('id') == since.id or (published and since.published and published < since.published):
+                        logger.info('Reached posts that were already scraped')
+                        pages.close()
+                        return
+                num_posts += 1
+                yield post
+
+    # Remove duplicates by finding multiple posts that show the same media, keyed by its binary hash
+    seen = DigestSet()
+    num_urls = 0
+    for nu in parse_posts_json(base, walk_posts(), skip_img, skip_vid):
+        if seen.add(nu.key()):
+            num_urls += 1
+            yield nu
+
+    logger.info(f'Found {num_urls} media files in {num_posts} posts')
 
 
 """
 Remove duplicate URLs based on the SHA-256 hash of existing files.
 Note that since URLs are hashes, there should be no duplicates between posts.
+Existing files are hashed immediately, then URLs are filtered lazily as they arrive.
+With link_stored, files that the content store holds are linked into dst as they arrive
+too, so they never take up a download slot or a probe.
 - dst: Directory to check for existing files.
 - named_urls: URLs to remove duplicates from.
-Returns a possibily reduced list of URLs
+- index: Persistent hash index of dst, so only new or changed files are hashed.
+- hash_jobs: Number of threads to hash existing files with (0 for one per core).
+- link_stored: If files in the content store should be linked out instead of returned.
+Returns an iterator over the possibily reduced URLs
 """
-def purge_duplicate_urls(dst: Path, named_urls: List[NamedUrl]) -> List[NamedUrl]:
+def purge_duplicate_urls( dst: Path
+                        , named_urls: Iterable[NamedUrl]
+                        , index: Optional[HashIndex] = None
+                        , hash_jobs: int = 0
+                        , link_stored: bool = False ) -> Iterator[NamedUrl]:
     # Get the hashes of the existing files
-    hashes = compute_file_hashes(dst)
+    hashed: List[Tuple[Path, str]] = []
+    hashes = compute_file_hashes(dst, index, hash_jobs, lambda file, digest: hashed.append((file, digest)))
+
+    # Share the existing files with every other creator through the content store,
+    # all of them the first time and then only the ones that were not hashed before
+    if index is not None and content_store.root is not None:
+        shared = content_store.shared(dst)
+        for file, digest in (hashed if shared else index.items()):
+            content_store.add(file, digest)
+        if not shared:
+            content_store.mark_shared(dst)
+    link_stored = link_stored and content_store.root is not None
 
     # Remove duplicates by finding URLs that includ the hash
-    unique_urls = []
-    for nu in named_urls:
-        url_hash = nu.url.split('/')[-1].split('.')[0]
-        if url_hash not in hashes:
-            unique_urls.append(nu)
-        else:
-            logger.debug(f'Removing from download list based on hash: {url_hash}')
-    return unique_urls
+    digests = DigestSet(bytes.fromhex(digest) for digest in hashes)
+    def unique_urls() -> Iterator[NamedUrl]:
+        removed = 0
+        linked = 0
+        for nu in named_urls:
+            if nu.digest in digests:
+                removed += 1
+                logger.debug(f'Removing from download list based on hash: {nu.digest.hex()}')
+                continue
+            if link_stored and nu.digest is not None:
+                digest = nu.digest.hex()
+                if content_store.contains(digest):
+                    file = _destination(nu, dst / 'pics', dst / 'vids')
+                    file.parent.mkdir(parents=True, exist_ok=True)
+                    if content_store.link_out(digest, file):
+                        if index is not None:
+                            index.add(file, digest)
+                        linked += 1
+                        continue
+            yield nu
+        logger.info(f'Skipped {removed} media files that already exist')
+        if linked:
+            logger.info(f'Linked {linked} media files out of the content store')
+    return unique_urls()
 
 
 """
-Driver function to download media from Coomer or Kemono
+Queue the downloads of a saved plan, as one job per creator folder.
+Only the creator folder of each path is used: files go to its pics or vids folder
+under their name, like discovered URLs, which is where exported plans put them anyway.
+Files that already exist are skipped, like for discovered URLs.
+- plan: JSON lines plan to import.
+- dst: Download destination the paths of the plan are relative to.
+- scheduler: Scheduler to add the jobs to.
+- indexes: Hash indexes of the creator folders, shared with the discovered URLs.
+- skip_img: If image downloads should be skipped.
+- skip_vid: If video downloads should be skipped.
+- hash_jobs: Number of threads to hash existing files with (0 for one per core).
+Returns the number of jobs that were queued.
+"""
+def schedule_plan( plan: Path
+                 , dst: Path
+                 , scheduler: Scheduler
+                 , indexes: Dict[Path, HashIndex]
+                 , skip_img: bool
+                 , skip_vid: bool
+                 , hash_jobs: int = 0 ) -> int:
+    # Group the entries by the creator folder they go to
+    creators: Dict[str, UrlList] = {}
+    skipped = skipped_exts(skip_img, skip_vid)
+    moved = 0
+    for entry in read_plan(plan):
+        if file_ext(entry.url) in skipped:
+            continue
+        nu = entry.named_url()
+        user = PurePosixPath(entry.path).parts[0]
+        creators.setdefault(user, UrlList()).append(nu)
+        if _destination(nu, PurePosixPath(user, 'pics'), PurePosixPath(user, 'vids')) != PurePosixPath(entry.path):
+            moved += 1
+    logger.info(f'Imported {sum(len(urls) for urls in creators.values())} planned downloads for {len(creators)} creators')
+    if moved:
+        logger.warning(f'{moved} planned files go to the pics or vids folder of their creator instead of their path')
+
+    for user, named_urls in creators.items():
+        dst_root = dst / user
+        if dst_root not in indexes:
+            indexes[dst_root] = HashIndex(dst_root)
+        index = indexes[dst_root]
+        with metrics.timer(user, 'hash'):
+            named_urls = UrlList(purge_duplicate_urls(dst_root, named_urls, index, hash_jobs, True))
+        create_folder_tree(dst, user, skip_img, skip_vid)
+        host = re.sub(r'^n\d+\.', '', urlsplit(named_urls[0].url).netloc) if named_urls else ''
+        scheduler.add(DownloadJob(str(plan), host, user, named_urls, dst_root / 'pics', dst_root / 'vids', index))
+    return len(creators)
+
+
+"""
+Forget a downloaded job, remembering its newest post for the next sync.
+- url: Argument URL of the job.
+- journal: Journal of the creator folder.
+- dst_root: Creator folder.
+- watermark_key: Key of the page for its watermark, if it is a page.
+- newest: Newest post found while discovering the page, if any.
+"""
+def finish_job( url: str
+              , journal: Journal
+              , dst_root: Path
+              , watermark_key: Optional[str]
+              , newest: Optional[Watermark] ) -> None:
+    # Forget the job once everything is downloaded, so the next run looks for new posts
+    if journal.finish(url):
+        logger.debug(f'Removed completed job "{url}" from the journal')
+
+        # Remember the newest post so the next sync can stop there
+        if watermark_key is not None and newest is not None and newest.id is not None:
+            write_watermark(dst_root, watermark_key, newest)
+
+
+"""
+Options of a scrape, as given on the command line
 - urls: List of URLs to download from (page, post, or pre-fetched media)
 - dst: Download destination for the media (per-creator subfolders will be made)
 - skip_img: If image files should be skipped when downloading
 - skip_vid: If video files should be skipped whne downloading
 - offsets: Post offsets to start from and end at when downloading a page.
 - dump_urls: If URLs should be dumped instead of downloaded from.
-- jobs: Maximum number of threads to perform downloads, one thread per download.
+- jobs: Maximum number of concurrent downloads (one thread per download with the threads engine).
+- hash_jobs: Number of threads to hash existing files with (0 for one per core).
+- engine: Download engine to use ("threads" or "async").
+- segment_count: Number of parallel byte ranges for large videos (threads engine only).
+- segment_threshold: Size in bytes from which videos are split into ranges.
+- api_rate: Maximum API requests per second.
+- media_rate: Maximum media requests per second to each server, None to only limit servers that answer 429.
+- sync: If pages should only be scraped up to the newest post of the previous run.
+- creator_jobs: Maximum concurrent downloads per creator (0 for no limit, threads engine only).
+- host_jobs: Maximum concurrent downloads per site (0 for no limit, threads engine only).
+- show_progress: If progress bars should be drawn, otherwise progress is only logged.
+- zero_copy: If media should be read from the socket into reusable buffers (threads engine only).
+- metrics_port: Port to serve Prometheus metrics on while running, if any.
+- metrics_file: File to write a JSON summary of the metrics to at exit, if any.
+- api_cache_ttl: Number of seconds cached API responses are used without revalidation (0 to disable the cache).
+- api_cache_size: Maximum size in bytes of the API cache.
+- store: Content-addressed store to share media between creators through, if any.
+- export_plan: File to export the plan of every URL to instead of downloading, or "-" for stdout.
+- plan_format: Format of the exported plan ("jsonl" or "aria2").
+- import_plan: JSON lines plan to download along with the URLs, if any.
+- order: Policy to order the downloads of each job by (threads engine only).
+- bandwidth: Maximum media bytes per second over every download, if any.
+- host_bandwidth: Maximum media bytes per second per site, if any.
+- creator_bandwidth: Maximum media bytes per second per creator, if any.
+- bandwidth_schedule: Windows of the day with their own global bandwidth, taking precedence over bandwidth.
+- preflight: If every URL should be probed before downloading, to skip dead links and files on disk (threads engine only).
 """
-def main( urls: List[str]
-        , dst: Path
-        , skip_img: bool
-        , skip_vid: bool
-        , offsets: Tuple[Optional[int], Optional[int]]
-        , dump_urls: bool
-        , jobs: int) -> None:
+@dataclass
+class ScrapeConfig:
+    urls: List[str]
+    dst: Path
+    skip_img: bool = False
+    skip_vid: bool = False
+    offsets: Tuple[Optional[int], Optional[int]] = ( None, None )
+    dump_urls: bool = False
+    jobs: int = 4
+    hash_jobs: int = 0
+    engine: str = 'threads'
+    segment_count: int = SEGMENT_COUNT
+    segment_threshold: int = SEGMENT_THRESHOLD
+    api_rate: float = API_RATE
+    media_rate: Optional[float] = None
+    sync: bool = False
+    creator_jobs: int = 0
+    host_jobs: int = 0
+    show_progress: bool = True
+    zero_copy: bool = False
+    metrics_port: Optional[int] = None
+    metrics_file: Optional[Path] = None
+    api_cache_ttl: float = CACHE_TTL
+    api_cache_size: int = CACHE_MAX_BYTES
+    store: Optional[Path] = None
+    export_plan: Optional[str] = None
+    plan_format: str = 'jsonl'
+    import_plan: Optional[Path] = None
+    order: str = 'discovery'
+    bandwidth: Optional[float] = None
+    host_bandwidth: Optional[float] = None
+    creator_bandwidth: Optional[float] = None
+    bandwidth_schedule: Optional[List[ScheduleWindow]] = None
+    preflight: bool = False
+
+
+"""
+Driver function to download media from Coomer or Kemono
+- config: Options of the scrape.
+"""
+def main(config: ScrapeConfig) -> None:
+
+    # Exporting a plan only discovers, like dumping URLs
+    plan_writer = PlanWriter(config.export_plan, config.plan_format) if config.export_plan is not None else None
+    dump_urls = config.dump_urls or plan_writer is not None
+
+    # Expose the counters and timings while the scrape runs
+    metrics_server = serve_metrics(config.metrics_port) if config.metrics_port is not None else None
+
+    # Keep API and media traffic under the site's rate limits
+    configure_rate_limits(config.api_rate, config.media_rate)
+
+    # Shape media traffic to a steady bandwidth
+    configure_bandwidth(config.bandwidth, config.host_bandwidth, config.creator_bandwidth, config.bandwidth_schedule)
+
+    # Reuse API responses of earlier runs, revalidating them once they get old
+    cache_root = config.dst / CACHE_DIR_NAME if config.api_cache_ttl > 0 else None
+    configure_api_cache(cache_root, config.api_cache_ttl, config.api_cache_size)
+
+    # Link media that any creator already has instead of downloading it again
+    configure_content_store(config.store if not dump_urls else None)
+
+    # Share pooled keep-alive connections between the API and download threads. The pools are sized
+    # to the real concurrency, since connections beyond the pool size are closed instead of kept alive
+    sources = len(config.urls) + (config.import_plan is not None)
+    probing = config.preflight or config.order in ( 'smallest', 'mixed' )
+    segments = config.segment_count if config.engine == 'threads' else 1
+    configure_session(pool_size( config.jobs, segments, PROBE_WORKERS * sources if probing else 0
+                               , PAGE_READ_AHEAD * sources ))
+
+    # With the threads engine, every URL is planned first and then downloaded through one shared queue
+    scheduler = Scheduler(config.creator_jobs, config.host_jobs, config.order, preflight=config.preflight)
+    indexes: Dict[Path, HashIndex] = {}
+    journals: Dict[Path, Journal] = {}
+    scheduled = []
 
     # Loop through the URLs to get more URLs
-    for url in urls:
+    for url in config.urls:
         logger.info(f'Parsing argument-provided URL "{url}"')
 
         # Split the URL on the separator
         segments = url.split('/')
         if len(segments) < 4:
-            logger.error('The URL is malformed')
-            return
+            logger.error('The URL is malformed, skipping it')
+            continue
         user = None
+        watermark_key = None
 
-        # Fetch URLs to download media from a post
+        # Work out what kind of URL it is and who it belongs to
         if segments[-2] == 'post':
             logger.debug('URL is suspected to be a post')
-            if offsets[0] is not None or offsets[1] is not None:
+            if config.offsets[0] is not None or config.offsets[1] is not None:
                 logger.warning('Start and end offsets are ignored when downloading a post')
+            kind = 'post'
             user = segments[-3]
-            named_urls = process_post(url, skip_img, skip_vid)
-
-        # Fetch URLs to download media from pre-fetched media
         elif segments[-4] == 'data':
             logger.debug('URL is suspected to be pre-fetched media')
-            if offsets[0] is not None or offsets[1] is not None:
+            if config.offsets[0] is not None or config.offsets[1] is not None:
                 logger.warning('Start and end offsets are ignored when downloading pre-fetched media')
             logger.warning('Cannot determine username for pre-fetched media. Download will be in a folder named "unknown"')
+            kind = 'data'
             user = 'unknown'
-            named_urls = process_prefetched(url, skip_img, skip_vid)
-
-        # Fetch URLs to download media from a page
         else:
             logger.debug('URL is suspected to be a page')
+            kind = 'page'
             user = segments[-1]
-            named_urls = process_page(url, skip_img, skip_vid, offsets)
-
-        # Remove URLs of files that already exist
-        dst_root = dst / user
-        logger.info(f'Begin hashing files in {dst_root}')
-        named_urls = purge_duplicate_urls(dst_root, named_urls)
-        logger.info(f'New number of media files to download is {len(named_urls)}')
+            watermark_key = f'{segments[-3]}/{segments[-1]}'
+
+        # Jobs of the same creator share its hash index and journal
+        dst_root = config.dst / user
+        if dst_root not in indexes:
+            indexes[dst_root] = HashIndex(dst_root)
+            if not dump_urls:
+                journals[dst_root] = Journal(dst_root)
+        index = indexes[dst_root]
+        journal = journals.get(dst_root)
+
+        # When syncing, a page is only scraped up to the previous run's newest post
+        since = read_watermark(dst_root, watermark_key) if config.sync and kind == 'page' else None
+
+        # Resume an interrupted download straight from the journal, skipping discovery
+        # A plan is only resumed by a run that would have discovered the same posts
+        params = { 'skip_img': config.skip_img, 'skip_vid': config.skip_vid
+                 , 'offsets': list(config.offsets) if kind == 'page' else None
+                 , 'sync': config.sync and kind == 'page'
+                 , 'since': [ since.id, since.published ] if since is not None else None }
+        named_urls = journal.resume(url, params) if journal is not None else None
+        newest = None
+        if named_urls is not None:
+            logger.info(f'Resuming from the journal with {len(named_urls)} media files left to download')
 
-        # Conditionally dump the URLs and return
+        else:
+            started = time.monotonic()
+
+            # Fetch URLs to download media from a post
+            if kind == 'post':
+                named_urls = process_post(url, config.skip_img, config.skip_vid)
+
+            # Fetch URLs to download media from pre-fetched media
+            elif kind == 'data':
+                named_urls = process_prefetched(url, config.skip_img, config.skip_vid)
+
+            # Fetch URLs to download media from a page, stopping at the previous run's newest post when syncing
+            else:
+                if config.sync:
+                    if since is not None:
+                        logger.info(f'Syncing posts newer than post {since.id} ({since.published})')
+                    else:
+                        logger.info('No earlier scrape of this page was found, scraping every post')
+                if config.offsets == (None, None):
+                    newest = Watermark()
+                named_urls = process_page(url, config.skip_img, config.skip_vid, config.offsets, since, newest)
+            # Pages are discovered as they are downloaded, so they are timed as they are read
+            streamed = not isinstance(named_urls, Sequence)
+            if streamed:
+                named_urls = metrics.timed(user, 'discover', named_urls)
+            else:
+                metrics.add_span(user, 'discover', started)
+
+            # Remove URLs of files that already exist
+            logger.info(f'Begin hashing files in {dst_root}')
+            with metrics.timer(user, 'hash'):
+                named_urls = purge_duplicate_urls(dst_root, named_urls, index, config.hash_jobs, not dump_urls)
+
+            # Record the plan as it is discovered so an interruption can resume from it
+            if journal is not None:
+                named_urls = journal.record(url, params, named_urls)
+
+            # Known-length lists keep an accurate total in the progress bar, pages are streamed
+            if not streamed:
+                named_urls = UrlList(named_urls)
+
+        # Conditionally dump or export the URLs and move on
+        if plan_writer is not None:
+            for nu in named_urls:
+                plan_writer.write(nu, _destination(nu, PurePosixPath(user, 'pics'), PurePosixPath(user, 'vids')))
+            continue
         if dump_urls:
             for nu in named_urls:
                 print(f'{nu.name}\t{nu.url}') # Print is used here instead of logging for a better UX
-            return
+            continue
 
         # Create the folder tree for the download destination
-        create_folder_tree(dst, user, skip_img, skip_vid)
-
-        # Perform the downloads
+        create_folder_tree(config.dst, user, config.skip_img, config.skip_vid)
         dst_pics = dst_root / 'pics'
         dst_vids = dst_root / 'vids'
-        logger.info(f'Downloading to {dst / user}')
-        multithread_download(named_urls, dst_pics, dst_vids, workers=jobs)
 
-    return
\ No newline at end of file
+        # The async engine downloads each URL in turn
+        if config.engine == 'async':
+            logger.info(f'Downloading to {dst_root}')
+            with metrics.timer(user, 'download'):
+                async_download( named_urls, dst_pics, dst_vids, workers=config.jobs, index=index
+                              , on_complete=journal.complete, show_progress=config.show_progress, creator=user
+                              , on_dead=journal.dead )
+            finish_job(url, journal, dst_root, watermark_key, newest)
+        else:
+            logger.info(f'Queued downloads to {dst_root}')
+            host = urlsplit(url).netloc
+            job = DownloadJob(url, host, user, named_urls, dst_pics, dst_vids, index, journal.complete, journal.dead)
+            scheduler.add(job)
+            scheduled.append((job, journal, dst_root, watermark_key, newest))
+
+    # Saved plans are downloaded along with the discovered URLs
+    imported = 0
+    if config.import_plan is not None:
+        imported = schedule_plan( config.import_plan, config.dst, scheduler, indexes
+                                , config.skip_img, config.skip_vid, config.hash_jobs )
+
+    # Perform the downloads of every scheduled URL at once
+    if scheduled or imported:
+        scheduler.download( config.jobs, config.segment_count, config.segment_threshold
+                          , config.show_progress, config.zero_copy )
+        # Jobs that failed to be discovered are left in the journal to be discovered again
+        for job, *settle in scheduled:
+            if not job.failed:
+                finish_job(job.source, *settle)
+
+    if not dump_urls:
+        log_connection_stats()
+        node_health.log_summary()
+        metrics.log_phases()
+    for journal in journals.values():
+        journal.close()
+    if plan_writer is not None:
+        plan_writer.close()
+
+    # Keep a record of the run for later comparison
+    if config.metrics_file is not None:
+        metrics.write_summary(config.metrics_file)
+    if metrics_server is not None:
+        metrics_server.shutdown()
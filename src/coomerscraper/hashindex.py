@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+INDEX_NAME = '.hashindex.json'
+LOG_NAME = '.hashindex.log'
+INDEX_VERSION = 1
+FLUSH_EVERY = 64
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Persistent index of the SHA-256 hashes of files in a download folder.
+Entries are keyed by the path relative to the root and are only trusted while
+the size, modification time, and inode of the file are unchanged.
+Changes are appended to a log in batches as files are downloaded, so recording a file
+costs the same however large the index is. The log is folded back into the index file
+when it is saved, usually once at the end of a run.
+"""
+class HashIndex:
+    """
+    Load the index for a download folder, starting empty if none exists.
+    - root: Folder whose files are indexed (usually dst/<user>).
+    """
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.path = root / INDEX_NAME
+        self.log_path = root / LOG_NAME
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._entries: Dict[str, List] = {}
+        self._pending: List[str] = []
+        self._unsaved = 0
+        self._load()
+
+
+    """
+    Read the index from disk, discarding it if it is unreadable or outdated.
+    """
+    def _load(self) -> None:
+        if not self.path.exists():
+            self._replay()
+            return
+        try:
+            with self.path.open('r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != INDEX_VERSION:
+                logger.info(f'Discarding outdated hash index {self.path}')
+                return
+            self._entries = data['files']
+        except (OSError, ValueError, KeyError):
+            logger.warning(f'Hash index {self.path} is unreadable and will be rebuilt')
+            self._entries = {}
+        self._replay()
+        logger.debug(f'Loaded {len(self._entries)} entries from hash index {self.path}')
+
+
+    """
+    Apply the changes logged since the index was last saved.
+    A line cut short by an interruption ends the replay.
+    """
+    def _replay(self) -> None:
+        if not self.log_path.exists():
+            return
+        try:
+            with self.log_path.open('r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        key, *entry = json.loads(line)
+                    except (ValueError, TypeError):
+                        break
+                    if entry:
+                        self._entries[key] = entry
+                    else:
+                        self._entries.pop(key, None)
+                    self._unsaved += 1
+        except OSError as e:
+            logger.warning(f'Failed to read hash index log {self.log_path}: {e}')
+
+
+    """
+    Get the key used to store a file in the index.
+    - file: File to get the key of.
+    Returns the path of the file relative to the root, using forward slashes.
+    """
+    def _key(self, file: Path) -> str:
+        return file.relative_to(self.root).as_posix()
+
+
+    """
+    Get the cached hash of a file if it has not changed since it was indexed.
+    - file: File to look up.
+    - st: Result of stat() on the file.
+    Returns the hex digest of the file, or None if it must be hashed.
+    """
+    def lookup(self, file: Path, st: os.stat_result) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(self._key(file))
+        if entry is None:
+            return None
+        size, mtime_ns, ino, digest = entry
+        if size != st.st_size or mtime_ns != st.st_mtime_ns or ino != st.st_ino:
+            return None
+        return digest
+
+
+    """
+    Store the hash of a file in the index.
+    - file: File that was hashed.
+    - digest: Hex digest of the file.
+    - st: Result of stat() on the file, or None to stat it now.
+    """
+    def add(self, file: Path, digest: str, st: Optional[os.stat_result] = None) -> None:
+        if st is None:
+            st = file.stat()
+        key = self._key(file)
+        entry = [ st.st_size, st.st_mtime_ns, st.st_ino, digest ]
+        with self._lock:
+            self._entries[key] = entry
+            self._pending.append(json.dumps([ key, *entry ], separators=(',', ':')))
+            self._unsaved += 1
+            flush = len(self._pending) >= FLUSH_EVERY
+        if flush:
+            self.flush()
+
+
+    """
+    Get every indexed file along with its hash.
+    Returns a list of the files and their hex digests.
+    """
+    def items(self) -> List[Tuple[Path, str]]:
+        with self._lock:
+            return [ (self.root / key, entry[3]) for key, entry in self._entries.items() ]
+
+
+    """
+    Drop entries for files that no longer exist.
+    - files: Every file that currently exists under the root.
+    """
+    def prune(self, files: Iterable[Path]) -> None:
+        keep = set(self._key(f) for f in files)
+        with self._lock:
+            stale = [ k for k in self._entries if k not in keep ]
+            for k in stale:
+                del self._entries[k]
+                self._pending.append(json.dumps([ k ]))
+            if stale:
+                self._unsaved += len(stale)
+                logger.debug(f'Pruned {len(stale)} stale entries from hash index')
+
+
+    """
+    Append the changes made since the last flush to the log.
+    """
+    def flush(self) -> None:
+        with self._save_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+            if not lines:
+                return
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                with self.log_path.open('a', encoding='utf-8') as f:
+                    f.write('\n'.join(lines) + '\n')
+            except OSError as e:
+                logger.warning(f'Failed to append to hash index log {self.log_path}: {e}')
+
+
+    """
+    Write the whole index to disk if it has changed since it was loaded or saved,
+    folding in and removing the log.
+    """
+    def save(self) -> None:
+        with self._save_lock:
+            with self._lock:
+                if self._unsaved == 0:
+                    return
+                data = { 'version': INDEX_VERSION, 'files': dict(self._entries) }
+                lines, self._pending = self._pending, []
+                self._unsaved = 0
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+                with tmp.open('w', encoding='utf-8') as f:
+                    json.dump(data, f, separators=(',', ':'))
+                tmp.replace(self.path)
+                self.log_path.unlink(missing_ok=True)
+            except OSError as e:
+                # Keep the changes in the log instead
+                logger.warning(f'Failed to save hash index {self.path}: {e}')
+                with self._lock:
+                    self._pending = lines + self._pending
+                    self._unsaved += len(lines) or 1
@@ -0,0 +1,199 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from .networking import NamedUrl
+from .urllist import UrlList
+
+
+JOURNAL_NAME = '.journal.sqlite'
+COMMIT_EVERY = 500
+COMMIT_INTERVAL = 2.0
+MAX_RESUMES = 3
+PENDING = 0
+DOWNLOADED = 1
+DEAD = 2
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    source     TEXT PRIMARY KEY,
+    params     TEXT NOT NULL,
+    discovered INTEGER NOT NULL DEFAULT 0,
+    started    REAL NOT NULL,
+    resumes    INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS plan (
+    source TEXT NOT NULL,
+    seq    INTEGER NOT NULL,
+    url    TEXT NOT NULL,
+    name   TEXT NOT NULL,
+    post   TEXT,
+    done   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (source, url)
+);
+CREATE INDEX IF NOT EXISTS plan_url ON plan (url);
+'''
+
+
+"""
+Persistent journal of the scrape jobs for a single creator folder.
+For every argument URL it records the planned NamedUrls (and the posts they came
+from) as they are discovered, and marks each one as completed once downloaded.
+A run that was interrupted can then resume from the plan without repeating the
+API pagination, hashing, and parsing. Files that the servers do not have are marked
+as dead, so they do not hold their job back. Jobs are removed once every file is
+downloaded or dead, so the next run discovers new posts again. A job that is still
+not done after MAX_RESUMES resumes is discovered again, and planned files that are no
+longer found are then given up on.
+Completed and dead files are committed in batches, at least every COMMIT_INTERVAL seconds,
+so an interruption only forgets the last few of them, which are then downloaded again.
+"""
+class Journal:
+    """
+    Open (or create) the journal of a creator folder.
+    - root: Creator folder (usually dst/<user>).
+    """
+    def __init__(self, root: Path) -> None:
+        root.mkdir(parents=True, exist_ok=True)
+        self.path = root / JOURNAL_NAME
+        self._lock = threading.Lock()
+        self._marked = 0
+        self._committed = time.monotonic()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        # Journals written before resumes were counted lack the column
+        columns = [ row[1] for row in self._db.execute('PRAGMA table_info(jobs)') ]
+        if 'resumes' not in columns:
+            self._db.execute('ALTER TABLE jobs ADD COLUMN resumes INTEGER NOT NULL DEFAULT 0')
+        self._db.commit()
+
+
+    """
+    Get the planned URLs left to download for an interrupted job.
+    - source: Argument URL of the job.
+    - params: Parameters that affect discovery (skips, offsets, ...).
+    Returns the remaining NamedUrls in plan order, or None if the job must be discovered again,
+    which is also the case once it has been resumed MAX_RESUMES times.
+    """
+    def resume(self, source: str, params: dict) -> Optional[UrlList]:
+        with self._lock:
+            row = self._db.execute( 'SELECT params, discovered, resumes FROM jobs WHERE source = ?'
+                                  , (source,) ).fetchone()
+            if row is None or row[1] == 0 or json.loads(row[0]) != params:
+                return None
+            if row[2] >= MAX_RESUMES:
+                logger.info(f'{source} is still not done after {row[2]} resumes, discovering it again')
+                return None
+            self._db.execute('UPDATE jobs SET resumes = resumes + 1 WHERE source = ?', (source,))
+            self._db.commit()
+            rows = self._db.execute( 'SELECT url, name, post FROM plan WHERE source = ? AND done = ? ORDER BY seq'
+                                   , (source, PENDING) ).fetchall()
+        return UrlList(NamedUrl(url, name, post) for url, name, post in rows)
+
+
+    """
+    Record the plan of a job as it is discovered, passing every URL through.
+    Once the stream is exhausted the job is marked as fully discovered.
+    - source: Argument URL of the job.
+    - params: Parameters that affect discovery (skips, offsets, ...).
+    - named_urls: Planned URLs, in download order.
+    Yields each of named_urls.
+    """
+    def record(self, source: str, params: dict, named_urls: Iterable[NamedUrl]) -> Iterator[NamedUrl]:
+        # Completed URLs of an earlier, interrupted discovery stay completed. Pending URLs
+        # are given up on unless they are discovered again.
+        with self._lock:
+            row = self._db.execute('SELECT params FROM jobs WHERE source = ?', (source,)).fetchone()
+            if row is not None and json.loads(row[0]) != params:
+                self._db.execute('DELETE FROM plan WHERE source = ?', (source,))
+            self._db.execute('UPDATE plan SET done = ? WHERE source = ? AND done = ?', (DEAD, source, PENDING))
+            self._db.execute( 'INSERT OR REPLACE INTO jobs (source, params, discovered, started, resumes) '
+                              'VALUES (?, ?, 0, ?, 0)'
+                            , (source, json.dumps(params), time.time()) )
+            self._db.commit()
+
+        for seq, nu in enumerate(named_urls):
+            with self._lock:
+                self._db.execute( 'INSERT INTO plan (source, seq, url, name, post) VALUES (?, ?, ?, ?, ?) '
+                                  'ON CONFLICT (source, url) DO UPDATE SET seq = excluded.seq, '
+                                  'done = CASE WHEN done = ? THEN ? ELSE ? END'
+                                , (source, seq, nu.url, nu.name, nu.post, DOWNLOADED, DOWNLOADED, PENDING) )
+                if seq % COMMIT_EVERY == 0:
+                    self._db.commit()
+            yield nu
+
+        with self._lock:
+            self._db.execute('UPDATE jobs SET discovered = 1 WHERE source = ?', (source,))
+            self._db.commit()
+
+
+    """
+    Mark a planned URL as downloaded.
+    - url: NamedUrl that finished downloading.
+    """
+    def complete(self, url: NamedUrl) -> None:
+        self._mark(url, DOWNLOADED)
+
+
+    """
+    Mark a planned URL as dead, since the servers do not have the file.
+    - url: NamedUrl that cannot be downloaded.
+    """
+    def dead(self, url: NamedUrl) -> None:
+        self._mark(url, DEAD)
+
+
+    """
+    Set the state of a planned URL, committing once a batch of them has been marked.
+    - url: NamedUrl to mark.
+    - state: New state of the URL.
+    """
+    def _mark(self, url: NamedUrl, state: int) -> None:
+        with self._lock:
+            self._db.execute('UPDATE plan SET done = ? WHERE url = ?', (state, url.url))
+            self._marked += 1
+            if self._marked >= COMMIT_EVERY or time.monotonic() - self._committed >= COMMIT_INTERVAL:
+                self._commit()
+
+
+    """
+    Commit the marked URLs, with the lock held.
+    """
+    def _commit(self) -> None:
+        self._db.commit()
+        self._marked = 0
+        self._committed = time.monotonic()
+
+
+    """
+    Remove a job whose plan has been fully downloaded, apart from dead files.
+    - source: Argument URL of the job.
+    Returns True if the job was removed, or False if some URLs are still left.
+    """
+    def finish(self, source: str) -> bool:
+        with self._lock:
+            row = self._db.execute( 'SELECT discovered, (SELECT COUNT(*) FROM plan WHERE source = ? AND done = ?) '
+                                    'FROM jobs WHERE source = ?', (source, PENDING, source) ).fetchone()
+            if row is None or row[0] == 0 or row[1] > 0:
+                return False
+            self._db.execute('DELETE FROM plan WHERE source = ?', (source,))
+            self._db.execute('DELETE FROM jobs WHERE source = ?', (source,))
+            self._commit()
+            return True
+
+
+    """
+    Close the journal.
+    """
+    def close(self) -> None:
+        with self._lock:
+            self._commit()
+            self._db.close()
@@ -0,0 +1,297 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+
+METRIC_PREFIX = 'coomerscraper_'
+BUCKETS = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0 )
+
+logger = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+T = TypeVar('T')
+
+
+"""
+Cumulative distribution of observed values, with Prometheus-style buckets
+"""
+@dataclass
+class _Histogram:
+    counts: List[int] = field(default_factory=lambda: [ 0 ] * (len(BUCKETS) + 1))
+    total: float = 0.0
+    count: int = 0
+    max: float = 0.0
+
+
+"""
+Counters, histograms, and per-creator phase timings of a scrape.
+Phases are timed as wall-clock spans, from their first start to their last end, so
+work that overlaps (e.g. concurrent downloads of a creator) is not counted twice.
+Every method is thread-safe and cheap, so instrumentation may be called from the
+download threads. Values are read through a Prometheus-style text exposition or a
+JSON summary.
+"""
+class Metrics:
+    """
+    Start with no values.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._phases: Dict[str, Dict[str, List[float]]] = {}
+        self._start = time.time()
+
+
+    """
+    Forget every value, starting the uptime over.
+    """
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._phases.clear()
+            self._start = time.time()
+
+
+    """
+    Add to a counter.
+    - name: Name of the counter.
+    - value: Amount to add.
+    - labels: Labels of the series to add to.
+    """
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+
+    """
+    Record a value in a histogram.
+    - name: Name of the histogram.
+    - value: Observed value, usually in seconds.
+    - labels: Labels of the series to record in.
+    """
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            hist = self._histograms.setdefault(name, {}).get(key)
+            if hist is None:
+                hist = self._histograms[name][key] = _Histogram()
+            hist.counts[bisect_left(BUCKETS, value)] += 1
+            hist.total += value
+            hist.count += 1
+            hist.max = max(hist.max, value)
+
+
+    """
+    Add a span of time spent in a phase of a creator's scrape, widening the span of the phase.
+    - creator: Creator the time was spent on.
+    - phase: Name of the phase (discover, hash, download, ...).
+    - start: Monotonic time the span started at.
+    - end: Monotonic time the span ended at, now if None.
+    """
+    def add_span(self, creator: str, phase: str, start: float, end: Optional[float] = None) -> None:
+        end = time.monotonic() if end is None else end
+        with self._lock:
+            phases = self._phases.setdefault(creator, {})
+            span = phases.get(phase)
+            if span is None:
+                phases[phase] = [ start, end ]
+            else:
+                span[0], span[1] = min(span[0], start), max(span[1], end)
+
+
+    """
+    Time a block of code as a phase of a creator's scrape.
+    - creator: Creator the time is spent on.
+    - phase: Name of the phase.
+    """
+    @contextmanager
+    def timer(self, creator: str, phase: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_span(creator, phase, start)
+
+
+    """
+    Time the iteration of a lazy iterable as a phase of a creator's scrape.
+    - creator: Creator the time is spent on.
+    - phase: Name of the phase.
+    - items: Iterable to time.
+    Yields each of items.
+    """
+    def timed(self, creator: str, phase: str, items: Iterable[T]) -> Iterator[T]:
+        items = iter(items)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add_span(creator, phase, start)
+                return
+            self.add_span(creator, phase, start)
+            yield item
+
+
+    """
+    Get the time spent in each phase of every creator.
+    Must be called with the lock held.
+    Returns the seconds of each phase, by creator.
+    """
+    def _phase_seconds(self) -> Dict[str, Dict[str, float]]:
+        return { creator: { phase: end - start for phase, (start, end) in p.items() }
+                 for creator, p in self._phases.items() }
+
+
+    """
+    Render every metric in the Prometheus text exposition format.
+    Returns the exposition text.
+    """
+    def prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f'# TYPE {METRIC_PREFIX}{name} counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{METRIC_PREFIX}{name}{_format_labels(key)} {_format_value(value)}')
+
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f'# TYPE {METRIC_PREFIX}{name} histogram')
+                for key, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ( float('inf'), ), hist.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                        lines.append(f'{METRIC_PREFIX}{name}_bucket{_format_labels(key + (("le", le),))} {cumulative}')
+                    lines.append(f'{METRIC_PREFIX}{name}_sum{_format_labels(key)} {_format_value(hist.total)}')
+                    lines.append(f'{METRIC_PREFIX}{name}_count{_format_labels(key)} {hist.count}')
+
+            lines.append(f'# TYPE {METRIC_PREFIX}phase_seconds_total counter')
+            for creator, phases in sorted(self._phase_seconds().items()):
+                for phase, seconds in sorted(phases.items()):
+                    labels = (('creator', creator), ('phase', phase))
+                    lines.append(f'{METRIC_PREFIX}phase_seconds_total{_format_labels(labels)} {_format_value(seconds)}')
+        return '\n'.join(lines) + '\n'
+
+
+    """
+    Summarize every metric as plain data.
+    Returns a JSON-serializable dictionary.
+    """
+    def summary(self) -> dict:
+        with self._lock:
+            counters = { name: { _label_text(key): value for key, value in series.items() }
+                         for name, series in self._counters.items() }
+            histograms = { name: { _label_text(key): { 'count': hist.count, 'sum': round(hist.total, 6)
+                                                     , 'mean': round(hist.total / hist.count, 6) if hist.count else 0.0
+                                                     , 'max': round(hist.max, 6) }
+                                   for key, hist in series.items() }
+                           for name, series in self._histograms.items() }
+            phases = { creator: { phase: round(seconds, 3) for phase, seconds in p.items() }
+                       for creator, p in self._phase_seconds().items() }
+        return { 'started': self._start, 'elapsed': round(time.time() - self._start, 3)
+               , 'counters': counters, 'histograms': histograms, 'phases': phases }
+
+
+    """
+    Write the JSON summary to a file.
+    - path: File to write.
+    """
+    def write_summary(self, path: Path) -> None:
+        with path.open('w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+        logger.info(f'Wrote metrics summary to {path}')
+
+
+    """
+    Log the time spent in each phase of every creator.
+    """
+    def log_phases(self) -> None:
+        with self._lock:
+            phases = self._phase_seconds()
+        for creator, p in sorted(phases.items()):
+            timings = ', '.join(f'{phase} {seconds:.1f}s' for phase, seconds in sorted(p.items()))
+            logger.info(f'Time spent on {creator}: {timings}')
+
+
+"""
+Format labels for the Prometheus exposition.
+- labels: Sorted label pairs.
+Returns the label set in braces, or an empty string if there are no labels.
+"""
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+"""
+Escape a label value for the Prometheus exposition.
+- value: Label value.
+Returns the escaped value.
+"""
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+"""
+Format a sample value for the Prometheus exposition.
+- value: Sample value.
+Returns whole numbers without a fraction or exponent, and other values at full precision.
+"""
+def _format_value(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+"""
+Format labels as a key for the JSON summary.
+- labels: Sorted label pairs.
+Returns the labels as "key=value,..." or "" if there are none.
+"""
+def _label_text(labels: Labels) -> str:
+    return ','.join(f'{key}={value}' for key, value in labels)
+
+
+metrics = Metrics()
+
+
+"""
+Serve the shared metrics at /metrics on a background thread.
+- port: Port to listen on, on localhost.
+Returns the server, to shut down once the scrape is over.
+"""
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split('?')[0] not in ( '/metrics', '/' ):
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics')
+    return server
@@ -0,0 +1,340 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+
+SERVICE = 'onlyfans'
+POSTS_PER_PAGE = 50
+WRITE_CHUNK = 64 * 1024
+
+PAGE_RE = re.compile(r'^/api/v1/([^/]+)/user/([^/]+)/posts$')
+POST_RE = re.compile(r'^/api/v1/([^/]+)/user/([^/]+)/post/([^/]+)$')
+DATA_RE = re.compile(r'^/data/+(?:[0-9a-f]{2}/[0-9a-f]{2}/)?([0-9a-f]{64})\.\w+$')
+
+
+"""
+Local stand-in for the Coomer/Kemono API and media servers.
+Creators, posts, and media are generated from a seed, so every run serves the same
+files, and every media URL holds the SHA-256 hash of its content like the real site.
+Faults can be injected to see how the scraper copes with a slow or unreliable site.
+"""
+class MockSite:
+    """
+    Generate the posts and media of the site.
+    - creators: Number of creators, named creator0, creator1, ...
+    - posts: Number of posts per creator.
+    - attachments: Number of attachments per post, besides its main file.
+    - min_size: Smallest media file, in bytes.
+    - max_size: Largest media file, in bytes.
+    - video_ratio: Fraction of media files that are videos.
+    - video_scale: How many times larger videos are than images.
+    - latency: Delay before every response, in seconds.
+    - bandwidth: Maximum bytes per second sent on each connection (0 for no limit).
+    - throttle_rate: Fraction of requests answered with 429 Too Many Requests.
+    - drop_rate: Fraction of media responses whose connection is dropped midway.
+    - dead_ratio: Fraction of media files that are listed in posts but missing from the servers.
+    - ignore_ranges: If Range requests are answered with the whole file, although byte ranges are advertised.
+    - seed: Seed for the generated content and the injected faults.
+    """
+    def __init__( self
+                , creators: int = 2
+                , posts: int = 100
+                , attachments: int = 1
+                , min_size: int = 64 * 1024
+                , max_size: int = 1024 * 1024
+                , video_ratio: float = 0.1
+                , video_scale: int = 1
+                , latency: float = 0.0
+                , bandwidth: int = 0
+                , throttle_rate: float = 0.0
+                , drop_rate: float = 0.0
+                , dead_ratio: float = 0.0
+                , ignore_ranges: bool = False
+                , seed: int = 0 ) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.drop_rate = drop_rate
+        self.ignore_ranges = ignore_ranges
+        self.media: Dict[str, bytes] = {}
+        self.posts: Dict[str, List[dict]] = {}
+        self.stats = { 'api': 0, 'media': 0, 'throttled': 0, 'dropped': 0, 'revalidated': 0, 'bytes': 0 }
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+        # Build every creator's posts from newest to oldest, like the API lists them
+        rng = random.Random(seed)
+        for c in range(creators):
+            creator = f'creator{c}'
+            feed = []
+            for p in range(posts):
+                files = []
+                for _ in range(attachments + 1):
+                    ext = 'mp4' if rng.random() < video_ratio else 'jpg'
+                    scale = video_scale if ext == 'mp4' else 1
+                    data = rng.randbytes(rng.randint(min_size, max_size) * scale)
+                    digest = hashlib.sha256(data).hexdigest()
+                    if dead_ratio <= 0 or rng.random() >= dead_ratio:
+                        self.media[digest] = data
+                    files.append({ 'name': f'{digest}.{ext}', 'path': f'/{digest[:2]}/{digest[2:4]}/{digest}.{ext}' })
+                published = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(1700000000 - p * 3600 - c))
+                feed.append({ 'id': str(1000000 * (c + 1) - p), 'user': creator, 'service': SERVICE
+                            , 'title': f'Post {p} by {creator}', 'published': published
+                            , 'file': files[0], 'attachments': files[1:] })
+            self.posts[creator] = feed
+
+
+    """
+    Get the page URL of every creator, as it would be passed to the scraper.
+    - host: Host name the scraper should see.
+    Returns the list of page URLs.
+    """
+    def page_urls(self, host: str = 'coomer.st') -> List[str]:
+        return [ f'https://{host}/{SERVICE}/user/{creator}' for creator in self.posts ]
+
+
+    """
+    Get the total number and size of the media files.
+    Returns the number of files and their combined size in bytes.
+    """
+    def media_totals(self) -> Tuple[int, int]:
+        return len(self.media), sum(len(data) for data in self.media.values())
+
+
+    """
+    Decide if a fault should be injected, using the shared seeded generator.
+    - rate: Probability of the fault.
+    Returns True if the fault should happen.
+    """
+    def roll(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+
+    """
+    Add to one of the request counters.
+    - key: Counter to add to.
+    - n: Amount to add.
+    """
+    def count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += n
+
+
+    """
+    Start serving on a background thread.
+    - port: Port to listen on (0 for any free port).
+    Returns the port the server listens on.
+    """
+    def start(self, port: int = 0) -> int:
+        handler = type('Handler', (_Handler,), { 'site': self })
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[1]
+
+
+    """
+    Stop serving.
+    """
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+    """
+    Get the port the site is served on, None if it is not running.
+    """
+    @property
+    def port(self) -> Optional[int]:
+        return self._server.server_address[1] if self._server is not None else None
+
+
+"""
+Request handler for a MockSite, which is set as a class attribute by MockSite.start
+"""
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    site: MockSite
+
+
+    """
+    Send a complete response with a body.
+    - status: HTTP status code.
+    - body: Response body.
+    - headers: Extra headers to send.
+    """
+    def _reply(self, status: int, body: bytes = b'', headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+    """
+    Send a JSON response, or 304 Not Modified if the client already holds it.
+    - obj: Object to encode.
+    """
+    def _json(self, obj: object) -> None:
+        body = json.dumps(obj).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.site.count('revalidated')
+            self._reply(304, headers={ 'ETag': etag })
+            return
+        self._reply(200, body, { 'Content-Type': 'application/json', 'ETag': etag })
+
+
+    """
+    Serve the API and media endpoints, injecting faults along the way.
+    """
+    def do_GET(self) -> None:
+        site = self.site
+        if site.latency > 0:
+            time.sleep(site.latency)
+        if site.roll(site.throttle_rate):
+            site.count('throttled')
+            self._reply(429, b'Too Many Requests', { 'Retry-After': '1' })
+            return
+
+        path, _, query = self.path.partition('?')
+        match = PAGE_RE.match(path)
+        if match is not None:
+            site.count('api')
+            params = dict(p.split('=', 1) for p in query.split('&') if '=' in p)
+            offset = int(params.get('o', 0))
+            self._json(site.posts.get(match.group(2), [])[offset:offset + POSTS_PER_PAGE])
+            return
+
+        match = POST_RE.match(path)
+        if match is not None:
+            site.count('api')
+            for post in site.posts.get(match.group(2), []):
+                if post['id'] == match.group(3):
+                    self._json({ 'post': post })
+                    return
+            self._reply(404)
+            return
+
+        match = DATA_RE.match(path)
+        if match is not None and match.group(1) in site.media:
+            site.count('media')
+            self._media(site.media[match.group(1)])
+            return
+        self._reply(404)
+
+
+    """
+    Send a media file, honouring Range requests and the bandwidth limit.
+    - data: Content of the file.
+    """
+    def _media(self, data: bytes) -> None:
+        site = self.site
+        start, end = 0, len(data) - 1
+        header = self.headers.get('Range')
+        if header is not None and header.startswith('bytes=') and not site.ignore_ranges:
+            first, _, last = header[6:].partition('-')
+            start = int(first) if first else 0
+            end = min(int(last), len(data) - 1) if last else len(data) - 1
+            if start >= len(data):
+                self._reply(416, headers={ 'Content-Range': f'bytes */{len(data)}' })
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        # Drop the connection halfway through if requested
+        stop = end + 1
+        dropped = site.roll(site.drop_rate)
+        if dropped:
+            stop = start + (end - start + 1) // 2
+
+        try:
+            pos = start
+            began = time.monotonic()
+            while pos < stop:
+                chunk = data[pos:min(pos + WRITE_CHUNK, stop)]
+                self.wfile.write(chunk)
+                pos += len(chunk)
+                site.count('bytes', len(chunk))
+                if site.bandwidth > 0:
+                    ahead = (pos - start) / site.bandwidth - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+        if dropped:
+            site.count('dropped')
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+
+
+    """
+    Answer HEAD requests like GET requests, without the body.
+    """
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Coomer/Kemono API and media')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on, 0 for any (default: 8080)')
+    parser.add_argument('--creators', type=int, default=2, help='number of creators (default: 2)')
+    parser.add_argument('--posts', type=int, default=100, help='posts per creator (default: 100)')
+    parser.add_argument('--attachments', type=int, default=1, help='attachments per post (default: 1)')
+    parser.add_argument('--min-size', type=int, default=64, help='smallest media file in KiB (default: 64)')
+    parser.add_argument('--max-size', type=int, default=1024, help='largest media file in KiB (default: 1024)')
+    parser.add_argument('--video-scale', type=int, default=1, help='how many times larger videos are than images (default: 1)')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay before every response in ms (default: 0)')
+    parser.add_argument('--bandwidth', type=int, default=0, help='KiB/s per connection, 0 for no limit (default: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with 429 (default: 0)')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of media responses dropped midway (default: 0)')
+    parser.add_argument('--dead-ratio', type=float, default=0.0, help='fraction of listed media missing from the servers (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the content and faults (default: 0)')
+    args = parser.parse_args()
+
+    site = MockSite( args.creators, args.posts, args.attachments, args.min_size * 1024, args.max_size * 1024
+                   , video_scale=args.video_scale, latency=args.latency / 1000, bandwidth=args.bandwidth * 1024
+                   , throttle_rate=args.throttle_rate, drop_rate=args.drop_rate, dead_ratio=args.dead_ratio, seed=args.seed )
+    port = site.start(args.port)
+    files, size = site.media_totals()
+    print(f'Serving {files} media files ({size / 1024**2:.1f} MiB) on port {port}', flush=True)
+    for url in site.page_urls():
+        print(url, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        site.stop()
+
+
+if __name__ == '__main__':
+    main()
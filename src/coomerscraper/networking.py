@@ -1,100 +1,755 @@
+import hashlib
+import http.client
+import json
 import logging
 import queue
+import sys
+import threading
 import requests
 import time
 
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
 from pathlib import Path
-from random import randrange
-from tqdm import tqdm
-from typing import List, Optional
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+from urllib3.exceptions import IncompleteRead, ProtocolError
 
+from .apicache import api_cache
+from .bandwidth import bandwidth_shaper
+from .hashindex import HashIndex
+from .metrics import metrics
+from .nodes import node_health
+from .progress import ProgressBoard, RENDER_INTERVAL, SlotProgress
+from .ratelimit import backoff_delay, parse_retry_after, rate_limiter
+from .sessions import get_session
+from .store import content_store
+from .utils import file_ext, hash_file, hash_from_url, HASH_BUFFER_SIZE, json_loads
 
-IMG_EXTS = [ 'jpg', 'jpeg', 'png', 'gif', 'webp' ]
-VID_EXTS = [ 'mp4', 'm4v', 'mkv', 'mov', 'wmv', 'webm', 'avi', 'flv', 'mp3' ]
 
-THROTTLE_TIME = 30
-CHUNK_SIZE = 10 * 1024
+IMG_EXTS = frozenset({ 'jpg', 'jpeg', 'png', 'gif', 'webp' })
+VID_EXTS = frozenset({ 'mp4', 'm4v', 'mkv', 'mov', 'wmv', 'webm', 'avi', 'flv', 'mp3' })
+
+API_MAX_ATTEMPTS = 8
+API_THROTTLE_BACKOFF = 5
+API_TIMEOUT = (10, 30)
+RETRY_STATUSES = { 403, 429, 500, 502, 503, 504 }
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+CHUNKS_PER_FILE = 64
+CHUNK_TARGET_TIME = 0.25
+MAX_WRITE_BUFFER = 4 * 1024 * 1024
+MAX_CORRUPT_RETRIES = 3
+STREAM_DESC_WIDTH = 48
+SEGMENT_THRESHOLD = 256 * 1024 * 1024
+SEGMENT_COUNT = 4
+SEGMENT_SAVE_INTERVAL = 1.0
+PROBE_WORKERS = 8
+PROBE_TIMEOUT = (3, 10)
+MISSING_ATTEMPTS = 2
+DEAD_STATUSES = { 404, 410 }
 
 logger = logging.getLogger(__name__)
 
 
 """
-Wrapper class to associate a URL with a name
+Wrapper class to associate a URL with a name.
+Media URLs are kept as the 32-byte hash of the file, its extension and an interned prefix
+shared by every URL of the same site, and rebuilt when read. Other URLs are kept as they are.
 """
-@dataclass
 class NamedUrl:
-    url: str
-    name: str
+    __slots__ = ( '_prefix', '_ext', 'digest', 'name', 'post' )
+
+    """
+    Wrap a URL.
+    - url: URL to download.
+    - name: Name of the downloaded file.
+    - post: Post the file belongs to, if known.
+    """
+    def __init__(self, url: str, name: str, post: Optional[str] = None) -> None:
+        self.name = name
+        self.post = post
+        # Media URLs end in /<aa>/<bb>/<sha256>.<ext>, with aa and bb the start of the hash
+        head, _, file = url.rpartition('/')
+        digest, dot, ext = file.rpartition('.')
+        if dot and len(digest) == 64 and digest.islower() and ext.isalnum() and head.endswith(f'/{digest[:2]}/{digest[2:4]}'):
+            try:
+                self.digest: Optional[bytes] = bytes.fromhex(digest)
+                self._prefix, self._ext = sys.intern(head[:-5]), sys.intern(ext)
+                return
+            except ValueError:
+                pass
+        self._prefix, self._ext = url, None
+        digest = hash_from_url(url)
+        self.digest = bytes.fromhex(digest) if digest is not None else None
+
+
+    """
+    Wrap a media URL from its parts, without parsing it.
+    - prefix: Interned URL up to the two folders named after the hash.
+    - digest: SHA-256 hash of the file.
+    - ext: Interned extension of the file.
+    - name: Name of the downloaded file.
+    - post: Post the file belongs to, if known.
+    Returns the NamedUrl of the media.
+    """
+    @classmethod
+    def from_parts(cls, prefix: str, digest: bytes, ext: str, name: str, post: Optional[str] = None) -> 'NamedUrl':
+        nu = cls.__new__(cls)
+        nu._prefix, nu._ext, nu.digest, nu.name, nu.post = prefix, ext, digest, name, post
+        return nu
+
+
+    """
+    Split a media URL into the parts it is kept as.
+    Returns the interned prefix, hash and interned extension, or None if the URL is kept as it is.
+    """
+    def parts(self) -> Optional[Tuple[str, bytes, str]]:
+        if self._ext is None:
+            return None
+        return self._prefix, self.digest, self._ext
+
+
+    """
+    Get the full URL, rebuilding media URLs from their parts.
+    """
+    @property
+    def url(self) -> str:
+        if self._ext is None:
+            return self._prefix
+        digest = self.digest.hex()
+        return f'{self._prefix}{digest[:2]}/{digest[2:4]}/{digest}.{self._ext}'
+
+
+    """
+    Get the key that duplicates of the URL share.
+    Returns the hash of the file, or the URL itself if it does not contain one.
+    """
+    def key(self) -> Union[bytes, str]:
+        return self.digest if self.digest is not None else self.url
+
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, NamedUrl):
+            return NotImplemented
+        return (self.url, self.name, self.post) == (other.url, other.name, other.post)
+
+
+    def __repr__(self) -> str:
+        return f'NamedUrl(url={self.url!r}, name={self.name!r}, post={self.post!r})'
 
 
 """
-Wrapper class to describe download progress
+Wrapper class to associate a URL with where it is downloaded to.
+on_complete is only called once the file is downloaded, on_dead if the servers do not
+have it, and on_finish whether or not it was.
+creator is the creator whose bandwidth limit the download counts against, and size the size
+of the file, if known.
 """
 @dataclass
-class _ProgressUpdate:
-    slot: int
-    done: int
-    total: Optional[int]
-    desc: str
-    n: int
-    finished: bool = False
-    paused: bool = False
+class DownloadTask:
+    url: NamedUrl
+    dst: Path
+    index: Optional[HashIndex] = None
+    on_complete: Optional[Callable[[NamedUrl], None]] = None
+    on_finish: Optional[Callable[[NamedUrl], None]] = None
+    creator: Optional[str] = None
+    size: Optional[int] = None
+    on_dead: Optional[Callable[[NamedUrl], None]] = None
+
+
+"""
+Seed a SHA-256 hash with the bytes already present in a partial download.
+- tmp: Partial download to read.
+Returns the hash object and the number of bytes fed into it.
+"""
+def _seed_hash(tmp: Path) -> Tuple['hashlib._Hash', int]:
+    hasher = hashlib.sha256()
+    seeded = 0
+    if tmp.exists():
+        with tmp.open('rb') as f:
+            while True:
+                chunk = f.read(HASH_BUFFER_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                seeded += len(chunk)
+    return hasher, seeded
+
+
+"""
+Get the full size of a file from the headers of a (possibly partial) response.
+- headers: Response headers.
+Returns the size of the whole file, or None if the server did not say.
+"""
+def _total_from_headers(headers: Mapping[str, str]) -> Optional[int]:
+    cl = headers.get('Content-Length')
+    cr = headers.get('Content-Range')
+    if cr is not None:
+        return int(cr.split('/')[-1])
+    elif cl is not None:
+        return int(cl)
+    return None
+
+
+"""
+Get the HTTP status code and requested delay behind a failed request.
+- e: Exception raised by the request.
+Returns the status code and Retry-After in seconds, each None if not known.
+"""
+def _error_details(e: requests.RequestException) -> Tuple[Optional[int], Optional[float]]:
+    res = getattr(e, 'response', None)
+    if res is None:
+        return None, None
+    return res.status_code, parse_retry_after(res.headers.get('Retry-After'))
+
+
+"""
+Check if a download failed because the servers do not have the file.
+- e: Exception raised by the download, from requests or aiohttp.
+Returns True if the file is missing from the servers.
+"""
+def _dead_link(e: BaseException) -> bool:
+    res = getattr(e, 'response', None)
+    status = res.status_code if res is not None else getattr(e, 'status', None)
+    return status in DEAD_STATUSES
+
+
+"""
+Get the download destination of a URL, routing pictures and videos apart.
+- url: NamedUrl to download.
+- dst_pics: Path to download pictures to.
+- dst_vids: Path to download videos to.
+Returns the path the URL should be downloaded to.
+"""
+def _destination(url: NamedUrl, dst_pics: Path, dst_vids: Path) -> Path:
+    return (dst_pics if file_ext(url.url) in IMG_EXTS else dst_vids) / url.name
+
+
+"""
+Pick how many bytes to read at a time, from the size of the file and the speed of its server.
+Big files are read in large chunks to cut the per-chunk overhead, small files and slow
+servers in small ones so progress and health samples still arrive several times a second.
+- total: Size of the file (or of the range being fetched), if known.
+- rate: Measured throughput of the server in bytes per second, if known.
+Returns the chunk size in bytes, a multiple of MIN_CHUNK_SIZE.
+"""
+def _chunk_size(total: Optional[int], rate: Optional[float]) -> int:
+    size = total // CHUNKS_PER_FILE if total else MIN_CHUNK_SIZE
+    if rate:
+        size = min(size, int(rate * CHUNK_TARGET_TIME))
+    size = min(max(size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    return size - size % MIN_CHUNK_SIZE
+
+
+"""
+Pick the size of the write buffer of a download, a few chunks deep.
+- chunk_size: Number of bytes read at a time.
+Returns the buffer size in bytes.
+"""
+def _write_buffer_size(chunk_size: int) -> int:
+    return min(chunk_size * 4, MAX_WRITE_BUFFER)
+
+
+"""
+Get the underlying http.client response of a streamed response, to read its body straight
+into a reusable buffer. Only plain bodies qualify, since encoded ones must go through urllib3.
+- res: Streamed response.
+Returns the response to call readinto on, or None if the body cannot be read that way.
+"""
+def _readinto_source(res: requests.Response) -> Optional[Any]:
+    if res.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    fp = getattr(res.raw, '_fp', None)
+    return fp if hasattr(fp, 'readinto') else None
+
+
+"""
+Iterate over the body of a streamed response in chunks.
+With zero_copy, plain bodies are read from the socket straight into one reusable buffer,
+so each chunk is only valid until the next one is requested. A body that ends before its
+Content-Length raises ChunkedEncodingError either way, like urllib3 does.
+- res: Streamed response.
+- chunk_size: Number of bytes to read at a time.
+- zero_copy: If the body should be read into a reusable buffer when possible.
+Yields each chunk of the body.
+"""
+def _iter_body(res: requests.Response, chunk_size: int, zero_copy: bool) -> Iterator[Union[bytes, memoryview]]:
+    source = _readinto_source(res) if zero_copy else None
+    if source is None:
+        yield from res.iter_content(chunk_size=chunk_size)
+        return
+
+    length = res.headers.get('Content-Length')
+    expected = int(length) if length is not None and length.isdigit() else None
+    received = 0
+    buf = memoryview(bytearray(chunk_size))
+    while True:
+        try:
+            n = source.readinto(buf)
+        except (http.client.HTTPException, OSError) as e:
+            raise requests.ConnectionError(e)
+        if not n:
+            break
+        received += n
+        yield buf[:n]
+
+    # http.client reports a body cut short as its end, so check it against the length here
+    if expected is not None and received < expected:
+        e = IncompleteRead(received, expected - received)
+        raise requests.exceptions.ChunkedEncodingError(ProtocolError(f'Connection broken: {e!r}', e))
+
+    # The whole body was read behind urllib3's back, so hand the connection back to the pool
+    res.raw.release_conn()
+
+
+"""
+Split a file into contiguous byte ranges of roughly equal size.
+- total: Size of the file.
+- count: Number of ranges to split it into.
+Returns a list of [start, end, done] for each range, with end inclusive.
+"""
+def _plan_segments(total: int, count: int) -> List[List[int]]:
+    size = -(-total // count)
+    return [ [start, min(start + size, total) - 1, 0] for start in range(0, total, size) ]
+
+
+"""
+Load the segment state of an interrupted segmented download.
+- state_file: Sidecar file holding the segment state.
+Returns the size of the file and its segments, or None if there is no usable state.
+"""
+def _load_segments(state_file: Path) -> Optional[Tuple[int, List[List[int]]]]:
+    try:
+        with state_file.open('r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state['total'], state['segments']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+"""
+Save the segment state of a segmented download so it can be resumed.
+- state_file: Sidecar file to hold the segment state.
+- total: Size of the file.
+- segments: List of [start, end, done] for each range.
+"""
+def _save_segments(state_file: Path, total: int, segments: List[List[int]]) -> None:
+    tmp = state_file.with_suffix('.tmp.part')
+    with tmp.open('w', encoding='utf-8') as f:
+        json.dump({ 'total': total, 'segments': segments }, f)
+    tmp.replace(state_file)
+
+
+"""
+Raised when a server answers a byte range with the whole file
+"""
+class _RangesIgnored(Exception):
+    pass
+
+
+"""
+Download one byte range of a segmented download into its place in the file.
+Gives up on files that several servers do not have, and on servers that ignore the range.
+- static_url: URL of the media without the https://nN prefix.
+- part: Preallocated partial file to write into.
+- seg: [start, end, done] of the range, with done updated as bytes arrive.
+- server_ident: Server to start downloading from.
+- lock: Lock guarding every segment's state.
+- paused: Called with True when the segment pauses after an error and False when it resumes.
+- abort: Set once another segment has failed, to stop this one as well.
+- zero_copy: If the body should be read into a reusable buffer when possible.
+- creator: Creator of the file, for its bandwidth limit.
+"""
+def _download_segment( static_url: str
+                     , part: Path
+                     , seg: List[int]
+                     , server_ident: int
+                     , lock: threading.Lock
+                     , paused: Callable[[bool], None]
+                     , abort: threading.Event
+                     , zero_copy: bool = False
+                     , creator: Optional[str] = None ) -> None:
+    missing = 0
+    while not abort.is_set():
+        with lock:
+            start, end, done = seg
+        pos = start + done
+        if pos > end:
+            return
+
+        real_url = f'https://n{server_ident}{static_url}'
+        meter = node_health.meter(server_ident)
+        throttle = bandwidth_shaper.throttle(real_url, creator)
+        try:
+            headers = { 'Range': f'bytes={pos}-{end}' }
+            rate_limiter.acquire(real_url)
+            with get_session().get(real_url, stream=True, timeout=(3, 3), headers=headers) as res:
+                meter.responded()
+                res.raise_for_status()
+                if res.status_code != 206:
+                    raise _RangesIgnored(f'Server n{server_ident} ignored the byte range')
+
+                # Unbuffered, so the saved segment state never runs ahead of the file
+                chunk_size = _chunk_size(end - pos + 1, throttle.cap(node_health.throughput(server_ident)))
+                with part.open('r+b', buffering=0) as f:
+                    f.seek(pos)
+                    for chunk in _iter_body(res, chunk_size, zero_copy):
+                        chunk = chunk[:end - pos + 1]
+                        if abort.is_set():
+                            break
+                        if not chunk:
+                            continue
+                        f.write(chunk)
+                        meter.update(len(chunk))
+                        throttle.update(len(chunk))
+                        pos += len(chunk)
+                        with lock:
+                            seg[2] = pos - start
+                        if pos > end:
+                            break
+            meter.close()
+
+        except (requests.RequestException, requests.exceptions.ReadTimeout) as e:
+            meter.close()
+            status, retry_after = _error_details(e)
+            if status in DEAD_STATUSES:
+                missing += 1
+                if missing >= MISSING_ATTEMPTS:
+                    raise
+            else:
+                node_health.record_error(server_ident, status, retry_after)
+                rate_limiter.record_error(real_url, status)
+            server_ident = node_health.choose(exclude=server_ident)
+            pause = node_health.delay(server_ident)
+            if pause > 0:
+                metrics.inc('backoff_seconds_total', pause, kind='media')
+                paused(True)
+                time.sleep(pause)
+                paused(False)
+
+
+"""
+Download a large file as several byte ranges in parallel, each from a different server.
+The ranges are written into a preallocated .part file and their progress is kept in a
+sidecar file, so each range resumes on its own after an interruption.
+- url: NamedUrl to download.
+- dst: Destination of the URL.
+- total: Size of the file, or None to take it from the sidecar file.
+- count: Number of ranges to split the file into.
+- progress: Progress of the slot running the download.
+- index: Hash index to record the completed file in, if any.
+- zero_copy: If bodies should be read into reusable buffers when possible.
+- creator: Creator of the file, for its bandwidth limit.
+Returns False if the download could not be resumed or a server ignored the byte ranges,
+so it must start over as a single stream, otherwise True.
+"""
+def _download_segmented( url: NamedUrl
+                       , dst: Path
+                       , total: Optional[int]
+                       , count: int
+                       , progress: SlotProgress
+                       , index: Optional[HashIndex] = None
+                       , zero_copy: bool = False
+                       , creator: Optional[str] = None ) -> bool:
+    static_url = url.url[10:]
+    part = dst.with_suffix(dst.suffix + '.part')
+    state_file = _segments_path(dst)
+    expected = hash_from_url(url.url)
+    corrupt = 0
+
+    while True:
+        # Resume from the sidecar, or preallocate the file and plan the ranges
+        state = _load_segments(state_file) if state_file.exists() else None
+        if state is not None and part.exists() and part.stat().st_size == state[0]:
+            total, segments = state
+        elif total is None:
+            state_file.unlink(missing_ok=True)
+            return False
+        else:
+            segments = _plan_segments(total, count)
+            with part.open('wb') as f:
+                f.truncate(total)
+            _save_segments(state_file, total, segments)
+
+        # Fetch every range at once, spreading them across the best servers
+        nodes = node_health.rank()
+        progress.server, progress.total = nodes[0], total
+        lock = threading.Lock()
+        abort = threading.Event()
+        paused_count = [0]
+        def paused(is_paused: bool) -> None:
+            with lock:
+                paused_count[0] += 1 if is_paused else -1
+
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            futures = [ pool.submit( _download_segment, static_url, part, seg
+                                   , nodes[i % len(nodes)], lock, paused, abort, zero_copy, creator )
+                        for i, seg in enumerate(segments) ]
+            pending = set(futures)
+            while pending:
+                finished, pending = wait(pending, timeout=SEGMENT_SAVE_INTERVAL, return_when=FIRST_EXCEPTION)
+                if any(future.exception() is not None for future in finished):
+                    abort.set()
+                with lock:
+                    progress.done = sum(seg[2] for seg in segments)
+                    progress.paused = paused_count[0] > 0
+                    _save_segments(state_file, total, segments)
+            try:
+                for future in futures:
+                    future.result()
+            except _RangesIgnored as e:
+                logger.info(f'{e}, downloading {url.name} as a single stream')
+                state_file.unlink(missing_ok=True)
+                part.unlink(missing_ok=True)
+                return False
+
+        # Hash the assembled file, since the ranges arrive out of order
+        state_file.unlink()
+        digest = hash_file(part, total)
+        if expected is not None and digest != expected:
+            corrupt += 1
+            metrics.inc('hash_mismatches_total')
+            if corrupt < MAX_CORRUPT_RETRIES:
+                logger.warning(f'Hash mismatch for {url.name} ({digest} != {expected}), retrying download')
+                part.unlink()
+                continue
+            logger.error(f'Hash mismatch for {url.name} persisted after {corrupt} attempts, keeping the file')
+
+        part.replace(dst)
+        if index is not None:
+            index.add(dst, digest)
+        if digest == expected:
+            content_store.add(dst, digest)
+        progress.done = total
+        return True
+
+
+"""
+Get the sidecar file that holds the state of a segmented download.
+- dst: Destination of the download.
+Returns the path of the sidecar file.
+"""
+def _segments_path(dst: Path) -> Path:
+    return dst.with_suffix(dst.suffix + '.segments.part')
 
 
 """
-Download a single URL, cycling through random load-balancing servers.
+Download a single URL, choosing load-balancing servers by their measured health.
+The file is hashed as it streams in and checked against the hash in its URL.
 - url: NamedUrl to download.
 - dst: Destination of the URL.
-- slot: Position in the progress rendering
-- q: The queue that this job belongs to
+- progress: Progress of the slot running the download.
+- index: Hash index to record the completed file in, if any.
+- segments: Number of byte ranges to split large videos into (1 to never split).
+- segment_threshold: Size in bytes from which videos are split into ranges.
+- zero_copy: If bodies should be read into reusable buffers when possible.
+- creator: Creator of the file, for its bandwidth limit.
 """
-def _download( url: NamedUrl, dst: Path, slot: int, q: queue.Queue ) -> None:
-    server_ident = randrange(4) + 1
+def _download( url: NamedUrl
+             , dst: Path
+             , progress: SlotProgress
+             , index: Optional[HashIndex] = None
+             , segments: int = 1
+             , segment_threshold: int = SEGMENT_THRESHOLD
+             , zero_copy: bool = False
+             , creator: Optional[str] = None ) -> None:
+    # Link files that were already downloaded for any creator out of the content store
+    expected = hash_from_url(url.url)
+    if content_store.link_out(expected, dst):
+        if index is not None:
+            index.add(dst, expected)
+        return
+
+    # Resume an interrupted segmented download
+    segmentable = segments > 1 and file_ext(url.url) in VID_EXTS
+    if segmentable and _segments_path(dst).exists():
+        if _download_segmented(url, dst, None, segments, progress, index, zero_copy, creator):
+            return
+        dst.with_suffix(dst.suffix + '.part').unlink(missing_ok=True)
+
+    server_ident = node_health.choose()
     static_url = url.url[10:]
     tmp = dst.with_suffix(dst.suffix + '.part')
     total = None
+    hasher, hashed = _seed_hash(tmp)
+    corrupt = 0
+    missing = 0
 
     while True:
-        headers = { 'Connection': 'close' }
+        headers = {}
         done = tmp.stat().st_size if tmp.exists() else 0
         if done > 0:
             headers['Range'] = f'bytes={done}-'
-        
+        if hashed != done:
+            hasher, hashed = _seed_hash(tmp)
+
         real_url = f'https://n{server_ident}{static_url}'
-        q.put(_ProgressUpdate(slot, done, total, url.name, server_ident))
+        progress.server, progress.done = server_ident, done
+        if total is not None:
+            progress.total = total
 
+        rate_limiter.acquire(real_url)
+        meter = node_health.meter(server_ident)
+        throttle = bandwidth_shaper.throttle(real_url, creator)
         try:
-            with requests.get(real_url, stream=True, timeout=(3, 3), headers=headers) as res:
-                res.raise_for_status()
+            with get_session().get(real_url, stream=True, timeout=(3, 3), headers=headers) as res:
+                meter.responded()
 
-                if total is None:
-                    cl = res.headers.get('Content-Length')
-                    cr = res.headers.get('Content-Range')
-                    if cr is not None:
-                        total = int(cr.split('/')[-1])
-                    elif cl is not None:
-                        total = int(cl)
+                # The partial download already holds the entire file
+                if res.status_code == 416 and done > 0:
+                    total = done
+                else:
+                    res.raise_for_status()
 
-                with tmp.open('ab') as f:
-                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
-                        if not chunk:
-                            continue
-                        f.write(chunk)
-                        done += len(chunk)
-                        q.put(_ProgressUpdate(slot, done, total, url.name, server_ident))
-                tmp.replace(dst)
+                    # The server ignored the range, so start from the beginning
+                    if done > 0 and res.status_code != 206:
+                        tmp.unlink()
+                        hasher, hashed, done = hashlib.sha256(), 0, 0
+
+                    if total is None:
+                        total = _total_from_headers(res.headers)
+                        progress.total = total
+
+                    # Large videos are handed off to parallel range requests instead, if the server takes them
+                    if ( segmentable and done == 0 and total is not None and total >= segment_threshold
+                         and res.headers.get('Accept-Ranges') == 'bytes' ):
+                        res.close()
+                        meter.close()
+                        if _download_segmented(url, dst, total, segments, progress, index, zero_copy, creator):
+                            return
+                        segmentable = False
+                        continue
+
+                    # Size reads to the rest of the file and the speed of the server, or its bandwidth limit
+                    chunk_size = _chunk_size(total - done if total else None, throttle.cap(node_health.throughput(server_ident)))
+                    with tmp.open('ab', buffering=_write_buffer_size(chunk_size)) as f:
+                        for chunk in _iter_body(res, chunk_size, zero_copy):
+                            if not chunk:
+                                continue
+                            f.write(chunk)
+                            hasher.update(chunk)
+                            meter.update(len(chunk))
+                            throttle.update(len(chunk))
+                            done += len(chunk)
+                            hashed = done
+                            progress.done = done
+            meter.close()
+
+        except (requests.RequestException, requests.exceptions.ReadTimeout) as e:
+            # Give up on files that several servers do not have. A missing file says
+            # nothing about the health of the server, so only other errors count against it.
+            meter.close()
+            status, retry_after = _error_details(e)
+            if status in DEAD_STATUSES:
+                missing += 1
+                if missing >= MISSING_ATTEMPTS:
+                    raise
+            else:
+                node_health.record_error(server_ident, status, retry_after)
+                rate_limiter.record_error(real_url, status)
+
+            # Move to the best other server, pausing only if every server is backed off
+            server_ident = node_health.choose(exclude=server_ident)
+            pause = node_health.delay(server_ident)
+            if pause > 0:
+                metrics.inc('backoff_seconds_total', pause, kind='media')
+                progress.server, progress.paused = server_ident, True
+                time.sleep(pause)
+                progress.paused = False
+            continue
+
+        # Discard corrupt downloads and try again, up to a limit
+        digest = hasher.hexdigest()
+        if expected is not None and digest != expected:
+            corrupt += 1
+            metrics.inc('hash_mismatches_total')
+            if corrupt < MAX_CORRUPT_RETRIES:
+                logger.warning(f'Hash mismatch for {url.name} ({digest} != {expected}), retrying download')
+                tmp.unlink()
+                hasher, hashed, total = hashlib.sha256(), 0, None
+                continue
+            logger.error(f'Hash mismatch for {url.name} persisted after {corrupt} attempts, keeping the file')
 
-        except (requests.RequestException, requests.exceptions.ReadTimeout):
-            q.put(_ProgressUpdate(slot, done, total, url.name, server_ident, paused=True))
-            time.sleep(THROTTLE_TIME)
-            server_ident = randrange(3) + 1
-            q.put(_ProgressUpdate(slot, done, total, url.name, server_ident))
+        tmp.replace(dst)
+        if index is not None:
+            index.add(dst, digest)
+        if digest == expected:
+            content_store.add(dst, digest)
+        progress.done = done
+        return
 
+
+"""
+Request an API URL, retrying errors and throttling with jittered exponential backoff.
+Every attempt waits for the per-host rate limiter, and Retry-After is honored.
+- api_url: URL to request.
+- headers: Extra headers to send, such as conditional request headers.
+Returns the final response, or None if no response was received after every attempt.
+"""
+def _api_get(api_url: str, headers: Optional[Mapping[str, str]] = None) -> Optional[requests.Response]:
+    res = None
+    headers = { 'accept': 'text/css', **(headers or {}) }
+    for attempt in range(1, API_MAX_ATTEMPTS + 1):
+        rate_limiter.acquire(api_url)
+        start = time.monotonic()
+        try:
+            res = get_session().get(api_url, headers=headers, timeout=API_TIMEOUT)
+        except requests.RequestException as e:
+            delay = backoff_delay(attempt)
+            reason, failure = 'error', f'failed ({api_url}) --> {e}'
         else:
-            q.put(_ProgressUpdate(slot, done, total, url.name, server_ident, finished=True))
-            return
+            metrics.observe('api_latency_seconds', time.monotonic() - start)
+            if res.status_code not in RETRY_STATUSES:
+                return res
+            retry_after = parse_retry_after(res.headers.get('Retry-After'))
+            delay = backoff_delay(attempt, retry_after, base=API_THROTTLE_BACKOFF)
+            reason, failure = str(res.status_code), f'throttled ({api_url}) --> {res.status_code}'
+
+        # There is nothing left to wait for after the last attempt
+        if attempt == API_MAX_ATTEMPTS:
+            logger.debug(f'API request {failure}, giving up after {attempt} attempts')
+            break
+        metrics.inc('api_retries_total', reason=reason)
+        logger.debug(f'API request {failure}, retrying in {delay:.1f}s')
+        metrics.inc('backoff_seconds_total', delay, kind='api')
+        time.sleep(delay)
+    return res
+
+
+"""
+Request an API URL and decode its JSON, going through the shared API cache.
+Fresh cached responses are used without a request, and stale ones are revalidated
+with the server. If the server cannot be reached, a stale response is used instead.
+- api_url: URL to request.
+- revalidate: If a cached response must be revalidated even while it is fresh.
+Returns the decoded JSON, or None if the request failed.
+"""
+def _api_get_json(api_url: str, revalidate: bool = False) -> Optional[Any]:
+    entry = api_cache.lookup(api_url)
+    if entry is not None and not revalidate and entry.fresh(api_cache.ttl):
+        metrics.inc('api_cache_total', result='hit')
+        return json_loads(entry.body)
+
+    res = _api_get(api_url, entry.validators() if entry is not None else None)
+    if res is not None and res.status_code == 304 and entry is not None:
+        metrics.inc('api_cache_total', result='revalidated')
+        api_cache.refresh(entry)
+        return json_loads(entry.body)
+    if res is None or res.status_code != 200:
+        status = res.status_code if res is not None else 'no response'
+        if entry is not None:
+            metrics.inc('api_cache_total', result='stale')
+            logger.warning(f'Using a cached response after the API failed ({api_url}) --> {status}')
+            return json_loads(entry.body)
+        logger.error(f'Failed to fetch posts using the API ({api_url}) --> {status}')
+        return None
+
+    metrics.inc('api_cache_total', result='miss')
+    data = json_loads(res.content)
+    api_cache.store(api_url, res.content, res.headers.get('ETag'), res.headers.get('Last-Modified'))
+    return data
 
 
 """
@@ -103,24 +758,64 @@ Use the Coomer/Kemono API to fetch a collection of posts.
 - service: Service the media originates from.
 - creator: Creator of the media.
 - offset: Offset into all of the posts to fetch from.
+- revalidate: If a cached copy of the posts must be checked with the server. The first
+  page is always checked, since that is where new posts show up.
 Returns a collection of posts, including possibly an empty collection
 """
-def api_fetch_post_multi(base: str, service: str, creator: str, offset: int) -> List[dict]:
+def api_fetch_post_multi(base: str, service: str, creator: str, offset: int, revalidate: bool = False) -> List[dict]:
     api_url = f'{base}/api/v1/{service}/user/{creator}/posts?o={offset}'
-    while True:
-        try:
-            res = requests.get(api_url, headers={'accept': 'text/css'})
-        except Exception:
-            if res.status_code in [429, 403]:
-                time.sleep(THROTTLE_TIME)
-        else:
-            break
+    posts = _api_get_json(api_url, revalidate or offset == 0)
+    return posts if posts is not None else []
 
-    if res.status_code != 200:
-        logger.error(f'Failed to fetch posts using the API ({api_url}) --> {res.status_code}')
-        return []
 
-    return res.json()
+"""
+Use the Coomer/Kemono API to fetch consecutive pages of posts, reading ahead
+by fetching up to `window` pages concurrently. Only the first page is fetched at
+first, and the read-ahead doubles after each full page, so creators with a single
+page of posts cost a single request.
+- base: Base URL for the API (includes up the the TLD).
+- service: Service the media originates from.
+- creator: Creator of the media.
+- start: Offset of the first page to fetch.
+- end: Offset to stop fetching at (exclusive).
+- per_page: Number of posts the API returns in a full page.
+- window: Maximum number of pages to fetch at once.
+- revalidate: If cached pages must be checked with the server.
+Yields the offset and posts of each page in order, stopping after the first short page.
+"""
+def api_iter_post_pages( base: str
+                       , service: str
+                       , creator: str
+                       , start: int
+                       , end: int
+                       , per_page: int
+                       , window: int
+                       , revalidate: bool = False ) -> Iterator[Tuple[int, List[dict]]]:
+    in_flight: Deque[Tuple[int, Future]] = deque()
+    next_offset = start
+    width = 1
+    with ThreadPoolExecutor(max_workers=window) as pool:
+        try:
+            while True:
+                # Speculatively keep the window full of upcoming pages
+                while len(in_flight) < width and next_offset < end:
+                    logger.info(f'Fetching posts {next_offset + 1} - {next_offset + per_page}')
+                    future = pool.submit(api_fetch_post_multi, base, service, creator, next_offset, revalidate)
+                    in_flight.append((next_offset, future))
+                    next_offset += per_page
+                if not in_flight:
+                    return
+
+                # Hand back pages in order, stopping at the first short one
+                offset, future = in_flight.popleft()
+                posts = future.result()
+                yield offset, posts
+                if len(posts) < per_page:
+                    return
+                width = min(width * 2, window)
+        finally:
+            for _, future in in_flight:
+                future.cancel()
 
 
 """
@@ -133,88 +828,225 @@ Returns a single post.
 """
 def api_fetch_post_single(base: str, service: str, creator: str, post_id: str) -> dict:
     api_url = f'{base}/api/v1/{service}/user/{creator}/post/{post_id}'
-    while True:
+    post = _api_get_json(api_url)
+    return post if post is not None else {}
+
+
+"""
+What a media server told about a file without sending it
+"""
+@dataclass
+class ProbeResult:
+    status: Optional[int] = None
+    size: Optional[int] = None
+
+
+    """
+    Check if downloading the file is bound to fail.
+    Returns True if the servers do not have the file, or only have an empty one.
+    """
+    def dead(self) -> bool:
+        return self.status in DEAD_STATUSES or (self.status is not None and self.status < 300 and self.size == 0)
+
+
+"""
+Ask the media servers about a file without downloading it.
+Missing files are asked about on another server before they are reported as missing.
+- url: NamedUrl to probe.
+Returns the status and size the servers answered with, both None if none of them answered.
+"""
+def probe(url: NamedUrl) -> ProbeResult:
+    server_ident = node_health.choose()
+    for attempt in range(1, MISSING_ATTEMPTS + 1):
+        real_url = f'https://n{server_ident}{url.url[10:]}'
+        rate_limiter.acquire(real_url)
         try:
-            res = requests.get(api_url, headers={'accept': 'text/css'})
-        except Exception:
-            if res.status_code in [429, 403]:
-                time.sleep(THROTTLE_TIME)
-        else:
-            break
+            res = get_session().head(real_url, timeout=PROBE_TIMEOUT, allow_redirects=True)
+        except requests.RequestException as e:
+            status, retry_after = _error_details(e)
+            node_health.record_error(server_ident, status, retry_after)
+            rate_limiter.record_error(real_url, status)
+            logger.debug(f'Failed to probe {url.name}: {e}')
+            return ProbeResult()
+
+        # Ask another server before trusting that a file is missing
+        if res.status_code in DEAD_STATUSES and attempt < MISSING_ATTEMPTS:
+            server_ident = node_health.choose(exclude=server_ident)
+            continue
+        metrics.inc('size_probes_total')
+        if not res.ok and res.status_code not in DEAD_STATUSES:
+            node_health.record_error(server_ident, res.status_code, parse_retry_after(res.headers.get('Retry-After')))
+            rate_limiter.record_error(real_url, res.status_code)
+        return ProbeResult(res.status_code, _total_from_headers(res.headers) if res.ok else None)
+
 
-    if res.status_code != 200:
-        logger.error(f'Failed to fetch posts using the API ({api_url}) --> {res.status_code}')
-        return {}
+"""
+Ask the media servers about several files concurrently.
+- urls: NamedUrl to probe.
+- workers: Maximum number of concurrent probes.
+Returns the result of each URL, in the same order.
+"""
+def probe_all(urls: List[NamedUrl], workers: int = PROBE_WORKERS) -> List[ProbeResult]:
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as pool:
+        return list(pool.map(probe, urls))
 
-    return res.json()
+
+"""
+Probe the sizes of several files concurrently.
+- urls: NamedUrl to probe.
+- workers: Maximum number of concurrent probes.
+Returns the size of each URL that the servers told, keyed by NamedUrl.key().
+"""
+def probe_sizes(urls: List[NamedUrl], workers: int = PROBE_WORKERS) -> Dict[Union[bytes, str], int]:
+    results = probe_all(urls, workers)
+    return { nu.key(): result.size for nu, result in zip(urls, results) if result.size is not None }
 
 
 """
 Download a list of NamedUrl using multithreading, checking for duplicates.
-- urls: List of NamedUrl to download.
+URLs may be a lazy iterable, in which case downloads begin as soon as the first URL arrives.
+- urls: List or iterable of NamedUrl to download.
 - dst_pics: Path to download pictures to.
 - dst_vids: Path to download videos to.
 - workers: Maximum number of threads to use for downloading.
+- index: Hash index to record completed downloads in, if any.
+- segments: Number of byte ranges to split large videos into (1 to never split).
+- segment_threshold: Size in bytes from which videos are split into ranges.
+- on_complete: Called on this thread with each NamedUrl once it is downloaded.
+- show_progress: If progress bars should be drawn, otherwise progress is only logged.
+- zero_copy: If bodies should be read into reusable buffers when possible.
 Returns the number of unique downloads successfully performed.
 """
-def multithread_download( urls: List[NamedUrl]
+def multithread_download( urls: Iterable[NamedUrl]
                         , dst_pics: Path
                         , dst_vids: Path
                         , hashes: dict[bytes, Path] = {}
                         , workers: int = 8
+                        , index: Optional[HashIndex] = None
+                        , segments: int = 1
+                        , segment_threshold: int = SEGMENT_THRESHOLD
+                        , on_complete: Optional[Callable[[NamedUrl], None]] = None
+                        , show_progress: bool = True
+                        , zero_copy: bool = False
                         ) -> dict[bytes, Path]:
-    q: queue.Queue = queue.Queue()
     url_iter = iter(urls)
-    max_desc_width = max((len(u.name) for u in urls), default=0) + 6
+    if isinstance(urls, Sequence):
+        total_urls = len(urls)
+        max_desc_width = max((len(u.name) for u in urls), default=0) + 6
+    else:
+        total_urls = None
+        max_desc_width = STREAM_DESC_WIDTH
+
+    # Every URL goes to the same folders and index
+    def next_task() -> Optional[DownloadTask]:
+        next_url = next(url_iter, None)
+        if next_url is None:
+            return None
+        return DownloadTask(next_url, _destination(next_url, dst_pics, dst_vids), index, on_complete)
+
+    download_pool(next_task, workers, total_urls, max_desc_width, segments, segment_threshold, show_progress, zero_copy)
+    if index is not None:
+        index.save()
+    return hashes
 
-    with ThreadPoolExecutor(max_workers=workers) as pool:
-        # Create a "master" bar the denotes total progress
-        master_bar = tqdm(total=len(urls), unit="file", desc="Total Media Files", position=0)
 
-        # Initialize tqdm bars for the fixed number of workers
-        bars: List[tqdm] = [tqdm(unit="B", unit_scale=True, unit_divisor=1024, position=i+1) for i in range(workers)]
+"""
+Run downloads on a fixed number of threads, each showing its own progress bar.
+Tasks are pulled from next_task whenever a thread is free. When it has nothing to
+hand out, the thread stays idle and is offered work again each time a download
+finishes or the progress is redrawn, so sources that hold work back (e.g. to cap
+concurrency, or until it is discovered) can fill it later.
+Threads only record their progress in per-slot counters, which are rendered at a fixed rate.
+- next_task: Returns the next task, or None if there is nothing to download right now.
+- workers: Maximum number of threads to use for downloading.
+- total_urls: Number of files to download, or None if unknown.
+- max_desc_width: Width to pad the progress bar descriptions to.
+- segments: Number of byte ranges to split large videos into (1 to never split).
+- segment_threshold: Size in bytes from which videos are split into ranges.
+- show_progress: If progress bars should be drawn, otherwise progress is only logged.
+- zero_copy: If bodies should be read into reusable buffers when possible.
+- board: Board to show the progress on, with a slot per worker, or None to create one.
+"""
+def download_pool( next_task: Callable[[], Optional[DownloadTask]]
+                 , workers: int
+                 , total_urls: Optional[int] = None
+                 , max_desc_width: int = STREAM_DESC_WIDTH
+                 , segments: int = 1
+                 , segment_threshold: int = SEGMENT_THRESHOLD
+                 , show_progress: bool = True
+                 , zero_copy: bool = False
+                 , board: Optional[ProgressBoard] = None ) -> None:
+    finished: queue.Queue = queue.Queue()
+    if board is None:
+        board = ProgressBoard(workers, total_urls, max_desc_width, show_progress)
 
-        # Helper to submit the next available URL to a specific slot
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Helper to submit the next available task to a specific slot
+        slot_tasks: List[Optional[DownloadTask]] = [ None ] * workers
+        slot_started: List[float] = [ 0.0 ] * workers
         def submit_next(slot: int) -> bool:
-            try:
-                next_url = next(url_iter)
-                dst = (dst_pics if next_url.url.split('.')[-1] in IMG_EXTS else dst_vids) / next_url.name
-                pool.submit(_download, next_url, dst, slot, q)
-                return True
-            except StopIteration:
+            waited = time.monotonic()
+            task = next_task()
+            slot_tasks[slot] = task
+            if task is None:
                 return False
+            slot_started[slot] = time.monotonic()
+            metrics.observe('queue_wait_seconds', slot_started[slot] - waited)
+            board.start(slot, task.url.name, task.size)
+            future = pool.submit( _download, task.url, task.dst, board.slots[slot], task.index
+                                , segments, segment_threshold, zero_copy, task.creator )
+            future.add_done_callback(lambda f, slot=slot: finished.put((slot, f)))
+            return True
 
         # Initialize necessary slots
         active_workers = 0
+        idle: List[int] = []
         for slot in range(workers):
             if submit_next(slot):
                 active_workers += 1
             else:
-                bars[slot].clear()
+                board.idle(slot)
+                idle.append(slot)
 
-        # Continually refill slots as jobs finish
+        # Continually refill slots as jobs finish, redrawing the progress in between
         while active_workers > 0:
             try:
-                msg = q.get(timeout=0.1)
+                slot, future = finished.get(timeout=RENDER_INTERVAL)
             except queue.Empty:
+                while idle and submit_next(idle[0]):
+                    idle.pop(0)
+                    active_workers += 1
+                board.render()
                 continue
 
-            bar = bars[msg.slot]
-            if msg.paused:
-                bar.set_description((f'[ {msg.n}*] ' + msg.desc).ljust(max_desc_width))
+            task = slot_tasks[slot]
+            metrics.observe('download_seconds', time.monotonic() - slot_started[slot])
+            board.finish(slot, future.exception() is None)
+            if future.exception() is not None and _dead_link(future.exception()):
+                metrics.inc('files_total', result='dead')
+                logger.warning(f'Skipping {task.url.name}, the file is missing on the servers: {future.exception()}')
+                if task.on_dead is not None:
+                    task.on_dead(task.url)
+            elif future.exception() is not None:
+                metrics.inc('files_total', result='failed')
+                logger.error(f'Failed to download {task.url.name}: {future.exception()}')
             else:
-                bar.set_description((f'[ {msg.n} ] ' + msg.desc).ljust(max_desc_width))
+                metrics.inc('files_total', result='downloaded')
+                if task.on_complete is not None:
+                    task.on_complete(task.url)
+            if task.on_finish is not None:
+                task.on_finish(task.url)
+            if not submit_next(slot):
+                active_workers -= 1
+                board.idle(slot)
+                idle.append(slot)
 
-            if msg.finished:
-                master_bar.update(1)
-                if submit_next(msg.slot):
-                    bar.reset()
-                else:
-                    active_workers -= 1
-            else:
-                if msg.total:
-                    bar.total = msg.total
-                bar.n = msg.done
-                bar.refresh()
+            # Offer the freed capacity to the idle slots as well
+            while idle and submit_next(idle[0]):
+                idle.pop(0)
+                active_workers += 1
+            board.render()
 
-    return hashes
\ No newline at end of file
+    board.close()
@@ -0,0 +1,267 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from random import choices
+from typing import Dict, Iterable, List, Optional
+
+from .metrics import metrics
+from .ratelimit import backoff_delay
+
+
+NODES = ( 1, 2, 3, 4 )
+EWMA_ALPHA = 0.3
+ERROR_BACKOFF = 1
+THROTTLE_BACKOFF = 10
+MAX_BACKOFF = 600
+SAMPLE_BYTES = 4 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Observed performance of a single nN server
+"""
+@dataclass
+class _NodeStats:
+    throughput: Optional[float] = None
+    latency: Optional[float] = None
+    error_rate: float = 0.0
+    failures: int = 0
+    throttled: int = 0
+    backoff_until: float = 0.0
+    transferred: int = 0
+
+
+"""
+Tracker for the health of the nN media servers, shared by every download.
+Servers are chosen in proportion to their measured throughput, discounted by
+latency and recent errors. Failing servers are backed off exponentially, for at
+least as long as any Retry-After they send, and only probed again once their
+backoff expires. Only a request that started after the backoff expired clears it, so
+transfers that were already running when a server failed do not cut its backoff short.
+"""
+class NodeHealth:
+    """
+    Start with no measurements, so every server is tried early on.
+    - nodes: Identifiers of the servers to choose from.
+    """
+    def __init__(self, nodes: Iterable[int] = NODES) -> None:
+        self._lock = threading.Lock()
+        self._stats: Dict[int, _NodeStats] = { n: _NodeStats() for n in nodes }
+
+
+    """
+    Forget every measurement and backoff, keeping the same servers.
+    """
+    def reset(self) -> None:
+        with self._lock:
+            self._stats = { n: _NodeStats() for n in self._stats }
+
+
+    """
+    Score a server for selection, higher being better.
+    - stats: Stats of the server.
+    - default: Throughput to assume for servers that have not been measured yet.
+    Returns the score of the server.
+    """
+    @staticmethod
+    def _score(stats: _NodeStats, default: float) -> float:
+        throughput = stats.throughput if stats.throughput is not None else default
+        latency = stats.latency if stats.latency is not None else 0.0
+        return max(throughput, 1.0) * (1.0 - stats.error_rate) / (1.0 + latency)
+
+
+    """
+    Rank every server from best to worst, with backed-off servers last.
+    Returns the list of server identifiers.
+    """
+    def rank(self) -> List[int]:
+        now = time.monotonic()
+        with self._lock:
+            default = max((s.throughput for s in self._stats.values() if s.throughput is not None), default=1.0)
+            return sorted( self._stats
+                         , key=lambda n: ( self._stats[n].backoff_until > now
+                                         , -self._score(self._stats[n], default) ) )
+
+
+    """
+    Choose a server for the next request.
+    - exclude: Server to avoid if any other is available (e.g. the one that just failed).
+    Returns the identifier of the chosen server.
+    """
+    def choose(self, exclude: Optional[int] = None) -> int:
+        now = time.monotonic()
+        with self._lock:
+            available = [ n for n, s in self._stats.items() if s.backoff_until <= now and n != exclude ]
+            if not available:
+                available = [ n for n, s in self._stats.items() if s.backoff_until <= now ]
+            if not available:
+                return min(self._stats, key=lambda n: self._stats[n].backoff_until)
+
+            # Spread load in proportion to performance, trying unmeasured servers first
+            unmeasured = [ n for n in available if self._stats[n].throughput is None ]
+            if unmeasured:
+                return choices(unmeasured)[0]
+            default = max(self._stats[n].throughput for n in available)
+            weights = [ self._score(self._stats[n], default) for n in available ]
+            return choices(available, weights=weights)[0]
+
+
+    """
+    Get how long to wait before a server may be used again.
+    - node: Server identifier.
+    Returns the number of seconds left in the backoff of the server.
+    """
+    def delay(self, node: int) -> float:
+        with self._lock:
+            return max(self._stats[node].backoff_until - time.monotonic(), 0.0)
+
+
+    """
+    Get the measured throughput of a server.
+    - node: Server identifier.
+    Returns the throughput in bytes per second, or None if it has not been measured yet.
+    """
+    def throughput(self, node: int) -> Optional[float]:
+        with self._lock:
+            return self._stats[node].throughput
+
+
+    """
+    Record a successful transfer from a server.
+    - node: Server identifier.
+    - size: Number of bytes transferred.
+    - elapsed: Time spent transferring, in seconds.
+    - latency: Time until the response headers arrived, in seconds.
+    - started: Monotonic time the request was made at, now if None.
+    """
+    def record_success( self
+                      , node: int
+                      , size: int
+                      , elapsed: float
+                      , latency: float
+                      , started: Optional[float] = None ) -> None:
+        started = time.monotonic() if started is None else started
+        with self._lock:
+            stats = self._stats[node]
+            if elapsed > 0 and size > 0:
+                stats.throughput = _ewma(stats.throughput, size / elapsed)
+            stats.latency = _ewma(stats.latency, latency)
+            stats.error_rate = _ewma(stats.error_rate, 0.0)
+            stats.transferred += size
+            if started >= stats.backoff_until:
+                stats.failures = 0
+                stats.backoff_until = 0.0
+        metrics.inc('media_bytes_total', size, node=f'n{node}')
+
+
+    """
+    Record a failed request to a server and back it off with jittered exponential backoff.
+    - node: Server identifier.
+    - status: HTTP status code of the failure, if there was a response.
+    - retry_after: Number of seconds the server asked to wait, if it did.
+    """
+    def record_error(self, node: int, status: Optional[int] = None, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            stats = self._stats[node]
+            stats.error_rate = _ewma(stats.error_rate, 1.0)
+            stats.failures += 1
+            if status in (429, 403):
+                stats.throttled += 1
+                base = THROTTLE_BACKOFF
+            else:
+                base = ERROR_BACKOFF
+            backoff = backoff_delay(stats.failures, retry_after, base, MAX_BACKOFF)
+            stats.backoff_until = time.monotonic() + backoff
+        metrics.inc('media_errors_total', node=f'n{node}', status=str(status) if status is not None else 'none')
+        logger.debug(f'Server n{node} failed (status {status}), backing off for {backoff:.0f}s')
+
+
+    """
+    Start measuring a request to a server.
+    - node: Server identifier.
+    Returns a meter to report the request through.
+    """
+    def meter(self, node: int) -> 'TransferMeter':
+        return TransferMeter(self, node)
+
+
+    """
+    Log the measured performance of every server.
+    """
+    def log_summary(self) -> None:
+        with self._lock:
+            for node, stats in sorted(self._stats.items()):
+                if stats.throughput is None and stats.failures == 0 and stats.throttled == 0:
+                    continue
+                throughput = f'{stats.throughput / 1024**2:.2f} MiB/s' if stats.throughput is not None else 'n/a'
+                latency = f'{stats.latency * 1000:.0f} ms' if stats.latency is not None else 'n/a'
+                logger.info( f'Server n{node}: {throughput}, {latency} latency, {stats.error_rate:.0%} errors, '
+                             f'{stats.throttled} throttled, {stats.transferred / 1024**2:.1f} MiB transferred' )
+
+
+"""
+Measurement of a single request to a server, fed back into the tracker.
+Long transfers are sampled every few MiB so the tracker reacts while they run.
+"""
+class TransferMeter:
+    """
+    Start timing a request.
+    - health: Tracker to report to.
+    - node: Server identifier.
+    """
+    def __init__(self, health: NodeHealth, node: int) -> None:
+        self.health = health
+        self.node = node
+        self.latency = 0.0
+        self._start = time.monotonic()
+        self._sample_start = self._start
+        self._sample_bytes = 0
+
+
+    """
+    Mark that the response headers have arrived.
+    """
+    def responded(self) -> None:
+        now = time.monotonic()
+        self.latency = now - self._start
+        self._sample_start = now
+        metrics.observe('media_latency_seconds', self.latency, node=f'n{self.node}')
+
+
+    """
+    Count bytes received from the server.
+    - size: Number of bytes received.
+    """
+    def update(self, size: int) -> None:
+        self._sample_bytes += size
+        if self._sample_bytes >= SAMPLE_BYTES:
+            self.close()
+
+
+    """
+    Report the bytes received since the last sample.
+    """
+    def close(self) -> None:
+        now = time.monotonic()
+        if self._sample_bytes > 0:
+            self.health.record_success( self.node, self._sample_bytes, now - self._sample_start, self.latency
+                                      , self._start )
+        self._sample_start = now
+        self._sample_bytes = 0
+
+
+"""
+Update an exponentially weighted moving average.
+- current: Current average, or None if there is no sample yet.
+- sample: New sample.
+Returns the updated average.
+"""
+def _ewma(current: Optional[float], sample: float) -> float:
+    if current is None:
+        return sample
+    return current + EWMA_ALPHA * (sample - current)
+
+
+node_health = NodeHealth()
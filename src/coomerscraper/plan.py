@@ -0,0 +1,108 @@
+import json
+import logging
+import sys
+from dataclasses import asdict, dataclass
+from pathlib import Path, PurePosixPath
+from typing import Iterator, Optional, TextIO
+
+from .networking import NamedUrl
+from .utils import hash_from_url
+
+
+PLAN_FORMATS = ( 'jsonl', 'aria2' )
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Planned download of a single media file, as saved in a plan
+"""
+@dataclass
+class PlanEntry:
+    url: str
+    name: str
+    path: str
+    post: Optional[str] = None
+    sha256: Optional[str] = None
+
+
+    """
+    Get the NamedUrl to download the entry with.
+    Returns the NamedUrl of the entry.
+    """
+    def named_url(self) -> NamedUrl:
+        return NamedUrl(self.url, self.name, self.post)
+
+
+"""
+Writer of download plans, streaming each entry out as soon as it is planned.
+Plans are written as JSON lines, which can be imported again, or as an aria2c
+input file with the output path and checksum of every file.
+Paths are relative to the download destination.
+"""
+class PlanWriter:
+    """
+    Open the plan for writing.
+    - path: File to write the plan to, or "-" for stdout.
+    - fmt: Format of the plan ("jsonl" or "aria2").
+    """
+    def __init__(self, path: str, fmt: str = 'jsonl') -> None:
+        assert fmt in PLAN_FORMATS, f'Unknown plan format "{fmt}"'
+        self.fmt = fmt
+        self.count = 0
+        self._file: TextIO = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8')
+
+
+    """
+    Write the entry of a planned download.
+    - nu: NamedUrl to download.
+    - path: Destination of the file, relative to the download destination.
+    """
+    def write(self, nu: NamedUrl, path: PurePosixPath) -> None:
+        digest = hash_from_url(nu.url)
+        if self.fmt == 'jsonl':
+            entry = PlanEntry(nu.url, nu.name, path.as_posix(), nu.post, digest)
+            self._file.write(json.dumps(asdict(entry)) + '\n')
+        else:
+            self._file.write(f'{nu.url}\n  dir={path.parent.as_posix()}\n  out={path.name}\n')
+            if digest is not None:
+                self._file.write(f'  checksum=sha-256={digest}\n')
+        self.count += 1
+
+
+    """
+    Flush the plan, closing it unless it is stdout.
+    """
+    def close(self) -> None:
+        self._file.flush()
+        if self._file is not sys.stdout:
+            self._file.close()
+        logger.info(f'Exported {self.count} planned downloads')
+
+
+"""
+Read the entries of a plan written in the JSON lines format.
+Paths must lead to a file inside a creator folder of the download destination.
+- path: File to read the plan from.
+Yields each entry of the plan, skipping blank and malformed lines.
+"""
+def read_plan(path: Path) -> Iterator[PlanEntry]:
+    with path.open('r', encoding='utf-8') as f:
+        for num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                entry = PlanEntry( record['url'], record['name'], record['path']
+                                 , record.get('post'), record.get('sha256') )
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f'Skipping malformed line {num} of plan {path}: {e}')
+                continue
+            parts = PurePosixPath(entry.path).parts
+            if PurePosixPath(entry.path).is_absolute() or '..' in parts:
+                logger.warning(f'Skipping line {num} of plan {path}, its path leaves the download destination')
+                continue
+            if len(parts) < 2:
+                logger.warning(f'Skipping line {num} of plan {path}, its path has no creator folder')
+                continue
+            yield entry
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from tqdm import tqdm
+from typing import List, Optional
+
+
+RENDER_INTERVAL = 0.25
+LOG_INTERVAL = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Progress of the download running in one slot of the pool.
+Only the download thread writes to it and the renderer only samples it, so plain
+attribute writes are enough and the transfer loop never blocks on the terminal.
+"""
+@dataclass
+class SlotProgress:
+    name: str = ''
+    done: int = 0
+    total: Optional[int] = None
+    server: int = 0
+    paused: bool = False
+
+
+"""
+Renderer for the progress of every slot of the download pool.
+Slots are sampled at a fixed rate rather than on every chunk. When headless, no bars
+are drawn and a summary is logged every so often instead, for cron or Docker runs.
+Files can be taken out of the total from any thread, e.g. once a probe finds them not
+worth downloading, and the next render picks the new total up.
+"""
+class ProgressBoard:
+    """
+    Create the bars, or nothing if headless.
+    - workers: Number of slots in the pool.
+    - total_urls: Number of files to download, or None if unknown.
+    - desc_width: Width to pad the bar descriptions to.
+    - show: If bars should be drawn, otherwise progress is only logged.
+    """
+    def __init__( self
+                , workers: int
+                , total_urls: Optional[int]
+                , desc_width: int
+                , show: bool = True ) -> None:
+        self.slots: List[SlotProgress] = [ SlotProgress() for _ in range(workers) ]
+        self.show = show
+        self.desc_width = desc_width
+        self.total_urls = total_urls
+        self.skipped = 0
+        self._skip_lock = threading.Lock()
+        self.files = 0
+        self.failed = 0
+        self.finished_bytes = 0
+        self._start = time.monotonic()
+        self._rendered = 0.0
+        self._logged = self._start
+        self._bars: List[tqdm] = []
+        self._master: Optional[tqdm] = None
+        if show:
+            self._master = tqdm(total=total_urls, unit="file", desc="Total Media Files", position=0)
+            self._bars = [ tqdm(unit="B", unit_scale=True, unit_divisor=1024, position=i+1) for i in range(workers) ]
+
+
+    """
+    Reset a slot for a new download.
+    - slot: Slot that starts the download.
+    - name: Name of the file being downloaded.
+    - total: Size of the file, if already known.
+    """
+    def start(self, slot: int, name: str, total: Optional[int] = None) -> None:
+        progress = self.slots[slot]
+        progress.name, progress.done, progress.total, progress.paused = name, 0, total, False
+        if self.show:
+            self._bars[slot].reset()
+
+
+    """
+    Count the download of a slot as over, whether or not the file was downloaded.
+    - slot: Slot whose download is over.
+    - ok: If the file was downloaded, otherwise it is counted as failed.
+    """
+    def finish(self, slot: int, ok: bool = True) -> None:
+        progress = self.slots[slot]
+        if ok:
+            self.files += 1
+            self.finished_bytes += progress.total or progress.done
+        else:
+            self.failed += 1
+            self.finished_bytes += progress.done
+        progress.name, progress.done = '', 0
+        if self._master is not None:
+            if not ok:
+                self._master.set_postfix(failed=self.failed, refresh=False)
+            self._master.update(1)
+
+
+    """
+    Take a file that will not be downloaded after all out of the total.
+    """
+    def skip(self) -> None:
+        with self._skip_lock:
+            self.skipped += 1
+
+
+    """
+    Get the number of files to download, without the skipped ones.
+    Returns the number of files, or None if unknown.
+    """
+    def total(self) -> Optional[int]:
+        return self.total_urls - self.skipped if self.total_urls is not None else None
+
+
+    """
+    Clear the bar of a slot that has nothing left to download.
+    - slot: Slot that went idle.
+    """
+    def idle(self, slot: int) -> None:
+        if self.show:
+            self._bars[slot].clear()
+
+
+    """
+    Sample every slot and redraw the bars, at most once per RENDER_INTERVAL.
+    When headless, a summary is logged once per LOG_INTERVAL instead.
+    """
+    def render(self) -> None:
+        now = time.monotonic()
+        if self.show:
+            if now - self._rendered < RENDER_INTERVAL:
+                return
+            self._rendered = now
+            if self.skipped and self._master.total != self.total():
+                self._master.total = self.total()
+                self._master.refresh()
+            for progress, bar in zip(self.slots, self._bars):
+                if not progress.name:
+                    continue
+                marker = '*' if progress.paused else ' '
+                bar.set_description((f'[ {progress.server}{marker}] ' + progress.name).ljust(self.desc_width), refresh=False)
+                if progress.total:
+                    bar.total = progress.total
+                bar.n = progress.done
+                bar.refresh()
+        elif now - self._logged >= LOG_INTERVAL:
+            self._logged = now
+            self.log_summary()
+
+
+    """
+    Log how many files and bytes have been downloaded so far.
+    """
+    def log_summary(self) -> None:
+        size = self.finished_bytes + sum(progress.done for progress in self.slots)
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        total = f'/{self.total()}' if self.total_urls is not None else ''
+        failed = f' ({self.failed} failed)' if self.failed else ''
+        logger.info( f'Downloaded {self.files}{total} files{failed}, {size / 1024**2:.1f} MiB '
+                     f'({size / 1024**2 / elapsed:.2f} MiB/s)' )
+
+
+    """
+    Close the bars, or log the final summary if headless.
+    """
+    def close(self) -> None:
+        if self.show:
+            for bar in self._bars:
+                bar.close()
+            self._master.close()
+        else:
+            self.log_summary()
@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from random import uniform
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from .metrics import metrics
+
+
+API_RATE = 2.0
+MEDIA_RATE = 10.0
+MIN_RATE = 0.5
+THROTTLE_COOLDOWN = 5.0
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Token bucket that spaces out requests to stay under a steady rate.
+"""
+class TokenBucket:
+    """
+    Create a full bucket.
+    - rate: Tokens added per second.
+    - burst: Maximum number of tokens the bucket holds.
+    """
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    """
+    Change the rate of the bucket, keeping the tokens it holds.
+    - rate: Tokens added per second.
+    - burst: Maximum number of tokens the bucket holds.
+    """
+    def set_rate(self, rate: float, burst: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate, self.burst = rate, burst
+
+
+    """
+    Take tokens from the bucket, going into debt if there are not enough.
+    - tokens: Number of tokens to take.
+    Returns the number of seconds to wait before the tokens are actually available.
+    """
+    def reserve(self, tokens: float = 1.0) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+    """
+    Take tokens from the bucket, sleeping until they are available.
+    - tokens: Number of tokens to take.
+    """
+    def acquire(self, tokens: float = 1.0) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+
+"""
+Per-host request rate limits shared by the API and media traffic.
+Hosts starting with "nN." are media servers, every other host is the API.
+Without a media rate, media servers are not limited until they answer 429, from which
+point each server is limited on its own and slowed down further by every new 429.
+"""
+class RateLimiter:
+    """
+    Create a limiter with no buckets, which are made per host on first use.
+    - api_rate: Requests per second allowed to the API host.
+    - media_rate: Requests per second allowed to each media server, None to only limit throttled servers.
+    """
+    def __init__(self, api_rate: float = API_RATE, media_rate: Optional[float] = None) -> None:
+        self.api_rate = api_rate
+        self.media_rate = media_rate
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._throttled: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+
+    """
+    Change the rates, starting every host over with a full bucket.
+    - api_rate: Requests per second allowed to the API host.
+    - media_rate: Requests per second allowed to each media server, None to only limit throttled servers.
+    """
+    def configure(self, api_rate: float, media_rate: Optional[float]) -> None:
+        with self._lock:
+            self.api_rate = api_rate
+            self.media_rate = media_rate
+            self._buckets.clear()
+            self._throttled.clear()
+
+
+    """
+    Get the bucket for the host of a URL.
+    - url: URL that is about to be requested.
+    Returns the bucket shared by every request to that host, or None if the host is not limited.
+    """
+    def bucket(self, url: str) -> Optional[TokenBucket]:
+        host = urlsplit(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                rate = self.media_rate if _is_media(host) else self.api_rate
+                if rate is None:
+                    return None
+                bucket = TokenBucket(rate, max(rate, 1.0))
+                self._buckets[host] = bucket
+        return bucket
+
+
+    """
+    Slow down a media server that answered 429.
+    Unlimited servers are limited to MEDIA_RATE, limited ones have their rate halved down to MIN_RATE.
+    Further 429s within THROTTLE_COOLDOWN seconds are answers to requests made at the old rate and are ignored.
+    - url: URL that failed.
+    - status: HTTP status code of the failure, if there was a response.
+    """
+    def record_error(self, url: str, status: Optional[int]) -> None:
+        host = urlsplit(url).netloc
+        if status != 429 or not _is_media(host):
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._throttled.get(host, -THROTTLE_COOLDOWN) < THROTTLE_COOLDOWN:
+                return
+            self._throttled[host] = now
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                rate = MEDIA_RATE
+                self._buckets[host] = TokenBucket(rate, max(rate, 1.0))
+            else:
+                rate = max(bucket.rate / 2, MIN_RATE)
+                bucket.set_rate(rate, max(rate, 1.0))
+        metrics.inc('rate_limit_throttles_total', host=host)
+        logger.debug(f'Server {host} answered 429, limiting it to {rate:g}/s')
+
+
+    """
+    Wait until a request to a URL is allowed.
+    - url: URL that is about to be requested.
+    """
+    def acquire(self, url: str) -> None:
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+
+    """
+    Reserve a request to a URL without blocking, for use from the event loop.
+    - url: URL that is about to be requested.
+    Returns the number of seconds to wait before making the request.
+    """
+    def reserve(self, url: str) -> float:
+        bucket = self.bucket(url)
+        if bucket is None:
+            return 0.0
+        wait = bucket.reserve()
+        if wait > 0:
+            metrics.inc('rate_limit_wait_seconds_total', wait, host=urlsplit(url).netloc)
+        return wait
+
+
+"""
+Check if a host is a media server rather than the API.
+- host: Host of a URL.
+Returns True for hosts starting with "nN.".
+"""
+def _is_media(host: str) -> bool:
+    return len(host) > 3 and host[0] == 'n' and host[1].isdigit() and host[2] == '.'
+
+
+"""
+Compute how long to wait before retrying, using exponential backoff with full jitter.
+- attempt: Number of failed attempts so far (starting at 1).
+- retry_after: Number of seconds the server asked to wait, if it did.
+- base: Delay of the first retry before jitter, in seconds.
+- cap: Maximum delay before jitter, in seconds.
+Returns the number of seconds to wait.
+"""
+def backoff_delay( attempt: int
+                 , retry_after: Optional[float] = None
+                 , base: float = BACKOFF_BASE
+                 , cap: float = BACKOFF_CAP ) -> float:
+    delay = uniform(0, min(cap, base * 2 ** max(attempt - 1, 0)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+"""
+Parse a Retry-After header, which is either a number of seconds or an HTTP date.
+- value: Value of the header, if it was sent.
+Returns the number of seconds to wait, or None if the header is missing or invalid.
+"""
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+rate_limiter = RateLimiter()
+
+
+"""
+Set the per-host rates of the shared rate limiter.
+- api_rate: Requests per second allowed to the API host.
+- media_rate: Requests per second allowed to each media server, None to only limit throttled servers.
+"""
+def configure_rate_limits(api_rate: float, media_rate: Optional[float] = None) -> None:
+    rate_limiter.configure(api_rate, media_rate)
+    media = f'{media_rate}/s per media server' if media_rate is not None else 'media servers once they answer 429'
+    logger.debug(f'Limiting requests to {api_rate}/s for the API and {media}')
@@ -0,0 +1,430 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+from .hashindex import HashIndex
+from .metrics import metrics
+from .networking import ( _destination, download_pool, DownloadTask, IMG_EXTS, NamedUrl, probe_all, probe_sizes
+                        , SEGMENT_THRESHOLD, STREAM_DESC_WIDTH )
+from .progress import ProgressBoard
+from .urllist import UrlList
+from .utils import file_ext
+
+
+ORDER_POLICIES = ( 'discovery', 'smallest', 'newest', 'images', 'mixed' )
+ORDER_WINDOW = 64
+IMAGE_SIZE_ESTIMATE = 1024 * 1024
+VIDEO_SIZE_ESTIMATE = 128 * 1024 * 1024
+LARGE_FILE_SIZE = 32 * 1024 * 1024
+LARGE_SLOT_SHARE = 0.25
+DISCOVERY_BUFFER = 256
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Planned downloads of a single argument URL, along with where they go
+"""
+@dataclass
+class DownloadJob:
+    source: str
+    host: str
+    creator: str
+    urls: Iterable[NamedUrl]
+    dst_pics: Path
+    dst_vids: Path
+    index: Optional[HashIndex] = None
+    on_complete: Optional[Callable[[NamedUrl], None]] = None
+    on_dead: Optional[Callable[[NamedUrl], None]] = None
+    active: int = 0
+    exhausted: bool = False
+    failed: bool = False
+    lookahead: List[NamedUrl] = field(default_factory=list)
+    discovered: Optional[queue.Queue] = None
+
+
+"""
+Marks the end of the URLs of a job in its discovery queue
+"""
+_DONE = object()
+
+
+"""
+Get the publish time of a file from its name, which starts with it for files of posts.
+- nu: NamedUrl of the file.
+Returns the publish time as YYYYMMDDTHHMMSS, or an empty string if the name does not start with one.
+"""
+def _published(nu: NamedUrl) -> str:
+    stamp = nu.name[:15]
+    return stamp if len(stamp) == 15 and stamp[8] == 'T' and stamp[:8].isdigit() and stamp[9:].isdigit() else ''
+
+
+"""
+Sort a list of files newest post first, keeping the files of each post in their order.
+Files without a publish time go last.
+- urls: Files to sort.
+Returns the sorted files.
+"""
+def _newest_first(urls: Sequence) -> UrlList:
+    published = [ _published(nu) for nu in urls ]
+    order = sorted(range(len(published)), key=published.__getitem__, reverse=True)
+    return UrlList(urls[i] for i in order)
+
+
+"""
+Global download queue shared by every job of a batch.
+Jobs are served round-robin, one URL at a time, so every creator makes progress
+and the worker pool stays full across creator boundaries. Jobs that are still being
+discovered (e.g. API pagination) are advanced on their own thread into a bounded queue,
+so a slow page never holds back the downloads of other jobs. A job whose discovery fails
+is marked as failed and stops there, while the other jobs carry on. Optional caps limit how
+many downloads may run at once for a single creator and for a single site.
+Within a job, URLs are taken in discovery order, or ordered by a policy:
+- smallest: smallest files first, so many files finish early.
+- newest: newest posts first, keeping the files of each post together. Lists are sorted
+  up front, while pages are discovered newest first already.
+- images: images before videos.
+- mixed: keep a share of the slots on files of at least LARGE_FILE_SIZE for bandwidth and
+  fill the rest with the smallest files for request rate, so neither sits idle.
+Except for newest, the next URL is picked from a window of upcoming URLs, which is refilled
+once it is half empty. For smallest and mixed, URLs are discovered on a thread of their own
+even for lists, where their sizes are probed in concurrent batches of HEAD requests before
+they are queued, so the dispatcher never waits on a probe. Sizes that are unknown are
+estimated from the file type.
+With preflight, every URL is probed before it is handed out, so links to missing or empty
+files and files already on disk with the same size are dropped without taking up a slot.
+Preflight runs on the discovery thread of each job, a window of URLs at a time, so the
+first downloads start after a single batch of probes, and dropped URLs are taken out of
+the total of the progress.
+"""
+class Scheduler:
+    """
+    Create an empty scheduler.
+    - creator_jobs: Maximum concurrent downloads per creator (0 for no limit).
+    - host_jobs: Maximum concurrent downloads per site (0 for no limit).
+    - order: Ordering policy, one of ORDER_POLICIES.
+    - window: Number of upcoming URLs of each job that the policy picks from.
+    - preflight: If every URL should be probed before it is downloaded.
+    """
+    def __init__( self
+                , creator_jobs: int = 0
+                , host_jobs: int = 0
+                , order: str = 'discovery'
+                , window: int = ORDER_WINDOW
+                , preflight: bool = False ) -> None:
+        assert order in ORDER_POLICIES, f'Unknown ordering policy "{order}"'
+        self.creator_jobs = creator_jobs
+        self.host_jobs = host_jobs
+        self.order = order
+        self.window = window
+        self.preflight = preflight
+        self._jobs: List[DownloadJob] = []
+        self._next = 0
+        self._creators: Counter = Counter()
+        self._hosts: Counter = Counter()
+        self._sizes: Dict[Union[bytes, str], int] = {}
+        self._workers = 1
+        self._large = 0
+        self._picked_large = False
+        self._wake = threading.Event()
+        self._board: Optional[ProgressBoard] = None
+
+
+    """
+    Add a job to the batch.
+    - job: Job to schedule.
+    """
+    def add(self, job: DownloadJob) -> None:
+        self._jobs.append(job)
+
+
+    """
+    Check if a job may start another download without exceeding a cap.
+    - job: Job to check.
+    Returns True if the job is below both caps.
+    """
+    def _allowed(self, job: DownloadJob) -> bool:
+        if self.creator_jobs and self._creators[job.creator] >= self.creator_jobs:
+            return False
+        if self.host_jobs and self._hosts[job.host] >= self.host_jobs:
+            return False
+        return True
+
+
+    """
+    Take the next URL of a job, discovering more of it if needed.
+    - job: Job to take from.
+    Returns the next NamedUrl, or None if the job has no URLs left.
+    """
+    def _pull(self, job: DownloadJob) -> Optional[NamedUrl]:
+        self._picked_large = False
+        if self.order in ( 'discovery', 'newest' ):
+            return self._discover(job)
+
+        # Refill the window of upcoming URLs once it is half empty
+        if len(job.lookahead) < max(self.window // 2, 1):
+            while len(job.lookahead) < self.window:
+                url = self._discover(job)
+                if url is None:
+                    break
+                job.lookahead.append(url)
+        if not job.lookahead:
+            return None
+        return job.lookahead.pop(self._pick(job.lookahead))
+
+
+    """
+    Take the next discovered URL of a job, without waiting for discovery.
+    - job: Job to take from.
+    Returns the next NamedUrl in discovery order, or None if the job has no URLs ready.
+    """
+    def _discover(self, job: DownloadJob) -> Optional[NamedUrl]:
+        if job.exhausted:
+            return None
+        if job.discovered is None:
+            url = next(job.urls, None)
+        else:
+            try:
+                url = job.discovered.get_nowait()
+            except queue.Empty:
+                return None
+            if isinstance(url, BaseException):
+                job.exhausted = job.failed = True
+                logger.error(f'Failed to discover "{job.source}", skipping the rest of it: {url!r}')
+                metrics.inc('discovery_errors_total')
+                return None
+            if url is _DONE:
+                url = None
+        if url is None:
+            job.exhausted = True
+            logger.debug(f'Finished discovering "{job.source}"')
+        return url
+
+
+    """
+    Discover the URLs of a job into its queue, on a thread of its own.
+    Errors are queued as well, so the job is failed where the URLs are taken.
+    - job: Job to discover.
+    """
+    def _produce(self, job: DownloadJob) -> None:
+        try:
+            for url in job.urls:
+                job.discovered.put(url)
+                self._wake.set()
+            job.discovered.put(_DONE)
+        except Exception as e:
+            job.discovered.put(e)
+        self._wake.set()
+
+
+    """
+    Probe the sizes of URLs in concurrent batches of a window, on the thread discovering them.
+    - urls: URLs of a job, in discovery order.
+    Yields each URL once its size is known, in the same order.
+    """
+    def _probe(self, urls: Iterator[NamedUrl]) -> Iterator[NamedUrl]:
+        while True:
+            batch = list(islice(urls, self.window))
+            if not batch:
+                break
+            self._sizes.update(probe_sizes([ nu for nu in batch if nu.key() not in self._sizes ]))
+            yield from batch
+
+
+    """
+    Probe the URLs of a job in concurrent batches of a window, on the thread discovering
+    them, dropping downloads that are not needed.
+    Files already on disk with the size the server reports count as downloaded.
+    - job: Job the URLs belong to.
+    - urls: URLs of the job, in discovery order.
+    Yields each URL that should be downloaded, in the same order.
+    """
+    def _preflight(self, job: DownloadJob, urls: Iterator[NamedUrl]) -> Iterator[NamedUrl]:
+        dropped = Counter()
+        while True:
+            batch = list(islice(urls, self.window))
+            if not batch:
+                break
+            for nu, result in zip(batch, probe_all(batch)):
+                if result.size is not None:
+                    self._sizes[nu.key()] = result.size
+
+                # Links to missing or empty files would only fail once downloading
+                if result.dead():
+                    reason = 'missing' if result.size != 0 else 'empty'
+                    logger.warning(f'Skipping {nu.name}, the file is {reason} on the server (status {result.status})')
+                    dropped[reason] += 1
+                    metrics.inc('preflight_total', result=reason)
+                    self._skip()
+                    if job.on_dead is not None:
+                        job.on_dead(nu)
+                    continue
+
+                # A file with the same name and size was downloaded without being hashed
+                dst = _destination(nu, job.dst_pics, job.dst_vids)
+                if result.size is not None and dst.is_file() and dst.stat().st_size == result.size:
+                    logger.debug(f'Skipping {nu.name}, it is already on disk with the same size')
+                    dropped['existing'] += 1
+                    metrics.inc('preflight_total', result='existing')
+                    self._skip()
+                    if job.on_complete is not None:
+                        job.on_complete(nu)
+                    continue
+                metrics.inc('preflight_total', result='ok')
+                yield nu
+        if dropped:
+            logger.info( f'Preflight of "{job.source}" skipped {dropped["missing"]} missing, {dropped["empty"]} empty '
+                         f'and {dropped["existing"]} existing files' )
+
+
+    """
+    Take a URL that was dropped before being handed out out of the total of the progress.
+    """
+    def _skip(self) -> None:
+        if self._board is not None:
+            self._board.skip()
+
+
+    """
+    Get the known or estimated size of a file.
+    - nu: NamedUrl of the file.
+    Returns the size of the file in bytes.
+    """
+    def _size(self, nu: NamedUrl) -> int:
+        size = self._sizes.get(nu.key())
+        if size is not None:
+            return size
+        return IMAGE_SIZE_ESTIMATE if file_ext(nu.url) in IMG_EXTS else VIDEO_SIZE_ESTIMATE
+
+
+    """
+    Pick the URL to download next out of a window, following the ordering policy.
+    - urls: Upcoming URLs of a job, in discovery order.
+    Returns the position of the picked URL.
+    """
+    def _pick(self, urls: List[NamedUrl]) -> int:
+        positions = range(len(urls))
+        if self.order == 'smallest':
+            return min(positions, key=lambda i: self._size(urls[i]))
+        if self.order == 'images':
+            return min(positions, key=lambda i: (file_ext(urls[i].url) not in IMG_EXTS, i))
+
+        # Mixed: give the first large file a slot while large files are below their share,
+        # and the smallest file otherwise
+        pick = None
+        if self._large < max(1, int(self._workers * LARGE_SLOT_SHARE)):
+            pick = next(( i for i in positions if self._size(urls[i]) >= LARGE_FILE_SIZE ), None)
+        if pick is None:
+            pick = min(positions, key=lambda i: self._size(urls[i]))
+        self._picked_large = self._size(urls[pick]) >= LARGE_FILE_SIZE
+        return pick
+
+
+    """
+    Hand out the next download, going round the jobs that are below their caps.
+    Only waits for discovery when no download is running, since the pool would stop otherwise.
+    Returns the next task, or None if every job is finished, held back by a cap, or still discovering.
+    """
+    def next_task(self) -> Optional[DownloadTask]:
+        while True:
+            # Anything discovered after the event is cleared sets it again
+            self._wake.clear()
+            task = self._next_ready()
+            if task is not None or any(job.active for job in self._jobs):
+                return task
+            if all(job.exhausted for job in self._jobs):
+                return None
+            self._wake.wait()
+
+
+    """
+    Hand out the next download that is ready, going round the jobs that are below their caps.
+    Returns the next task, or None if no job has a URL ready.
+    """
+    def _next_ready(self) -> Optional[DownloadTask]:
+        for _ in range(len(self._jobs)):
+            job = self._jobs[self._next]
+            self._next = (self._next + 1) % len(self._jobs)
+            if not self._allowed(job):
+                continue
+            url = self._pull(job)
+            if url is None:
+                continue
+
+            # Release the caps once the download is over, even if it failed
+            started = time.monotonic()
+            large = self._picked_large
+            def on_finish(nu: NamedUrl, job: DownloadJob = job, large: bool = large) -> None:
+                metrics.add_span(job.creator, 'download', started)
+                self._large -= large
+                job.active -= 1
+                self._creators[job.creator] -= 1
+                self._hosts[job.host] -= 1
+
+            self._large += large
+            job.active += 1
+            self._creators[job.creator] += 1
+            self._hosts[job.host] += 1
+            dst = _destination(url, job.dst_pics, job.dst_vids)
+            return DownloadTask( url, dst, job.index, job.on_complete, on_finish, job.creator
+                               , self._sizes.pop(url.key(), None), job.on_dead )
+        return None
+
+
+    """
+    Download every job of the batch through a single pool of threads.
+    - workers: Maximum number of threads to use for downloading.
+    - segments: Number of byte ranges to split large videos into (1 to never split).
+    - segment_threshold: Size in bytes from which videos are split into ranges.
+    - show_progress: If progress bars should be drawn, otherwise progress is only logged.
+    - zero_copy: If bodies should be read into reusable buffers when possible.
+    """
+    def download( self
+                , workers: int
+                , segments: int = 1
+                , segment_threshold: int = SEGMENT_THRESHOLD
+                , show_progress: bool = True
+                , zero_copy: bool = False ) -> None:
+        if not self._jobs:
+            return
+
+        # Lists have a known length, so the progress bar can show a total
+        total_urls = None
+        if all(isinstance(job.urls, Sequence) for job in self._jobs):
+            total_urls = sum(len(job.urls) for job in self._jobs)
+        self._board = ProgressBoard(workers, total_urls, STREAM_DESC_WIDTH, show_progress)
+
+        # URLs are probed on the discovery threads, so lists get one too when they are probed
+        probing = self.preflight or self.order in ( 'smallest', 'mixed' )
+        for job in self._jobs:
+            listed = isinstance(job.urls, Sequence)
+            if listed and self.order == 'newest':
+                job.urls = _newest_first(job.urls)
+            job.urls = iter(job.urls)
+            if self.preflight:
+                job.urls = self._preflight(job, job.urls)
+            elif probing:
+                job.urls = self._probe(job.urls)
+            if not listed or probing:
+                job.discovered = queue.Queue(DISCOVERY_BUFFER)
+                threading.Thread(target=self._produce, args=(job,), name=f'discover-{job.creator}', daemon=True).start()
+        self._workers = workers
+
+        logger.info( f'Downloading {len(self._jobs)} jobs with up to {workers} concurrent downloads'
+                     f'{f", {self.creator_jobs} per creator" if self.creator_jobs else ""}'
+                     f'{f", {self.host_jobs} per site" if self.host_jobs else ""}'
+                     f'{f", ordered by {self.order}" if self.order != "discovery" else ""}' )
+        download_pool( self.next_task, workers, total_urls, STREAM_DESC_WIDTH, segments, segment_threshold
+                     , show_progress, zero_copy, self._board )
+        self._board = None
+
+        # Indexes may be shared between jobs of the same creator
+        for index in { id(job.index): job.index for job in self._jobs if job.index is not None }.values():
+            index.save()
@@ -0,0 +1,91 @@
+import logging
+import threading
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+MAX_POOLED_HOSTS = 32
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[requests.Session] = None
+_adapter: Optional[HTTPAdapter] = None
+_lock = threading.RLock()
+
+
+"""
+Create the shared session used for all API and media requests.
+Connections are kept alive and pooled separately for each host, so retries and
+consecutive files on the same nN server skip the TCP and TLS handshakes.
+- pool_size: Maximum number of connections kept per host, see pool_size().
+"""
+def configure_session(pool_size: int) -> None:
+    global _session, _adapter
+    adapter = HTTPAdapter(pool_connections=MAX_POOLED_HOSTS, pool_maxsize=max(pool_size, 1))
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    with _lock:
+        old = _session
+        _session, _adapter = session, adapter
+    if old is not None:
+        old.close()
+    logger.debug(f'Configured shared session with {pool_size} pooled connections per host')
+
+
+"""
+Work out how many connections to keep per host, so that none is discarded at the busiest.
+Every download may hold a connection per segment to the same server, next to the probes.
+- downloads: Maximum number of concurrent downloads.
+- segments: Number of connections a single download may open.
+- probes: Maximum number of concurrent HEAD probes.
+- api_requests: Maximum number of concurrent API requests.
+Returns the number of connections to pool per host.
+"""
+def pool_size(downloads: int, segments: int = 1, probes: int = 0, api_requests: int = 0) -> int:
+    return max(downloads * max(segments, 1) + probes, api_requests, 1)
+
+
+"""
+Get the shared session, creating one with a default pool size if needed.
+Returns a session that is safe to use from the download threads.
+"""
+def get_session() -> requests.Session:
+    if _session is None:
+        with _lock:
+            if _session is None:
+                configure_session(4)
+    return _session
+
+
+"""
+Count the requests made and connections opened by the shared session.
+Returns the number of requests and the number of new connections.
+"""
+def connection_stats() -> Tuple[int, int]:
+    if _adapter is None:
+        return 0, 0
+    num_requests = 0
+    num_connections = 0
+    pools = _adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        num_requests += pool.num_requests
+        num_connections += pool.num_connections
+    return num_requests, num_connections
+
+
+"""
+Log how many requests were served over reused connections.
+"""
+def log_connection_stats() -> None:
+    num_requests, num_connections = connection_stats()
+    if num_requests == 0:
+        return
+    reused = max(num_requests - num_connections, 0)
+    logger.info( f'Made {num_requests} requests over {num_connections} connections '
+                 f'({reused / num_requests:.0%} reused)' )
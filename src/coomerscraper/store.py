@@ -0,0 +1,183 @@
+import errno
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .metrics import metrics
+
+
+FICLONE = 0x40049409
+SHARED_MARKER = '.content_store'
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Content-addressed store of media files, shared by every creator.
+Files are kept under <root>/<aa>/<bb>/<sha256>, like the /data/ paths of the site,
+so the store doubles as a global index of every hash that was ever downloaded.
+Creator folders hold hardlinks into the store (or reflinks, or copies when the
+store is on another file system), so media reposted by several creators is only
+downloaded and stored once.
+"""
+class ContentStore:
+    """
+    Create a disabled store, which is enabled through configure.
+    """
+    def __init__(self) -> None:
+        self.root: Optional[Path] = None
+        self._lock = threading.Lock()
+        self._warned = False
+
+
+    """
+    Point the store at a folder, or disable it.
+    - root: Folder of the store, or None to disable it.
+    """
+    def configure(self, root: Optional[Path]) -> None:
+        self.root = root
+        self._warned = False
+        if root is None:
+            return
+        try:
+            root.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            logger.warning(f'Disabling the content store, {root} is not usable: {e}')
+            self.root = None
+
+
+    """
+    Get where the file with a given hash is kept.
+    - digest: SHA-256 hex digest of the file.
+    Returns the path of the file in the store.
+    """
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+
+    """
+    Check if a file with a given hash is in the store.
+    - digest: SHA-256 hex digest of the file, or None.
+    Returns True if the store is enabled and holds the file.
+    """
+    def contains(self, digest: Optional[str]) -> bool:
+        return self.root is not None and digest is not None and self.path(digest).exists()
+
+
+    """
+    Put the stored file with a given hash at a destination, instead of downloading it.
+    - digest: SHA-256 hex digest of the file, or None.
+    - dst: Destination of the file.
+    Returns True if the file was taken from the store.
+    """
+    def link_out(self, digest: Optional[str], dst: Path) -> bool:
+        if not self.contains(digest):
+            return False
+        src = self.path(digest)
+        try:
+            dst.unlink(missing_ok=True)
+            _link(src, dst, allow_copy=True)
+        except OSError as e:
+            logger.warning(f'Failed to link {dst.name} from the content store: {e}')
+            return False
+        metrics.inc('store_links_total')
+        metrics.inc('store_bytes_saved_total', dst.stat().st_size)
+        return True
+
+
+    """
+    Check if every file of a folder was already offered to the store.
+    - folder: Creator folder.
+    Returns True if the folder was shared with this store before.
+    """
+    def shared(self, folder: Path) -> bool:
+        try:
+            return self.root is not None and (folder / SHARED_MARKER).read_text(encoding='utf-8') == str(self.root.resolve())
+        except OSError:
+            return False
+
+
+    """
+    Remember that every file of a folder was offered to the store, so that only files that
+    are new to the folder are offered from then on.
+    - folder: Creator folder.
+    """
+    def mark_shared(self, folder: Path) -> None:
+        try:
+            (folder / SHARED_MARKER).write_text(str(self.root.resolve()), encoding='utf-8')
+        except OSError as e:
+            logger.debug(f'Failed to mark {folder} as shared with the content store: {e}')
+
+
+    """
+    Add a downloaded file to the store, unless a file with its hash already is.
+    Files that cannot be linked into the store are left out rather than copied.
+    - file: File to add.
+    - digest: SHA-256 hex digest of the file.
+    """
+    def add(self, file: Path, digest: str) -> None:
+        if self.root is None or self.contains(digest):
+            return
+        path = self.path(digest)
+        tmp = path.with_name(f'{digest}.{threading.get_ident()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _link(file, tmp, allow_copy=False)
+            tmp.replace(path)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            with self._lock:
+                warned, self._warned = self._warned, True
+            if not warned:
+                logger.warning(f'Failed to add files to the content store, is it on the same file system? ({e})')
+            return
+        metrics.inc('store_files_total')
+
+
+"""
+Make dst share the content of src, preferring a hardlink, then a reflink, then a copy.
+- src: Existing file.
+- dst: Path to create.
+- allow_copy: If the content may be copied when it cannot be shared.
+"""
+def _link(src: Path, dst: Path, allow_copy: bool) -> None:
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if e.errno not in ( errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP ):
+            raise
+
+    # Copy-on-write clone, e.g. across subvolumes of btrfs or XFS
+    if fcntl is not None:
+        try:
+            with src.open('rb') as s, dst.open('wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        except OSError:
+            dst.unlink(missing_ok=True)
+
+    if not allow_copy:
+        raise OSError(errno.EXDEV, f'Cannot link {src} to {dst}')
+    shutil.copyfile(src, dst)
+
+
+content_store = ContentStore()
+
+
+"""
+Set up the shared content store.
+- root: Folder of the store, or None to disable it.
+"""
+def configure_content_store(root: Optional[Path]) -> None:
+    content_store.configure(root)
+    if content_store.root is not None:
+        logger.info(f'Sharing media between creators through the content store in {root}')
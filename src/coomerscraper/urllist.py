@@ -0,0 +1,212 @@
+import re
+from array import array
+from collections.abc import Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from .networking import NamedUrl
+
+
+DIGEST_SIZE = 32
+MAX_FILE_NUMBER = 0xffff
+MAX_EXTS = 0xff
+BUCKET_BITS = 14
+NAME_LAYOUT = re.compile(r'(.*_)(0|[1-9][0-9]{0,4})\.([^.]+)', re.DOTALL)
+
+
+"""
+Compact list of NamedUrls, for plans of hundreds of thousands of files.
+Instead of one object and two strings per file, each media file takes the 32 bytes of its
+hash, a small extension code, the number of the file in its post, and the code of its
+group, which holds the URL prefix, post and name stem shared by the files of a post.
+NamedUrls are rebuilt as they are read. URLs and names that do not follow the media
+layout are kept as they are.
+"""
+class UrlList(Sequence):
+    """
+    Create the list.
+    - named_urls: NamedUrls to fill the list with.
+    """
+    def __init__(self, named_urls: Iterable[NamedUrl] = ()) -> None:
+        self._digests = bytearray()
+        self._groups = array('I')
+        self._numbers = array('H')
+        self._exts = array('B')
+        self._group_table: List[Tuple[str, Optional[str], Optional[str]]] = []
+        self._group_codes: Dict[Tuple[str, Optional[str], Optional[str]], int] = {}
+        self._ext_table: List[str] = []
+        self._ext_codes: Dict[str, int] = {}
+        self._names: Dict[int, str] = {}
+        self._others: Dict[int, NamedUrl] = {}
+        self._last_group: Optional[Tuple[str, Optional[str], Optional[str]]] = None
+        self._last_code = 0
+        for nu in named_urls:
+            self.append(nu)
+
+
+    """
+    Split a file name into the stem shared by the files of a post and the number of the file.
+    - name: Name of the file, usually <published>-<title>_<number>.<ext>.
+    - ext: Extension of the file.
+    Returns the stem and number, or None if the name does not follow that layout.
+    """
+    @staticmethod
+    def _split_name(name: str, ext: str) -> Optional[Tuple[str, int]]:
+        match = NAME_LAYOUT.fullmatch(name)
+        if match is None or match.group(3) != ext:
+            return None
+        number = int(match.group(2))
+        if number > MAX_FILE_NUMBER:
+            return None
+        return match.group(1), number
+
+
+    """
+    Add a NamedUrl to the end of the list.
+    - nu: NamedUrl to add.
+    """
+    def append(self, nu: NamedUrl) -> None:
+        parts = nu.parts()
+        ext_code = None
+        if parts is not None:
+            prefix, digest, ext = parts
+            ext_code = self._ext_codes.get(ext)
+            if ext_code is None and len(self._ext_table) <= MAX_EXTS:
+                ext_code = self._ext_codes[ext] = len(self._ext_table)
+                self._ext_table.append(ext)
+
+        # Anything that does not fit the media layout is kept whole
+        if ext_code is None:
+            self._others[len(self._groups)] = nu
+            prefix, digest, stem, number = '', bytes(DIGEST_SIZE), None, 0
+            ext_code = 0
+        else:
+            split = self._split_name(nu.name, ext)
+            if split is None:
+                self._names[len(self._groups)] = nu.name
+                stem, number = None, 0
+            else:
+                stem, number = split
+
+        # Consecutive files usually come from the same post, so the last group is checked first
+        group = (prefix, nu.post, stem)
+        if group == self._last_group:
+            code = self._last_code
+        else:
+            code = self._group_codes.get(group)
+            if code is None:
+                code = self._group_codes[group] = len(self._group_table)
+                self._group_table.append(group)
+            self._last_group, self._last_code = group, code
+        self._digests += digest
+        self._groups.append(code)
+        self._numbers.append(number)
+        self._exts.append(ext_code)
+
+
+    """
+    Rebuild the NamedUrl at a position.
+    - position: Non-negative position in the list.
+    Returns the NamedUrl.
+    """
+    def _get(self, position: int) -> NamedUrl:
+        if self._others and position in self._others:
+            return self._others[position]
+        prefix, post, stem = self._group_table[self._groups[position]]
+        ext = self._ext_table[self._exts[position]]
+        name = f'{stem}{self._numbers[position]}.{ext}' if stem is not None else self._names[position]
+        digest = bytes(self._digests[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE])
+        return NamedUrl.from_parts(prefix, digest, ext, name, post)
+
+
+    def __getitem__(self, position: int) -> NamedUrl:
+        if isinstance(position, slice):
+            return UrlList(self._get(i) for i in range(*position.indices(len(self))))
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('UrlList index out of range')
+        return self._get(position)
+
+
+    def __iter__(self) -> Iterator[NamedUrl]:
+        for position in range(len(self._groups)):
+            yield self._get(position)
+
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+
+
+"""
+Compact set of the keys that duplicate files share, for deduplicating plans of hundreds of
+thousands of files. Instead of a bytes object and a set entry per file, hashes are packed
+32 bytes apiece into buckets picked by their first bits, and looked up with a byte search of
+their bucket. Keys that are not hashes (URLs without one) are kept in a regular set.
+"""
+class DigestSet:
+    """
+    Create the set.
+    - keys: Keys to fill the set with, as returned by NamedUrl.key().
+    """
+    def __init__(self, keys: Iterable[Union[bytes, str]] = ()) -> None:
+        self._buckets: Dict[int, bytearray] = {}
+        self._count = 0
+        self._others: Set[Union[bytes, str]] = set()
+        for key in keys:
+            self.add(key)
+
+
+    """
+    Find the bucket of a hash and check if the hash is in it.
+    Hashes are uniformly distributed, so their first bits spread them evenly over the buckets.
+    - digest: Hash to look up.
+    Returns the bucket, None if it does not exist yet, and if the hash is in it.
+    """
+    def _lookup(self, digest: bytes) -> Tuple[int, Optional[bytearray], bool]:
+        code = (digest[0] << 8 | digest[1]) >> (16 - BUCKET_BITS)
+        bucket = self._buckets.get(code)
+        if bucket is None:
+            return code, None, False
+        # Only matches that start on a hash boundary count
+        pos = bucket.find(digest)
+        while pos >= 0 and pos % DIGEST_SIZE:
+            pos = bucket.find(digest, pos + 1)
+        return code, bucket, pos >= 0
+
+
+    """
+    Add a key to the set.
+    - key: Key to add, as returned by NamedUrl.key().
+    Returns True if the key was not in the set yet.
+    """
+    def add(self, key: Union[bytes, str]) -> bool:
+        if not isinstance(key, bytes) or len(key) != DIGEST_SIZE:
+            if key in self._others:
+                return False
+            self._others.add(key)
+            return True
+        # Same as _lookup, inlined as this runs for every discovered file
+        code = (key[0] << 8 | key[1]) >> (16 - BUCKET_BITS)
+        bucket = self._buckets.get(code)
+        if bucket is None:
+            self._buckets[code] = bytearray(key)
+        else:
+            pos = bucket.find(key)
+            while pos >= 0 and pos % DIGEST_SIZE:
+                pos = bucket.find(key, pos + 1)
+            if pos >= 0:
+                return False
+            bucket += key
+        self._count += 1
+        return True
+
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, bytes) or len(key) != DIGEST_SIZE:
+            return key in self._others
+        return self._lookup(key)[2]
+
+
+    def __len__(self) -> int:
+        return self._count + len(self._others)
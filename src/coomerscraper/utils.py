@@ -1,11 +1,30 @@
 import hashlib
+import json
 import logging
+import mmap
 import os
 import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import islice
 from pathlib import Path
 from sys import maxsize
-from typing import Optional, Set, Tuple
+from typing import Any, Callable, Iterator, List, Optional, Set, Tuple, Union
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .hashindex import HashIndex
+from .metrics import metrics
+
+
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+HASH_QUEUE_DEPTH = 4
+WATERMARK_NAME = '.watermark.json'
 
 logger = logging.getLogger(__name__)
 
@@ -25,28 +44,108 @@ def base_url(url: str) -> str:
     return base
 
 
+"""
+Compute the SHA-256 hash of a single file.
+Large files are memory-mapped instead of being copied through read buffers.
+- file: File to hash.
+- size: Size of the file, or None to stat it now.
+Returns the hex digest of the file.
+"""
+def hash_file(file: Path, size: Optional[int] = None) -> str:
+    if size is None:
+        size = file.stat().st_size
+    start = time.monotonic()
+    curr_hash = hashlib.sha256()
+    with file.open('rb') as f:
+        if size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                for i in range(0, len(view), HASH_BUFFER_SIZE):
+                    curr_hash.update(view[i:i + HASH_BUFFER_SIZE])
+                view.release()
+        else:
+            while(True):
+                chunk = f.read(HASH_BUFFER_SIZE)
+                if not chunk:
+                    break
+                curr_hash.update(chunk)
+    metrics.observe('hash_seconds', time.monotonic() - start)
+    metrics.inc('hash_bytes_total', size)
+    return curr_hash.hexdigest()
+
+
 """
 Compute the hash of all files in a directory, including subdirectories.
 This is the hash that is used in the media URLs.
 - root: Starting path to hash from.
+- index: Persistent hash index to reuse and update, if any.
+- workers: Number of threads to hash with (0 to use every core, 1 to hash serially).
+- on_hashed: Called with each file that was hashed rather than found in the index, and its hex digest.
 Returns a set of unique hashes from root.
 """
-def compute_file_hashes(root: Path) -> Set[str]:
+def compute_file_hashes( root: Path
+                       , index: Optional[HashIndex] = None
+                       , workers: int = 0
+                       , on_hashed: Optional[Callable[[Path, str], None]] = None ) -> Set[str]:
     hashes = set()
+    files = []
+    pending = []
     for file in root.glob('**/*'):
-        if file.is_dir() or file.suffix == '.part':
+        # Skip partial downloads and bookkeeping files such as the hash index
+        if file.is_dir() or file.suffix == '.part' or file.name.startswith('.'):
             continue
-        with file.open('rb') as f:
-            curr_hash = hashlib.sha256()
-            while(True):
-                chunk = f.read(10 * 1024)
-                if not chunk:
-                    break
-                curr_hash.update(chunk)
-            hashes.add(curr_hash.hexdigest())
+        files.append(file)
+        st = file.stat()
+        digest = index.lookup(file, st) if index is not None else None
+        if digest is None:
+            pending.append((file, st))
+        else:
+            hashes.add(digest)
+
+    # Hash whatever was not in the index, either serially or across a thread pool
+    # (hashlib releases the GIL while hashing, so threads use multiple cores)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        results = ( (file, st, hash_file(file, st.st_size)) for file, st in pending )
+    else:
+        results = _parallel_hash(pending, workers)
+    for file, st, digest in results:
+        if index is not None:
+            index.add(file, digest, st)
+        if on_hashed is not None:
+            on_hashed(file, digest)
+        hashes.add(digest)
+
+    if index is not None:
+        index.prune(files)
+        index.save()
+        logger.info(f'Hashed {len(pending)} new or changed files, reused {len(files) - len(pending)} from the index')
     return hashes
 
 
+"""
+Hash files on a thread pool, keeping a bounded number of files in flight.
+- pending: Files to hash along with the result of stat() on each.
+- workers: Number of threads to hash with.
+Yields each file, its stat() result, and its hex digest as they complete.
+"""
+def _parallel_hash( pending: List[Tuple[Path, os.stat_result]]
+                  , workers: int ) -> Iterator[Tuple[Path, os.stat_result, str]]:
+    todo = iter(pending)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        for file, st in islice(todo, workers * HASH_QUEUE_DEPTH):
+            in_flight[pool.submit(hash_file, file, st.st_size)] = (file, st)
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                file, st = in_flight.pop(future)
+                yield file, st, future.result()
+            for file, st in islice(todo, len(finished)):
+                in_flight[pool.submit(hash_file, file, st.st_size)] = (file, st)
+
+
 """
 Create the folder structure for download destinations
 - dst: Root destination for all downloads
@@ -70,6 +169,66 @@ def create_folder_tree(dst: Path, user: str, skip_img: bool, skip_vid: bool) ->
     return
 
 
+"""
+Get the SHA-256 hash embedded in a Coomer/Kemono media URL.
+- url: Media URL, usually of the form https://<host>/data/xx/yy/<hash>.<ext>
+Returns the hex digest from the URL, or None if the URL does not contain one.
+"""
+def hash_from_url(url: str) -> Optional[str]:
+    url_hash = url.split('?')[0].split('/')[-1].split('.')[0].lower()
+    if re.fullmatch(r'[0-9a-f]{64}', url_hash) is None:
+        return None
+    return url_hash
+
+
+"""
+Newest post of a creator that has already been scraped
+"""
+@dataclass
+class Watermark:
+    id: Optional[str] = None
+    published: Optional[str] = None
+
+
+"""
+Read the watermark of a creator page from its download folder.
+- root: Download folder of the creator (usually dst/<user>).
+- key: Key of the page, "<service>/<creator>".
+Returns the watermark, or None if the page has not been scraped before.
+"""
+def read_watermark(root: Path, key: str) -> Optional[Watermark]:
+    path = root / WATERMARK_NAME
+    try:
+        with path.open('r', encoding='utf-8') as f:
+            entry = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    return Watermark(entry.get('id'), entry.get('published'))
+
+
+"""
+Store the watermark of a creator page in its download folder.
+- root: Download folder of the creator (usually dst/<user>).
+- key: Key of the page, "<service>/<creator>".
+- watermark: Newest post that has been scraped.
+"""
+def write_watermark(root: Path, key: str, watermark: Watermark) -> None:
+    path = root / WATERMARK_NAME
+    try:
+        with path.open('r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[key] = { 'id': watermark.id, 'published': watermark.published }
+    tmp = path.with_suffix('.tmp')
+    with tmp.open('w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    tmp.replace(path)
+    logger.debug(f'Updated watermark of {key} to post {watermark.id} ({watermark.published})')
+
+
 """
 Round offsets in an API-friendly that includes the intended range.
 - offsets: Offsets to round.
@@ -117,4 +276,24 @@ Convert a sentence to CamelCase.
 Returns the camel case equivalent.
 """
 def to_camel(sentence: str) -> str:
-    return ''.join([ word.capitalize() for word in sentence.split() ])
\ No newline at end of file
+    return ''.join([ word.capitalize() for word in sentence.split() ])
+
+
+"""
+Get the extension of a file name or URL, without the dot.
+- name: File name or URL to get the extension of.
+Returns the text after the last dot, or the whole name if it has none.
+"""
+def file_ext(name: str) -> str:
+    return name.rpartition('.')[2]
+
+
+"""
+Decode a JSON document, with orjson if it is installed.
+- data: Document to decode.
+Returns the decoded JSON.
+"""
+def json_loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
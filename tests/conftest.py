@@ -0,0 +1,35 @@
+from urllib.parse import urlsplit, urlunsplit
+
+import pytest
+from requests.adapters import HTTPAdapter
+
+from coomerscraper import sessions
+from coomerscraper.metrics import metrics
+from coomerscraper.mocksite import MockSite
+from coomerscraper.nodes import node_health
+from coomerscraper.ratelimit import configure_rate_limits
+
+
+"""
+Start a small mock site and route every request of the scraper to it.
+Yields the running MockSite, with 1 creator of 20 posts and about 1 dead link in 10.
+"""
+@pytest.fixture
+def mock_site(monkeypatch):
+    site = MockSite(creators=1, posts=20, attachments=1, min_size=1024, max_size=4096, dead_ratio=0.1, seed=1)
+    port = site.start()
+
+    # Every session the scraper configures sends its requests to the mock site
+    class LocalAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            parts = urlsplit(request.url)
+            request.headers['Host'] = parts.netloc
+            request.url = urlunsplit(('http', f'127.0.0.1:{port}', parts.path, parts.query, ''))
+            return super().send(request, **kwargs)
+    monkeypatch.setattr(sessions, 'HTTPAdapter', LocalAdapter)
+    sessions.configure_session(4)
+    configure_rate_limits(1000, 1000)
+    node_health.reset()
+    metrics.reset()
+    yield site
+    site.stop()
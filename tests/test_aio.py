@@ -0,0 +1,60 @@
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from coomerscraper.aio import async_download
+from coomerscraper.networking import NamedUrl
+
+
+"""
+Send every request of the asyncio engine to the mock site.
+- site: Running MockSite.
+- monkeypatch: Pytest monkeypatch fixture.
+"""
+def route_to(site, monkeypatch):
+    port = site.port
+    session_class = aiohttp.ClientSession
+
+    class LocalSession:
+        def __init__(self, **kwargs):
+            self._session = session_class(**kwargs)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            await self._session.close()
+
+        def get(self, url, headers=None, **kwargs):
+            parts = urlsplit(url)
+            headers = dict(headers or {}, Host=parts.netloc)
+            return self._session.get(urlunsplit(('http', f'127.0.0.1:{port}', parts.path, parts.query, '')), headers=headers, **kwargs)
+    monkeypatch.setattr(aiohttp, 'ClientSession', LocalSession)
+
+
+"""
+Files are written whole, and completed and dead files are reported off the event loop.
+"""
+def test_async_download(mock_site, monkeypatch, tmp_path, caplog):
+    caplog.set_level(logging.INFO, logger='coomerscraper.aio')
+    route_to(mock_site, monkeypatch)
+    media = dict(list(mock_site.media.items())[:8])
+    urls = [ NamedUrl(f'https://n1.coomer.st/data/{d[:2]}/{d[2:4]}/{d}.jpg', f'{d}.jpg') for d in media ]
+    urls.append(NamedUrl(f'https://n1.coomer.st/data/00/00/{0:064x}.jpg', 'missing.jpg'))
+    completed, dead, threads = [], [], set()
+    def on_complete(nu):
+        completed.append(nu)
+        threads.add(threading.current_thread().name)
+
+    async_download(urls, tmp_path, tmp_path, workers=4, on_complete=on_complete, show_progress=False, on_dead=dead.append)
+    assert sorted(nu.name for nu in completed) == sorted(urls[i].name for i in range(len(media)))
+    assert [ nu.name for nu in dead ] == [ 'missing.jpg' ]
+    assert all(name.startswith('aio-disk') for name in threads)
+    for digest, data in media.items():
+        assert (tmp_path / f'{digest}.jpg').read_bytes() == data
+    assert not list(tmp_path.glob('*.part'))
+    assert f'Downloaded {len(media)}/{len(urls)} files (1 failed)' in caplog.text
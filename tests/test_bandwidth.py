@@ -0,0 +1,73 @@
+import pytest
+
+from coomerscraper.bandwidth import BandwidthShaper, BURST_SECONDS, parse_rate, parse_schedule, ScheduleWindow
+
+
+MEDIA_URL = 'https://n1.coomer.st/data/00/00/file.mp4'
+OTHER_URL = 'https://n2.coomer.st/data/00/00/file.mp4'
+
+
+"""
+Bandwidths take binary units with optional B, iB and /s suffixes, and 0 is no limit.
+"""
+def test_parse_rate():
+    assert parse_rate('500') == 500
+    assert parse_rate('500K') == parse_rate('500kb') == parse_rate('500 KiB/s') == 500 * 1024
+    assert parse_rate('1.5GiB/s') == 1.5 * 1024**3
+    assert parse_rate(' 2m ') == parse_rate('2.M') == 2 * 1024**2
+    assert parse_rate('0') is None and parse_rate('0M') is None
+    for text in ( '', 'M', '-1M', '.5M', '1T', '1 M/h', '1,5M' ):
+        with pytest.raises(ValueError):
+            parse_rate(text)
+
+
+"""
+Schedules are read as windows in the order given, with times from 00:00 to 23:59.
+"""
+def test_parse_schedule():
+    assert parse_schedule('08:00-18:00=1M, 18:00 - 8:00 = 0') == [ ScheduleWindow(8 * 60, 18 * 60, 1024**2)
+                                                                , ScheduleWindow(18 * 60, 8 * 60, None) ]
+    assert parse_schedule('00:00-23:59=500K') == [ ScheduleWindow(0, 23 * 60 + 59, 500 * 1024) ]
+    for text in ( '24:00-08:00=1M', '08:00-24:00=1M', '24:30-01:00=1M', '08:60-09:00=1M', '08:00-09:00'
+                , '8-9=1M', '08:00-09:00=fast', '08:00-18:00=1M,' ):
+        with pytest.raises(ValueError):
+            parse_schedule(text)
+
+
+"""
+Windows cover their start but not their end, and wrap past midnight when they end before they start.
+"""
+def test_schedule_windows():
+    day, night = parse_schedule('08:00-18:00=1M,18:00-08:00=0')
+    assert day.covers(8 * 60) and day.covers(18 * 60 - 1) and not day.covers(18 * 60) and not day.covers(0)
+    assert night.covers(18 * 60) and night.covers(0) and night.covers(8 * 60 - 1) and not night.covers(8 * 60)
+
+    shaper = BandwidthShaper()
+    shaper.configure(rate=100, schedule=[ day ])
+    assert shaper.current_rate(12 * 60) == 1024**2
+    assert shaper.current_rate(20 * 60) == 100
+
+
+"""
+A transfer may burst half a second of its limit, and then waits for every byte past it.
+The tightest of the limits that apply to a transfer sets its wait.
+"""
+def test_throttle_token_math():
+    shaper = BandwidthShaper()
+    assert shaper.throttle(MEDIA_URL).reserve(10**9) == 0.0
+
+    shaper.configure(rate=1000)
+    throttle = shaper.throttle(MEDIA_URL)
+    assert throttle.rate() == 1000
+    assert throttle.reserve(1000 * BURST_SECONDS) == 0.0
+    assert throttle.reserve(1000) == pytest.approx(1.0, abs=0.01)
+    assert throttle.reserve(500) == pytest.approx(1.5, abs=0.01)
+    assert throttle.cap(None) == 1000 and throttle.cap(10) == 10 and throttle.cap(10**6) == 1000
+
+    # Sites share a bucket across their media servers, creators have their own
+    shaper.configure(host_rate=1000, creator_rate=100)
+    first, second = shaper.throttle(MEDIA_URL, 'a'), shaper.throttle(OTHER_URL, 'b')
+    assert first.rate() == 100
+    assert first.reserve(500) == pytest.approx(4.5, abs=0.01)
+    assert second.reserve(50) == pytest.approx(0.05, abs=0.01)
+    assert shaper.throttle(OTHER_URL).rate() == 1000
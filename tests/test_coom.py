@@ -0,0 +1,76 @@
+from coomerscraper.coom import process_page
+from coomerscraper.utils import read_watermark, Watermark, write_watermark
+
+
+"""
+Scrape the page of the first creator of the mock site.
+- site: Running MockSite.
+- since: Newest post of an earlier scrape, if syncing.
+- newest: Filled in with the newest post that was found, if given.
+Returns the IDs of the posts that media files were found in, in order.
+"""
+def scrape(site, since=None, newest=None):
+    ids = []
+    for nu in process_page(site.page_urls()[0], False, False, (None, None), since, newest):
+        if not ids or ids[-1] != nu.post:
+            ids.append(nu.post)
+    return ids
+
+
+"""
+Syncing stops at the newest post of the previous run, and remembers the newest post of this one.
+"""
+def test_sync_stops_at_the_watermark(mock_site):
+    feed = mock_site.posts['creator0']
+    newest = Watermark()
+    assert scrape(mock_site, Watermark(feed[5]['id'], feed[5]['published']), newest) == [ p['id'] for p in feed[:5] ]
+    assert newest == Watermark(feed[0]['id'], feed[0]['published'])
+
+    # Without an earlier scrape, every post is scraped
+    assert scrape(mock_site) == [ p['id'] for p in feed ]
+
+
+"""
+Posts published in the same second as the watermark are still scraped, and a deleted
+watermark post stops the sync at the first older post.
+"""
+def test_sync_keeps_posts_published_with_the_watermark(mock_site):
+    feed = mock_site.posts['creator0']
+    feed[4]['published'] = feed[5]['published']
+    since = Watermark(feed[5]['id'], feed[5]['published'])
+    assert scrape(mock_site, since) == [ p['id'] for p in feed[:5] ]
+
+    del feed[5]
+    assert scrape(mock_site, since) == [ p['id'] for p in feed[:5] ]
+
+
+"""
+Watermarks are kept per page in the download folder of the creator.
+"""
+def test_watermark_round_trip(tmp_path):
+    assert read_watermark(tmp_path, 'onlyfans/a') is None
+    write_watermark(tmp_path, 'onlyfans/a', Watermark('1', '2024-01-02T03:04:05'))
+    write_watermark(tmp_path, 'onlyfans/b', Watermark('2', None))
+    assert read_watermark(tmp_path, 'onlyfans/a') == Watermark('1', '2024-01-02T03:04:05')
+    assert read_watermark(tmp_path, 'onlyfans/b') == Watermark('2', None)
+
+
+"""
+Media URLs are yielded as soon as the first page arrives, later pages are only fetched as
+the URLs are consumed, and closing the generator stops the fetching.
+"""
+def test_page_is_streamed(mock_site):
+    feed = mock_site.posts['creator0']
+    for p in range(len(feed), 180):
+        digest = f'{p:064x}'
+        feed.append(dict(feed[-1], id=str(p), file={ 'name': 'a.jpg', 'path': f'/{digest[:2]}/{digest[2:4]}/{digest}.jpg' }, attachments=[]))
+
+    urls = process_page(mock_site.page_urls()[0], False, False, (None, None))
+    assert mock_site.stats['api'] == 0
+    assert next(urls).post == feed[0]['id']
+    assert mock_site.stats['api'] == 1
+    urls.close()
+    assert mock_site.stats['api'] == 1
+
+    # Consumed to the end, every post of every page is found once
+    assert scrape(mock_site) == [ p['id'] for p in feed ]
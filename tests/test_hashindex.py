@@ -0,0 +1,45 @@
+from coomerscraper.hashindex import FLUSH_EVERY, HashIndex
+
+
+"""
+Create files in a folder.
+- root: Folder to create the files in.
+- count: Number of files.
+Returns the files.
+"""
+def make_files(root, count: int) -> list:
+    files = [ root / f'{i}.jpg' for i in range(count) ]
+    for i, file in enumerate(files):
+        file.write_bytes(b'%d' % i)
+    return files
+
+
+"""
+Hashes are appended to a log in batches, and saving folds the log into the index file.
+"""
+def test_hashes_are_logged_then_saved(tmp_path):
+    files = make_files(tmp_path, FLUSH_EVERY * 2 + 1)
+    index = HashIndex(tmp_path)
+    for file in files:
+        index.add(file, file.name)
+    assert not index.path.exists()
+    assert len(HashIndex(tmp_path).items()) == FLUSH_EVERY * 2
+
+    index.save()
+    assert not index.log_path.exists()
+    assert sorted(HashIndex(tmp_path).items()) == sorted((file, file.name) for file in files)
+
+
+"""
+A log cut short by an interruption is replayed up to the last whole line.
+"""
+def test_truncated_log_is_replayed(tmp_path):
+    files = make_files(tmp_path, FLUSH_EVERY)
+    index = HashIndex(tmp_path)
+    for file in files:
+        index.add(file, file.name)
+    index.prune(files[1:])
+    index.flush()
+    with index.log_path.open('a', encoding='utf-8') as f:
+        f.write('["cut')
+    assert sorted(HashIndex(tmp_path).items()) == sorted((file, file.name) for file in files[1:])
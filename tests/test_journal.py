@@ -0,0 +1,88 @@
+import sqlite3
+
+from coomerscraper import journal as journal_module
+from coomerscraper.coom import ScrapeConfig, main
+from coomerscraper.journal import COMMIT_EVERY, Journal, MAX_RESUMES
+from coomerscraper.mocksite import SERVICE
+from coomerscraper.networking import NamedUrl
+
+
+PAGE = f'https://coomer.st/{SERVICE}/user/creator0'
+
+
+"""
+Scrape the page of the mock site once, syncing with the previous run.
+- dst: Download destination.
+"""
+def scrape(dst) -> None:
+    main(ScrapeConfig( [ PAGE ], dst, jobs=4, api_rate=1000, media_rate=1000, sync=True
+                     , show_progress=False, api_cache_ttl=0 ))
+
+
+"""
+Dead links must not pin the creator to its journal, so later runs still look for new posts.
+"""
+def test_dead_links_do_not_pin_the_journal(mock_site, tmp_path):
+    dead = [ f for post in mock_site.posts['creator0'] for f in [ post['file'], *post['attachments'] ]
+             if f['name'].split('.')[0] not in mock_site.media ]
+    assert dead, 'the mock site should have dead links'
+
+    scrape(tmp_path)
+    journal = Journal(tmp_path / 'creator0')
+    params = { 'skip_img': False, 'skip_vid': False, 'offsets': [ None, None ], 'sync': True, 'since': None }
+    assert journal.resume(PAGE, params) is None
+    journal.close()
+    assert (tmp_path / 'creator0' / '.watermark.json').exists()
+
+    # The second run discovers again instead of resuming the dead links
+    api_requests = mock_site.stats['api']
+    scrape(tmp_path)
+    assert mock_site.stats['api'] > api_requests
+    downloaded = { f.name for folder in ('pics', 'vids') for f in (tmp_path / 'creator0' / folder).iterdir() }
+    assert not any(name.endswith('.part') for name in downloaded)
+
+
+"""
+A job that keeps failing is discovered again after MAX_RESUMES resumes, and only what is
+discovered again is left to download.
+"""
+def test_resume_falls_back_to_discovery(tmp_path):
+    params = { 'skip_img': False }
+    urls = [ NamedUrl(f'https://n1.coomer.st/data/{i:064x}.jpg', f'{i}.jpg', str(i)) for i in range(3) ]
+    journal = Journal(tmp_path)
+    list(journal.record(PAGE, params, urls))
+    journal.complete(urls[0])
+    for _ in range(MAX_RESUMES):
+        assert list(journal.resume(PAGE, params)) == urls[1:]
+    assert journal.resume(PAGE, params) is None
+
+    list(journal.record(PAGE, params, urls[:2]))
+    assert list(journal.resume(PAGE, params)) == urls[1:2]
+    journal.complete(urls[1])
+    assert journal.finish(PAGE)
+    journal.close()
+
+
+"""
+Completed and dead files are committed in batches, and whatever is left when the journal is closed.
+"""
+def test_marks_are_committed_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, 'COMMIT_INTERVAL', 3600.0)
+    urls = [ NamedUrl(f'https://n1.coomer.st/data/{i:064x}.jpg', f'{i}.jpg', str(i)) for i in range(COMMIT_EVERY + 2) ]
+    journal = Journal(tmp_path)
+    list(journal.record(PAGE, { 'skip_img': False }, urls))
+    reader = sqlite3.connect(str(journal.path))
+    def pending():
+        return reader.execute('SELECT COUNT(*) FROM plan WHERE done = ?', (journal_module.PENDING,)).fetchone()[0]
+
+    journal.complete(urls[0])
+    journal.dead(urls[1])
+    assert pending() == len(urls)
+    for nu in urls[2:COMMIT_EVERY]:
+        journal.complete(nu)
+    assert pending() == 2
+    journal.complete(urls[COMMIT_EVERY])
+    assert pending() == 2
+    journal.close()
+    assert pending() == 1
+    reader.close()
@@ -0,0 +1,34 @@
+from coomerscraper.metrics import Metrics
+
+
+"""
+Overlapping spans of a phase count as the wall-clock time they cover, not their sum.
+"""
+def test_phases_are_wall_clock_spans():
+    metrics = Metrics()
+    for start, end in ((10.0, 14.0), (11.0, 15.0), (12.0, 13.0)):
+        metrics.add_span('creator', 'download', start, end)
+    assert metrics.summary()['phases'] == { 'creator': { 'download': 5.0 } }
+    assert 'phase_seconds_total{creator="creator",phase="download"} 5' in metrics.prometheus()
+
+
+"""
+Lazy iterables are timed from the first item asked for to the end of the iteration.
+"""
+def test_timed_iteration_spans_the_whole_iteration():
+    metrics = Metrics()
+    assert list(metrics.timed('creator', 'discover', range(3))) == [ 0, 1, 2 ]
+    assert 'discover' in metrics.summary()['phases']['creator']
+
+
+"""
+Resetting forgets every counter, histogram and phase.
+"""
+def test_reset():
+    metrics = Metrics()
+    metrics.inc('downloads_total')
+    metrics.observe('download_seconds', 1.0)
+    metrics.add_span('creator', 'download', 10.0, 14.0)
+    metrics.reset()
+    summary = metrics.summary()
+    assert summary['counters'] == {} and summary['histograms'] == {} and summary['phases'] == {}
@@ -0,0 +1,209 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from coomerscraper import networking
+from coomerscraper.sessions import configure_session, get_session, pool_size
+from coomerscraper.apicache import configure_api_cache
+
+from coomerscraper.metrics import metrics
+from coomerscraper.mocksite import SERVICE
+from coomerscraper.networking import ( _api_get, _chunk_size, _download, _iter_body, _write_buffer_size, api_fetch_post_multi
+                                     , api_iter_post_pages, download_pool, DownloadTask, MAX_CHUNK_SIZE, MAX_WRITE_BUFFER
+                                     , MIN_CHUNK_SIZE, NamedUrl )
+from coomerscraper.progress import ProgressBoard, SlotProgress
+
+
+"""
+A file that the servers do not have is given up on without backing the servers off.
+"""
+def test_missing_file_is_not_a_server_error(mock_site, tmp_path):
+    url = NamedUrl(f'https://n1.coomer.st/data/00/00/{0:064x}.jpg', 'missing.jpg')
+    with pytest.raises(requests.HTTPError):
+        _download(url, tmp_path / url.name, SlotProgress())
+    assert 'media_errors_total' not in metrics.summary()['counters']
+
+
+"""
+An API that keeps throttling is given up on without sleeping after the last attempt.
+"""
+def test_api_gives_up_without_a_last_backoff(mock_site, monkeypatch):
+    mock_site.throttle_rate = 1.0
+    sleeps = []
+    monkeypatch.setattr(networking.time, 'sleep', sleeps.append)
+    res = _api_get(f'https://coomer.st/api/v1/{SERVICE}/user/creator0/posts')
+    assert res.status_code == 429
+    assert mock_site.stats['throttled'] == networking.API_MAX_ATTEMPTS
+    assert len(sleeps) == networking.API_MAX_ATTEMPTS - 1 and min(sleeps) >= 1
+
+
+"""
+Pages are only read ahead once a full page shows that more may follow.
+"""
+def test_short_first_page_costs_one_request(mock_site):
+    pages = list(api_iter_post_pages('https://coomer.st', SERVICE, 'creator0', 0, 10**6, 50, 4))
+    assert [ offset for offset, _ in pages ] == [ 0 ]
+    assert mock_site.stats['api'] == 1
+
+
+"""
+The first page of a creator is always revalidated, deeper pages are reused while fresh.
+"""
+def test_first_page_is_always_revalidated(mock_site, tmp_path):
+    configure_api_cache(tmp_path, 3600)
+    try:
+        for _ in range(2):
+            api_fetch_post_multi('https://coomer.st', SERVICE, 'creator0', 0)
+            api_fetch_post_multi('https://coomer.st', SERVICE, 'creator0', 50)
+    finally:
+        configure_api_cache(None)
+    assert mock_site.stats['api'] == 3
+    assert mock_site.stats['revalidated'] == 1
+
+
+"""
+Download a video out of the mock site in segments.
+- mock_site: Running MockSite.
+- tmp_path: Folder to download to.
+Returns the content of the video and of the downloaded file.
+"""
+def download_segmented(mock_site, tmp_path):
+    digest, data = next(iter(mock_site.media.items()))
+    url = NamedUrl(f'https://n1.coomer.st/data/{digest[:2]}/{digest[2:4]}/{digest}.mp4', 'video.mp4')
+    _download(url, tmp_path / url.name, SlotProgress(), segments=4, segment_threshold=1)
+    return data, (tmp_path / url.name).read_bytes()
+
+
+"""
+Large videos are fetched in byte ranges when the server takes them.
+"""
+def test_segmented_download(mock_site, tmp_path):
+    data, downloaded = download_segmented(mock_site, tmp_path)
+    assert downloaded == data
+    assert mock_site.stats['media'] == 5
+
+
+"""
+A server that ignores byte ranges gets a single stream instead of endless retries.
+"""
+def test_ignored_ranges_fall_back_to_a_single_stream(mock_site, tmp_path):
+    mock_site.ignore_ranges = True
+    data, downloaded = download_segmented(mock_site, tmp_path)
+    assert downloaded == data
+    assert not list(tmp_path.glob('*.part'))
+
+
+"""
+Connections of concurrent segmented downloads are all kept alive once the pool is sized for them.
+"""
+def test_pool_keeps_every_segment_connection(mock_site, tmp_path, caplog):
+    mock_site.latency = 0.05
+    videos = list(mock_site.media)[:4]
+    def download_all(folder):
+        folder.mkdir()
+        urls = [ NamedUrl(f'https://n1.coomer.st/data/{d[:2]}/{d[2:4]}/{d}.mp4', f'{d}.mp4') for d in videos ]
+        with ThreadPoolExecutor(len(urls)) as pool:
+            list(pool.map(lambda nu: _download(nu, folder / nu.name, SlotProgress(), segments=4, segment_threshold=1), urls))
+
+    caplog.set_level(logging.WARNING, logger='urllib3.connectionpool')
+    configure_session(4)
+    download_all(tmp_path / 'small')
+    assert 'Connection pool is full' in caplog.text
+
+    caplog.clear()
+    configure_session(pool_size(len(videos), 4))
+    download_all(tmp_path / 'sized')
+    assert 'Connection pool is full' not in caplog.text
+
+
+"""
+Chunks grow with the file up to a cap, shrink for slow servers, and stay whole multiples of
+the smallest chunk, while write buffers hold a few chunks up to their own cap.
+"""
+def test_chunk_and_buffer_sizes():
+    assert _chunk_size(None, None) == MIN_CHUNK_SIZE
+    assert _chunk_size(1024, None) == MIN_CHUNK_SIZE
+    assert _chunk_size(10**12, None) == MAX_CHUNK_SIZE
+    assert _chunk_size(10**12, 100.0) == MIN_CHUNK_SIZE
+    size = _chunk_size(10**12, 1024 * 1024)
+    assert MIN_CHUNK_SIZE < size < MAX_CHUNK_SIZE and size % MIN_CHUNK_SIZE == 0
+    assert _chunk_size(300 * 1024 * 1024, 10**9) % MIN_CHUNK_SIZE == 0
+
+    assert _write_buffer_size(MIN_CHUNK_SIZE) == 4 * MIN_CHUNK_SIZE
+    assert _write_buffer_size(MAX_CHUNK_SIZE) == MAX_WRITE_BUFFER
+    assert _write_buffer_size(MAX_WRITE_BUFFER) == MAX_WRITE_BUFFER
+
+
+"""
+A body cut short raises the same error whether or not it is read into a reusable buffer.
+"""
+@pytest.mark.parametrize('zero_copy', [ False, True ])
+def test_truncated_body_is_an_error(mock_site, zero_copy):
+    digest, data = next(iter(mock_site.media.items()))
+    url = f'https://n1.coomer.st/data/{digest[:2]}/{digest[2:4]}/{digest}.jpg'
+    with get_session().get(url, stream=True, timeout=5) as res:
+        assert b''.join(_iter_body(res, MIN_CHUNK_SIZE, zero_copy)) == data
+
+    mock_site.drop_rate = 1.0
+    received = 0
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        with get_session().get(url, stream=True, timeout=5) as res:
+            for chunk in _iter_body(res, MIN_CHUNK_SIZE, zero_copy):
+                received += len(chunk)
+    assert received < len(data)
+
+
+"""
+Every download that is over moves the progress on, and the ones that failed are counted apart.
+"""
+def test_failed_downloads_are_counted(mock_site, tmp_path):
+    urls = [ NamedUrl(f'https://n1.coomer.st/data/{d[:2]}/{d[2:4]}/{d}.jpg', f'{d}.jpg') for d in list(mock_site.media)[:3] ]
+    urls.append(NamedUrl(f'https://n1.coomer.st/data/00/00/{0:064x}.jpg', 'missing.jpg'))
+    tasks = iter([ DownloadTask(nu, tmp_path / nu.name) for nu in urls ])
+    board = ProgressBoard(2, len(urls), 20, show=False)
+    download_pool(lambda: next(tasks, None), 2, board=board)
+    assert (board.files, board.failed) == (3, 1)
+
+
+"""
+Download a file of the mock site whose content no longer matches the hash in its URL.
+- mock_site: Running MockSite.
+- tmp_path: Folder to download to.
+- segments: Number of byte ranges to download the file in.
+Returns the served content and the downloaded file.
+"""
+def download_corrupt(mock_site, tmp_path, segments: int):
+    digest = next(iter(mock_site.media))
+    mock_site.media[digest] = corrupt = bytes(len(mock_site.media[digest]))
+    url = NamedUrl(f'https://n1.coomer.st/data/{digest[:2]}/{digest[2:4]}/{digest}.mp4', 'corrupt.mp4')
+    _download(url, tmp_path / url.name, SlotProgress(), segments=segments, segment_threshold=1)
+    return corrupt, tmp_path / url.name
+
+
+"""
+Files whose hash does not match their URL are downloaded again, and kept once the mismatch
+persisted for MAX_CORRUPT_RETRIES attempts, whether streamed or fetched in byte ranges.
+"""
+@pytest.mark.parametrize('segments', [ 1, 4 ])
+def test_hash_mismatch_is_retried_then_kept(mock_site, tmp_path, segments):
+    corrupt, file = download_corrupt(mock_site, tmp_path, segments)
+    assert file.read_bytes() == corrupt
+    assert not list(tmp_path.glob('*.part*'))
+    assert metrics.summary()['counters']['hash_mismatches_total'][''] == networking.MAX_CORRUPT_RETRIES
+    # A segmented download first learns the size of the file from a plain request
+    assert mock_site.stats['media'] == networking.MAX_CORRUPT_RETRIES * segments + (segments > 1)
+
+
+"""
+A partial download whose bytes do not match the URL hash is thrown away and downloaded whole.
+"""
+def test_corrupt_partial_download_starts_over(mock_site, tmp_path):
+    digest, data = next(iter(mock_site.media.items()))
+    url = NamedUrl(f'https://n1.coomer.st/data/{digest[:2]}/{digest[2:4]}/{digest}.jpg', 'image.jpg')
+    (tmp_path / 'image.jpg.part').write_bytes(bytes(len(data) // 2))
+    _download(url, tmp_path / url.name, SlotProgress())
+    assert (tmp_path / url.name).read_bytes() == data
+    assert mock_site.stats['media'] == 2
+    assert metrics.summary()['counters']['hash_mismatches_total'][''] == 1
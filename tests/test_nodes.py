@@ -0,0 +1,60 @@
+import time
+
+from coomerscraper.nodes import NodeHealth
+
+
+"""
+A failing server is avoided until its backoff expires, for at least its Retry-After.
+"""
+def test_failed_server_is_backed_off():
+    health = NodeHealth((1, 2))
+    health.record_error(1, 429, retry_after=30)
+    assert 29 < health.delay(1) <= 30
+    assert all(health.choose() == 2 for _ in range(20))
+    assert health.choose(exclude=2) == 2
+    assert health.rank() == [ 2, 1 ]
+
+    # With every server backed off, the one that is free first is chosen
+    health.record_error(2, 503, retry_after=60)
+    assert health.choose() == 1
+
+
+"""
+A transfer that was already running when the server failed does not clear its backoff.
+"""
+def test_running_transfer_keeps_the_backoff():
+    health = NodeHealth((1, 2))
+    started = time.monotonic()
+    health.record_error(1, 429, retry_after=30)
+    health.record_success(1, 4 * 1024 * 1024, 1.0, 0.1, started)
+    assert health.delay(1) > 29
+    assert health.choose() == 2
+
+    # A request made once the backoff is over clears it
+    health.record_success(1, 4 * 1024 * 1024, 1.0, 0.1, time.monotonic() + 31)
+    assert health.delay(1) == 0
+
+
+"""
+Servers are chosen in proportion to their throughput, after every server was tried once.
+"""
+def test_faster_server_is_preferred():
+    health = NodeHealth((1, 2))
+    health.record_success(1, 100 * 1024 * 1024, 1.0, 0.01)
+    assert health.choose() == 2
+    health.record_success(2, 1024 * 1024, 1.0, 0.01)
+    picks = [ health.choose() for _ in range(200) ]
+    assert picks.count(1) > 150
+    assert health.throughput(1) == 100 * 1024 * 1024
+
+
+"""
+Resetting forgets every measurement and backoff, but keeps the servers.
+"""
+def test_reset():
+    health = NodeHealth((1, 2))
+    health.record_error(1, 429, retry_after=30)
+    health.record_success(2, 1024 * 1024, 1.0, 0.01)
+    health.reset()
+    assert health.delay(1) == 0 and health.throughput(2) is None
+    assert sorted(health.rank()) == [ 1, 2 ]
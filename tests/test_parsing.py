@@ -0,0 +1,86 @@
+from coomerscraper.coom import parse_posts_json, process_prefetched
+from coomerscraper.networking import NamedUrl
+
+
+BASE = 'https://coomer.st'
+DATA = 'https://n1.coomer.st/data/'
+
+
+"""
+Get the path of a media file on the servers.
+- i: Number of the file, used as its hash.
+- ext: Extension of the file.
+Returns the path, as the API lists it.
+"""
+def path(i: int, ext: str) -> str:
+    digest = f'{i:064x}'
+    return f'/{digest[:2]}/{digest[2:4]}/{digest}.{ext}'
+
+
+"""
+Create a post JSON like the ones the API returns.
+- post_id: ID of the post.
+- files: Paths of the main file, or None for a post without one, and of the attachments.
+- title: Title of the post.
+Returns the post.
+"""
+def post(post_id: str, files, title: str = 'Hello, World! #2') -> dict:
+    main, *attachments = files
+    return { 'id': post_id, 'title': title, 'published': '2024-01-02T03:04:05'
+           , 'file': { 'name': 'a.jpg', 'path': main } if main is not None else {}
+           , 'attachments': [ { 'name': 'a.jpg', 'path': p } for p in attachments ] }
+
+
+"""
+Files are named after the post and numbered by their place in it, main file first, even
+when the attachments share a name.
+"""
+def test_files_are_numbered_in_their_post():
+    urls = list(parse_posts_json(BASE, [ post('1', [ path(1, 'jpg'), path(2, 'jpg'), path(3, 'mp4') ]) ], False, False))
+    assert urls == [ NamedUrl(f'{DATA}{path(1, "jpg")}', '20240102T030405-HelloWorld2_0.jpg', '1')
+                   , NamedUrl(f'{DATA}{path(2, "jpg")}', '20240102T030405-HelloWorld2_1.jpg', '1')
+                   , NamedUrl(f'{DATA}{path(3, "mp4")}', '20240102T030405-HelloWorld2_2.mp4', '1') ]
+
+
+"""
+Attachments are numbered from 1 whether the main file is empty, missing or null.
+"""
+def test_posts_without_a_main_file():
+    empty = post('1', [ None, path(1, 'jpg') ])
+    missing = post('2', [ None, path(2, 'jpg') ])
+    del missing['file']
+    null = dict(post('3', [ None, path(3, 'jpg') ]), file=None)
+    urls = list(parse_posts_json(BASE, [ empty, missing, null ], False, False))
+    assert [ (nu.name, nu.post) for nu in urls ] == [ ('20240102T030405-HelloWorld2_1.jpg', str(i)) for i in (1, 2, 3) ]
+
+
+"""
+Paths are appended to the data folder as they are, double slashes included.
+"""
+def test_double_slashes_are_kept():
+    odd = '//' + path(1, 'jpg').lstrip('/')
+    urls = list(parse_posts_json(BASE, [ post('1', [ path(2, 'png'), odd ]) ], False, False))
+    assert [ nu.url for nu in urls ] == [ f'{DATA}{path(2, "png")}', f'{DATA}{odd}' ]
+    assert urls[0].url.startswith('https://n1.coomer.st/data//')
+    assert urls[0].digest == bytes.fromhex(f'{2:064x}') and urls[1].digest == bytes.fromhex(f'{1:064x}')
+
+
+"""
+Skipped files keep the numbers of the others, and a skipped main file does not skip its attachments.
+"""
+def test_skipped_files():
+    posts = [ post('1', [ path(1, 'mp4'), path(2, 'jpg'), path(3, 'mov') ]) ]
+    assert [ nu.name for nu in parse_posts_json(BASE, posts, False, True) ] == [ '20240102T030405-HelloWorld2_1.jpg' ]
+    assert [ nu.name for nu in parse_posts_json(BASE, posts, True, False) ] == [ '20240102T030405-HelloWorld2_0.mp4'
+                                                                              , '20240102T030405-HelloWorld2_2.mov' ]
+    assert list(parse_posts_json(BASE, posts, True, True)) == []
+
+
+"""
+Prefetched media URLs drop their query and are named after their hash.
+"""
+def test_prefetched_url():
+    url = f'https://coomer.st/data{path(1, "mp4")}?f=My%20Video.mp4'
+    assert process_prefetched(url, False, False) == [ NamedUrl(url.split('?')[0], f'{1:064x}.mp4') ]
+    assert process_prefetched(url, False, True) == []
+    assert process_prefetched(url, True, False) != []
@@ -0,0 +1,14 @@
+import json
+
+from coomerscraper.plan import read_plan
+
+
+"""
+Entries whose path leaves the destination or has no creator folder are skipped.
+"""
+def test_paths_need_a_creator_folder(tmp_path):
+    url = f'https://n1.coomer.st/data/{0:064x}.jpg'
+    paths = [ 'creator/pics/a.jpg', 'a.jpg', '', '/creator/pics/a.jpg', 'creator/../a.jpg', './creator/a.jpg' ]
+    plan = tmp_path / 'plan.jsonl'
+    plan.write_text(''.join(json.dumps({ 'url': url, 'name': 'a.jpg', 'path': path }) + '\n' for path in paths))
+    assert [ entry.path for entry in read_plan(plan) ] == [ 'creator/pics/a.jpg', './creator/a.jpg' ]
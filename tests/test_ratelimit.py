@@ -0,0 +1,47 @@
+from coomerscraper import ratelimit
+from coomerscraper.ratelimit import API_RATE, MEDIA_RATE, MIN_RATE, RateLimiter
+
+
+MEDIA_URL = 'https://n1.coomer.st/data/00/00/file.mp4'
+OTHER_URL = 'https://n2.coomer.st/data/00/00/file.mp4'
+
+
+"""
+Media servers are not limited until they answer 429, while the API always is.
+"""
+def test_media_is_unlimited_until_throttled():
+    limiter = RateLimiter()
+    assert limiter.bucket(MEDIA_URL) is None
+    assert limiter.reserve(MEDIA_URL) == 0.0
+    assert limiter.bucket('https://coomer.st/api/v1/posts').rate == API_RATE
+
+    limiter.record_error(MEDIA_URL, 503)
+    assert limiter.bucket(MEDIA_URL) is None
+    limiter.record_error(MEDIA_URL, 429)
+    assert limiter.bucket(MEDIA_URL).rate == MEDIA_RATE
+    assert limiter.bucket(OTHER_URL) is None
+
+
+"""
+Every new 429 halves the rate of the server, once per cooldown and down to the minimum rate.
+"""
+def test_throttled_server_is_slowed_down(monkeypatch):
+    limiter = RateLimiter()
+    limiter.record_error(MEDIA_URL, 429)
+    limiter.record_error(MEDIA_URL, 429)
+    assert limiter.bucket(MEDIA_URL).rate == MEDIA_RATE
+
+    monkeypatch.setattr(ratelimit, 'THROTTLE_COOLDOWN', 0.0)
+    limiter.record_error(MEDIA_URL, 429)
+    assert limiter.bucket(MEDIA_URL).rate == MEDIA_RATE / 2
+    for _ in range(10):
+        limiter.record_error(MEDIA_URL, 429)
+    assert limiter.bucket(MEDIA_URL).rate == MIN_RATE
+
+
+"""
+A fixed media rate limits every server from the start.
+"""
+def test_fixed_media_rate():
+    limiter = RateLimiter(media_rate=3.0)
+    assert limiter.bucket(MEDIA_URL).rate == 3.0
@@ -0,0 +1,187 @@
+import threading
+
+from coomerscraper import scheduler
+from coomerscraper.networking import NamedUrl, ProbeResult
+from coomerscraper.scheduler import DownloadJob, LARGE_FILE_SIZE, ORDER_WINDOW, Scheduler
+
+
+"""
+Create a job of synthetic image URLs.
+- tmp_path: Folder to download to.
+- count: Number of URLs.
+Returns the job.
+"""
+def make_job(tmp_path, count: int) -> DownloadJob:
+    urls = [ NamedUrl(f'https://n1.coomer.st/data/{i:064x}.jpg', f'{i}.jpg', str(i)) for i in range(count) ]
+    return DownloadJob('page', 'coomer.st', 'creator', iter(urls), tmp_path, tmp_path)
+
+
+"""
+Run a scheduler with a download pool that finishes every task at once.
+- sched: Scheduler to run.
+- monkeypatch: Pytest monkeypatch fixture.
+- workers: Number of download slots.
+Returns the tasks in the order they were handed out.
+"""
+def run(sched, monkeypatch, workers: int = 2) -> list:
+    tasks = []
+    def pool(next_task, *args):
+        while (task := next_task()) is not None:
+            tasks.append(task)
+            task.on_finish(task.url)
+    monkeypatch.setattr(scheduler, 'download_pool', pool)
+    sched.download(workers)
+    return tasks
+
+
+"""
+Sizes are probed in batches of a window on the discovery thread, even for lists, not one
+URL per handed out task on the dispatcher.
+"""
+def test_sizes_are_probed_in_batches_while_discovering(tmp_path, monkeypatch):
+    batches, threads = [], set()
+    def probe(urls):
+        batches.append(len(urls))
+        threads.add(threading.current_thread().name)
+        return {}
+    monkeypatch.setattr(scheduler, 'probe_sizes', probe)
+    sched = Scheduler(order='smallest')
+    job = make_job(tmp_path, 500)
+    job.urls = list(job.urls)
+    sched.add(job)
+    assert len(run(sched, monkeypatch)) == 500
+    assert sum(batches) == 500 and set(batches[:-1]) == { ORDER_WINDOW }
+    assert threads == { 'discover-creator' }
+
+
+"""
+Sizes are only held on to until their URL is handed out.
+"""
+def test_sizes_are_released_on_handout(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler, 'probe_sizes', lambda urls: { nu.key(): 1024 for nu in urls })
+    sched = Scheduler(order='smallest')
+    sched.add(make_job(tmp_path, 100))
+    tasks = run(sched, monkeypatch)
+    assert len(tasks) == 100 and all(task.size == 1024 for task in tasks)
+    assert not sched._sizes
+
+
+"""
+Lists are downloaded newest post first, with the files of each post kept in their order
+and files without a publish time last.
+"""
+def test_newest_first(tmp_path, monkeypatch):
+    names = [ '20240101T000000-a_0.jpg', '20240301T000000-c_0.jpg', 'hash.jpg', '20240301T000000-c_1.mp4'
+            , '20240201T000000-b_0.jpg', '20240301T000000-c_2.jpg' ]
+    urls = [ NamedUrl(f'https://n1.coomer.st/data/{i:064x}.jpg', name) for i, name in enumerate(names) ]
+    sched = Scheduler(order='newest')
+    sched.add(DownloadJob('plan', 'coomer.st', 'creator', urls, tmp_path, tmp_path))
+    assert [ task.url.name for task in run(sched, monkeypatch) ] == [ names[i] for i in (1, 3, 5, 4, 0, 2) ]
+
+
+"""
+Mixed ordering only gives the share of large files to files past the large file size, so a
+window of small files is downloaded smallest first.
+"""
+def test_mixed_classifies_large_files_by_size(tmp_path):
+    def picks(sizes):
+        sched = Scheduler(order='mixed')
+        sched._workers = 4
+        job = make_job(tmp_path, len(sizes))
+        sched._sizes = { nu.key(): size for nu, size in zip(make_job(tmp_path, len(sizes)).urls, sizes) }
+        sched.add(job)
+        picked = []
+        while (task := sched.next_task()) is not None:
+            picked.append(int(task.url.name[:-4]))
+        return picked, sched._large
+
+    sizes = [ LARGE_FILE_SIZE if i in (3, 5) else 1000 + i for i in range(8) ]
+    assert picks(sizes) == ([ 3, 0, 1, 2, 4, 6, 7, 5 ], 2)
+    assert picks([ 1000 - i for i in range(8) ]) == ([ 7, 6, 5, 4, 3, 2, 1, 0 ], 0)
+
+
+"""
+A job that is slow to discover does not hold back the downloads of the others.
+"""
+def test_slow_discovery_does_not_block_other_jobs(tmp_path, monkeypatch):
+    gate = threading.Event()
+    def slow():
+        yield NamedUrl(f'https://n1.coomer.st/data/{0:064x}.jpg', 'slow0.jpg')
+        gate.wait(5)
+        yield NamedUrl(f'https://n1.coomer.st/data/{1:064x}.jpg', 'slow1.jpg')
+    fast = make_job(tmp_path, 10)
+    fast.urls = (nu for nu in fast.urls)
+
+    handed = []
+    def pool(next_task, *args):
+        while (task := next_task()) is not None:
+            handed.append(task.url.name)
+            task.on_finish(task.url)
+            if len(handed) == 11:
+                gate.set()
+    monkeypatch.setattr(scheduler, 'download_pool', pool)
+    sched = Scheduler()
+    sched.add(DownloadJob('slow', 'coomer.st', 'slow', slow(), tmp_path, tmp_path))
+    sched.add(fast)
+    sched.download(2)
+    assert len(handed) == 12 and handed[-1] == 'slow1.jpg'
+
+
+"""
+A job whose discovery fails is marked as failed, while the other jobs are still downloaded.
+"""
+def test_failed_discovery_only_fails_its_job(tmp_path, monkeypatch):
+    def broken():
+        yield NamedUrl(f'https://n1.coomer.st/data/{0:064x}.jpg', 'broken0.jpg')
+        raise KeyError('file')
+    good = make_job(tmp_path, 10)
+    good.urls = (nu for nu in good.urls)
+    bad = DownloadJob('broken', 'coomer.st', 'broken', broken(), tmp_path, tmp_path)
+
+    handed = []
+    def pool(next_task, *args):
+        while (task := next_task()) is not None:
+            handed.append(task.url.name)
+            task.on_finish(task.url)
+    monkeypatch.setattr(scheduler, 'download_pool', pool)
+    sched = Scheduler()
+    sched.add(bad)
+    sched.add(good)
+    sched.download(2)
+    assert len(handed) == 11 and 'broken0.jpg' in handed
+    assert bad.failed and not good.failed
+
+
+"""
+Preflight probes lists a window at a time while they are downloaded, rather than every URL
+up front, and takes the dropped URLs out of the total.
+"""
+def test_preflight_is_lazy(tmp_path, monkeypatch):
+    first_task = threading.Event()
+    batches = []
+    def probe_all(urls):
+        if batches:
+            assert first_task.wait(5)
+        batches.append(len(urls))
+        return [ ProbeResult(404 if int(nu.name[:-4]) % 10 == 0 else 200, 1024) for nu in urls ]
+    monkeypatch.setattr(scheduler, 'probe_all', probe_all)
+
+    handed, boards = [], []
+    def pool(next_task, workers, total_urls, width, segments, threshold, show, zero_copy, board):
+        boards.append(board)
+        while (task := next_task()) is not None:
+            if not handed:
+                assert len(batches) == 1
+                first_task.set()
+            handed.append(task.url.name)
+            task.on_finish(task.url)
+    monkeypatch.setattr(scheduler, 'download_pool', pool)
+
+    job = make_job(tmp_path, 300)
+    job.urls = list(job.urls)
+    sched = Scheduler(preflight=True)
+    sched.add(job)
+    sched.download(2, show_progress=False)
+    assert len(handed) == 270 and '10.jpg' not in handed
+    assert batches == [ ORDER_WINDOW ] * 4 + [ 300 - 4 * ORDER_WINDOW ]
+    assert boards[0].total_urls == 300 and boards[0].total() == 270
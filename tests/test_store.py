@@ -0,0 +1,127 @@
+import errno
+import hashlib
+import os
+
+import pytest
+
+from coomerscraper import store
+from coomerscraper.coom import purge_duplicate_urls
+from coomerscraper.hashindex import HashIndex
+from coomerscraper.networking import NamedUrl
+from coomerscraper.store import ContentStore, content_store
+
+
+"""
+Write a file and get its hash.
+- file: File to write.
+- data: Content of the file.
+Returns the hex digest of the content.
+"""
+def write(file, data: bytes) -> str:
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_bytes(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+"""
+Make hardlinks fail as they do across file systems.
+- monkeypatch: Pytest monkeypatch fixture.
+"""
+def no_hardlinks(monkeypatch):
+    def link(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(store.os, 'link', link)
+
+
+"""
+Use a content store in a folder for the duration of a test.
+"""
+@pytest.fixture
+def shared_store(tmp_path):
+    content_store.configure(tmp_path / 'store')
+    yield content_store
+    content_store.configure(None)
+
+
+"""
+Added files are hardlinked into the store once, and linked back out under any name.
+"""
+def test_add_and_link_out(tmp_path):
+    cs = ContentStore()
+    cs.configure(tmp_path / 'store')
+    digest = write(tmp_path / 'a' / 'file.jpg', b'media')
+    cs.add(tmp_path / 'a' / 'file.jpg', digest)
+    assert cs.contains(digest) and os.path.samefile(cs.path(digest), tmp_path / 'a' / 'file.jpg')
+    cs.add(tmp_path / 'a' / 'file.jpg', digest)
+    assert list(cs.path(digest).parent.iterdir()) == [ cs.path(digest) ]
+
+    (tmp_path / 'b').mkdir()
+    assert cs.link_out(digest, tmp_path / 'b' / 'copy.jpg')
+    assert os.path.samefile(tmp_path / 'b' / 'copy.jpg', cs.path(digest))
+    assert not cs.link_out(None, tmp_path / 'b' / 'none.jpg') and not cs.link_out('0' * 64, tmp_path / 'b' / 'none.jpg')
+
+
+"""
+Without hardlinks, files are cloned, and only copied out of the store when cloning fails too.
+"""
+def test_link_falls_back_to_clone_then_copy(tmp_path, monkeypatch):
+    no_hardlinks(monkeypatch)
+    src = tmp_path / 'src.jpg'
+    write(src, b'media')
+    clones = []
+    def ioctl(fd, request, arg):
+        assert request == store.FICLONE
+        clones.append(fd)
+        os.write(fd, b'media')
+    monkeypatch.setattr(store.fcntl, 'ioctl', ioctl)
+    store._link(src, tmp_path / 'clone.jpg', allow_copy=False)
+    assert len(clones) == 1 and (tmp_path / 'clone.jpg').read_bytes() == b'media'
+
+    def no_clone(fd, request, arg):
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+    monkeypatch.setattr(store.fcntl, 'ioctl', no_clone)
+    with pytest.raises(OSError):
+        store._link(src, tmp_path / 'nocopy.jpg', allow_copy=False)
+    assert not (tmp_path / 'nocopy.jpg').exists()
+    store._link(src, tmp_path / 'copy.jpg', allow_copy=True)
+    assert (tmp_path / 'copy.jpg').read_bytes() == b'media'
+    assert not os.path.samefile(src, tmp_path / 'copy.jpg')
+
+
+"""
+Files are only added to a store they can be linked into, never copied into it.
+"""
+def test_add_does_not_copy(tmp_path, monkeypatch):
+    no_hardlinks(monkeypatch)
+    monkeypatch.setattr(store.fcntl, 'ioctl', lambda *args: (_ for _ in ()).throw(OSError(errno.EOPNOTSUPP, '')))
+    cs = ContentStore()
+    cs.configure(tmp_path / 'store')
+    digest = write(tmp_path / 'file.jpg', b'media')
+    cs.add(tmp_path / 'file.jpg', digest)
+    assert not cs.contains(digest) and not list(cs.path(digest).parent.iterdir())
+
+
+"""
+Files in the store are linked out while purging, and only files new to a folder are offered
+to the store once the folder was shared with it.
+"""
+def test_purge_links_stored_files(tmp_path, shared_store, monkeypatch):
+    stored = write(tmp_path / 'other' / 'pics' / 'stored.jpg', b'stored')
+    shared_store.add(tmp_path / 'other' / 'pics' / 'stored.jpg', stored)
+    dst = tmp_path / 'creator'
+    existing = write(dst / 'pics' / 'existing.jpg', b'existing')
+    urls = [ NamedUrl(f'https://n1.coomer.st/data/{d[:2]}/{d[2:4]}/{d}.jpg', f'{name}.jpg')
+             for d, name in ((stored, 'linked'), (existing, 'existing'), ('ab' * 32, 'new')) ]
+
+    index = HashIndex(dst)
+    left = list(purge_duplicate_urls(dst, urls, index, 1, link_stored=True))
+    assert [ nu.name for nu in left ] == [ 'new.jpg' ]
+    assert os.path.samefile(dst / 'pics' / 'linked.jpg', shared_store.path(stored))
+    assert shared_store.contains(existing) and shared_store.shared(dst)
+    index.save()
+
+    added = []
+    monkeypatch.setattr(shared_store, 'add', lambda file, digest: added.append(file.name))
+    write(dst / 'pics' / 'later.jpg', b'later')
+    assert [ nu.name for nu in purge_duplicate_urls(dst, urls, HashIndex(dst), 1) ] == [ 'new.jpg' ]
+    assert added == [ 'later.jpg' ]
@@ -0,0 +1,83 @@
+from coomerscraper.networking import NamedUrl
+from coomerscraper.urllist import DigestSet, MAX_EXTS, MAX_FILE_NUMBER, UrlList
+
+
+"""
+Create a media NamedUrl of a post.
+- i: Number of the file, used as its hash.
+- name: Name of the file.
+- ext: Extension of the file.
+- post: Post the file belongs to.
+Returns the NamedUrl.
+"""
+def media(i: int, name: str, ext: str = 'jpg', post: str = '1') -> NamedUrl:
+    digest = f'{i:064x}'
+    return NamedUrl(f'https://n1.coomer.st/data/{digest[:2]}/{digest[2:4]}/{digest}.{ext}', name, post)
+
+
+"""
+Media URLs are rebuilt exactly as they were added, by position, slice and iteration.
+"""
+def test_round_trip_media():
+    urls = [ media(i, f'20240101T000000-Title_{i % 7}.jpg', post=str(i // 7)) for i in range(100) ]
+    plan = UrlList(urls)
+    assert len(plan) == 100
+    assert list(plan) == urls
+    assert plan[-1] == urls[-1] and plan[42] == urls[42]
+    assert list(plan[10:20]) == urls[10:20]
+
+
+"""
+URLs without a hash folder layout, names that do not follow the stem_N layout, and
+files numbered past what fits in a file number are kept as they are.
+"""
+def test_round_trip_irregular_urls_and_names():
+    urls = [ NamedUrl('https://n1.coomer.st/data/file.jpg', 'file.jpg')
+           , NamedUrl(f'https://coomer.st/thumbnail/{0:064x}.jpg', 'thumb.jpg', '1')
+           , NamedUrl(f'https://n1.coomer.st/data//00/00/{0:064x}.jpg', 'double.jpg')
+           , media(1, 'no-number.jpg')
+           , media(2, 'leading_01.jpg')
+           , media(3, 'other_3.png')
+           , media(4, 'dotted.name_4.jpg')
+           , media(5, f'big_{MAX_FILE_NUMBER + 1}.jpg')
+           , media(6, f'max_{MAX_FILE_NUMBER}.jpg')
+           , media(7, 'nopost_7.jpg', post=None) ]
+    plan = UrlList(urls)
+    assert list(plan) == urls
+    assert [ nu.url for nu in plan ] == [ nu.url for nu in urls ]
+
+
+"""
+Extensions past the table of extension codes are kept whole instead of being coded.
+"""
+def test_round_trip_many_extensions():
+    urls = [ media(i, f'title_{i}.e{i}', ext=f'e{i}') for i in range(MAX_EXTS + 10) ]
+    assert list(UrlList(urls)) == urls
+
+
+"""
+Lists longer than a 16-bit position round-trip, along with their file numbers.
+"""
+def test_round_trip_long_list():
+    urls = [ media(i, f'title_{i % (MAX_FILE_NUMBER + 10)}.jpg', post=str(i // 1000)) for i in range(70000) ]
+    plan = UrlList(urls)
+    assert len(plan) == 70000
+    assert plan[69999] == urls[69999] and plan[MAX_FILE_NUMBER + 1] == urls[MAX_FILE_NUMBER + 1]
+    assert list(plan) == urls
+
+
+"""
+Hashes and keys without a hash are each only added once.
+"""
+def test_digest_set():
+    keys = [ media(i, 'x.jpg').key() for i in range(5000) ] + [ 'https://n1.coomer.st/data/file.jpg' ]
+    seen = DigestSet()
+    assert all(seen.add(key) for key in keys)
+    assert not any(seen.add(key) for key in keys)
+    assert len(seen) == len(keys) and all(key in seen for key in keys)
+    assert media(99999, 'x.jpg').key() not in seen and 'other' not in seen and None not in seen
+
+    # A hash that only matches across two stored hashes is not in the set
+    first, second = bytes(18) + bytes(range(1, 15)), bytes(2) + bytes(range(50, 80))
+    seen = DigestSet([ first, second ])
+    assert first[16:] + second[:16] not in seen
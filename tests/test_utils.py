@@ -0,0 +1,30 @@
+import hashlib
+
+from coomerscraper.hashindex import HashIndex
+from coomerscraper.utils import _parallel_hash, compute_file_hashes, hash_file, HASH_BUFFER_SIZE, HASH_MMAP_THRESHOLD
+
+
+"""
+Hashing on a thread pool gives the same digests as hashing serially, for files read through
+buffers and for files memory-mapped from the mmap threshold on.
+"""
+def test_parallel_hash_matches_serial(tmp_path):
+    sizes = [ 0, 1, HASH_BUFFER_SIZE - 1, HASH_BUFFER_SIZE + 1, HASH_MMAP_THRESHOLD - 1, HASH_MMAP_THRESHOLD
+            , HASH_MMAP_THRESHOLD + HASH_BUFFER_SIZE + 7 ] + list(range(2, 40))
+    files = []
+    for i, size in enumerate(sizes):
+        file = tmp_path / f'{i}.mp4'
+        with file.open('wb') as f:
+            f.write(bytes([ i ]) * min(size, 4096))
+            f.truncate(size)
+        files.append(file)
+    expected = { file: hashlib.sha256(file.read_bytes()).hexdigest() for file in files }
+
+    pending = [ (file, file.stat()) for file in files ]
+    assert { file: hash_file(file, st.st_size) for file, st in pending } == expected
+    assert { file: digest for file, _, digest in _parallel_hash(pending, 4) } == expected
+
+    # One thread per core is the default, and fills in the hash index the same way
+    index = HashIndex(tmp_path)
+    assert compute_file_hashes(tmp_path, index) == set(expected.values())
+    assert dict(index.items()) == expected